@@ -1,26 +1,40 @@
-import matplotlib.pyplot as plt
-import tskit
-import sys
+import numpy as np
 import math
+from argparse import ArgumentParser
 
-wf = tskit.load(sys.argv[1])
-ooa = tskit.load(sys.argv[2])
 
-fig, ax = plt.subplots(ncols=1)
+def get_parser():
+    parser = ArgumentParser("af_compare.py")
+    parser.add_argument("spectra", help="Spectra written by afs_replicates.py")
+    parser.add_argument("output", help="Output figure")
+    return parser
 
-afs_wf = wf.allele_frequency_spectrum(
-    polarised=False, mode="site", span_normalise=False
-)[1 : math.ceil(wf.num_samples / 2)]
 
-afs_ooa = ooa.allele_frequency_spectrum(
-    polarised=False, mode="site", span_normalise=False
-)[1 : math.ceil(ooa.num_samples / 2)]
+def main(args):
+    import matplotlib.pyplot as plt
 
-plot_args = dict(marker=".", ls="")
-ax.plot(afs_wf, label="WF", **plot_args)
-ax.plot(afs_ooa, label="OOA", **plot_args)
-ax.legend()
+    # plot the mean folded AFS of every model in an afs_replicates.py output,
+    # with one standard deviation across replicates
+    spectra = np.load(args.spectra)
 
-ax.set_title("Folded AFS of out-of-Africa vs constant size Wright-Fisher continuation")
+    fig, ax = plt.subplots(ncols=1)
 
-fig.savefig(sys.argv[3])
+    plot_args = dict(marker=".", ls="")
+    for model in spectra["models"]:
+        mean = spectra[f"{model}_mean"]
+        stdev = np.sqrt(spectra[f"{model}_variance"])
+        # the folded spectrum is zero past half the number of samples
+        num_samples = len(mean) - 1
+        bins = np.arange(1, math.ceil(num_samples / 2))
+        count = int(spectra[f"{model}_count"])
+        ax.errorbar(bins, mean[bins], stdev[bins], label=f"{model} (n={count})",
+                    **plot_args)
+    ax.legend()
+
+    ax.set_title("Folded AFS of out-of-Africa vs constant size Wright-Fisher continuation")
+
+    fig.savefig(args.output)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
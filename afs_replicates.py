@@ -0,0 +1,127 @@
+"""
+Mean and variance of the folded allele frequency spectrum over many
+replicate tree sequences of several models.
+
+The files are streamed through a pool of processes, each of which loads one
+tree sequence at a time and sends back its spectrum only. The spectra of
+every model are accumulated online, and the means, variances and replicate
+counts are written to a single .npz file, which `af_compare.py` plots.
+"""
+import multiprocessing
+from argparse import ArgumentParser
+
+import numpy as np
+
+import instrument
+import storage
+
+from replicate_stats import RunningMoments
+from simulate import status
+
+
+def folded_afs(path, mode="site"):
+    """
+    Folded, not span-normalised, allele frequency spectrum of a tree
+    sequence file.
+    """
+    ts = storage.load(path)
+    return ts.allele_frequency_spectrum(
+        polarised=False, mode=mode, span_normalise=False
+    )
+
+
+def _afs_task(task):
+    model, path, mode = task
+    return model, folded_afs(path, mode)
+
+
+def accumulate_afs(models, mode="site", processes=None):
+    """
+    Stream the files of every model, a dict mapping model names to lists of
+    tree sequence files, and return the running moments of each model.
+    """
+    moments = {model: RunningMoments() for model in models}
+    tasks = [(model, path, mode) for model, paths in models.items() for path in paths]
+
+    if processes == 1:
+        for model, afs in map(_afs_task, tasks):
+            moments[model].add(afs)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            # imap keeps the order of the files, so the sums are reproducible
+            for model, afs in pool.imap(_afs_task, tasks):
+                moments[model].add(afs)
+    return moments
+
+
+def save_afs(path, moments, mode):
+    """
+    Write the spectra as `<model>_mean`, `<model>_variance` and
+    `<model>_count` arrays, with the model names in `models`.
+    """
+    empty = [model for model, moment in moments.items() if moment.count == 0]
+    if empty:
+        raise ValueError(f"No tree sequences for models {', '.join(empty)}")
+    arrays = dict(models=np.array(list(moments)), mode=np.array(mode))
+    for model, moment in moments.items():
+        arrays[f"{model}_mean"] = moment.mean
+        arrays[f"{model}_variance"] = moment.variance
+        arrays[f"{model}_count"] = np.array(moment.count)
+    np.savez_compressed(path, **arrays)
+
+
+def get_parser():
+    parser = ArgumentParser("afs_replicates.py")
+    parser.add_argument("output", help="Output .npz file")
+    parser.add_argument(
+        "--model",
+        "-m",
+        nargs="+",
+        action="append",
+        required=True,
+        metavar=("NAME", "FILE"),
+        help="A model name followed by its tree sequence files; repeat for "
+        "every model",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["site", "branch"],
+        default="site",
+        help="Spectrum of the sites or of the branch lengths",
+    )
+    parser.add_argument(
+        "--processes",
+        "-j",
+        default=None,
+        type=int,
+        help="Number of worker processes (default: all cores)",
+    )
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    parser = get_parser()
+    models = {}
+    for name, *paths in args.model:
+        models.setdefault(name, []).extend(paths)
+    for name, paths in models.items():
+        if not paths:
+            # e.g. a glob that matched nothing under nullglob
+            parser.error(f"argument --model/-m: no tree sequence files for "
+                         f"model {name}")
+    instrument.start("afs", args)
+    with instrument.span("afs", models=len(models),
+                         tree_sequences=sum(map(len, models.values()))):
+        moments = accumulate_afs(models, mode=args.mode,
+                                 processes=args.processes)
+    with instrument.span("write"):
+        save_afs(args.output, moments, args.mode)
+    for model, moment in moments.items():
+        status(f"{model}: {moment.count} replicates")
+    status(f"Wrote the spectra to {args.output}")
+    instrument.finish(args.output)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,22 +1,205 @@
-import numpy as np
+"""
+Turn a BALSAC genealogy export, a CSV file with a header and the individual,
+father and mother IDs in its first three columns, into a text genealogy with
+a founder row for every parent that is missing from the export.
+
+The CSV is read twice, in blocks of `--block-rows` lines: once to collect
+the individual and parent IDs into sorted arrays, and once to write the
+founders followed by the original rows. Only integer ID and index arrays
+are held in memory, never the parsed table. Duplicated IDs, individuals who
+are their own parent and cycles are errors, and leave no output behind.
+"""
+import io
+import os
+import sys
 from argparse import ArgumentParser
+from itertools import chain, islice
+
+import numpy as np
+
+import instrument
+from pedigree import (PedigreeWriter, TextPedigreeWriter, _id_dtype,
+                      cyclic_rows)
+
+COLUMNS = ("individual", "father", "mother")
+BLOCK_ROWS = 1_000_000
+
+
+def status(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+
+def fill_empty_fields(text):
+    """
+    Write 0 in the empty fields of CSV lines; a few passes of str.replace
+    are much faster than a regular expression.
+    """
+    # twice, as the first pass leaves every other field of a run of commas
+    text = text.replace(",,", ",0,").replace(",,", ",0,")
+    text = text.replace(",\n", ",0\n").replace("\n,", "\n0,")
+    if text.startswith(","):
+        text = "0" + text
+    if text.endswith(","):
+        text += "0"
+    return text
+
+
+def sorted_unique(values):
+    """
+    Sorted unique values; sorting and dropping repeats is faster than
+    `np.unique` on large integer arrays.
+    """
+    values = np.sort(values, axis=None)
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+
+def read_blocks(path, block_rows=BLOCK_ROWS):
+    """
+    Yield the individual, father and mother columns of the CSV file as
+    (n, 3) int64 arrays of at most `block_rows` rows, with empty fields
+    read as 0.
+    """
+    with open(path) as f:
+        next(f, None)
+        while True:
+            text = "".join(islice(f, block_rows))
+            if not text:
+                return
+            if text.isspace():
+                continue
+            yield np.loadtxt(io.StringIO(fill_empty_fields(text)),
+                             delimiter=",", usecols=(0, 1, 2),
+                             dtype=np.int64, ndmin=2)
+
+
+def check_block(block):
+    """
+    Reject IDs that are not positive, and individuals who are their own
+    parent.
+    """
+    if np.any(block[:, 0] <= 0) or np.any(block[:, 1:] < 0):
+        bad = block[(block[:, 0] <= 0) | np.any(block[:, 1:] < 0, axis=1)][0]
+        raise ValueError(f"Invalid IDs in row {bad.tolist()}: individuals "
+                         f"must be positive and parents positive or 0")
+    own_parent = np.any(block[:, 1:] == block[:, :1], axis=1)
+    if np.any(own_parent):
+        raise ValueError(f"Individual {block[own_parent, 0][0]} is their "
+                         f"own parent")
+
+
+def scan_ids(path, block_rows=BLOCK_ROWS):
+    """
+    First pass: the IDs of the founders to add, and of all the rows of the
+    output (founders first) as a sorted array and its row order.
+    """
+    individuals, parents = [], []
+    for block in read_blocks(path, block_rows):
+        check_block(block)
+        individuals.append(block[:, 0])
+        parents.append(sorted_unique(block[:, 1:]))
+    individuals = np.concatenate(individuals or [np.empty(0, np.int64)])
+    parents = sorted_unique(
+        np.concatenate(parents or [np.empty(0, np.int64)]))
+
+    sorted_individuals = np.sort(individuals)
+    duplicated = sorted_individuals[1:] == sorted_individuals[:-1]
+    if np.any(duplicated):
+        raise ValueError(f"{np.count_nonzero(duplicated)} duplicated IDs, "
+                         f"e.g. {sorted_individuals[1:][duplicated][0]}")
+    founders = np.setdiff1d(parents[parents != 0], sorted_individuals,
+                            assume_unique=True)
+
+    id_all = np.concatenate([founders, individuals])
+    id_order = np.argsort(id_all, kind="stable").astype(np.int32)
+    return founders, id_all[id_order], id_order
+
+
+def parent_index(ids, id_sorted, id_order):
+    """
+    Rows of the parents with the given IDs, -1 for a missing (0) parent.
+    Every other ID is known after `scan_ids`.
+    """
+    pos = np.searchsorted(id_sorted, ids)
+    return np.where(ids == 0, -1, id_order[np.minimum(pos, len(id_order) - 1)])
+
+
+def preprocess(input, output, binary_output=None, block_rows=BLOCK_ROWS):
+    """
+    Write the founders, then the rows of the CSV file, to the text genealogy
+    `output`, and to the binary pedigree `binary_output` if given. Returns
+    the number of founders and of rows read.
+    """
+    founders, id_sorted, id_order = scan_ids(input, block_rows)
+    id_dtype = _id_dtype(id_sorted)
+    founder_rows = np.zeros((len(founders), len(COLUMNS)), dtype=np.int64)
+    founder_rows[:, 0] = founders
+
+    # the text output is renamed into place once everything is checked
+    partial = output + ".partial"
+    binary = None
+    if binary_output is not None:
+        binary = PedigreeWriter(
+            binary_output, COLUMNS + ("father_index", "mother_index"),
+            dtype=dict(individual=id_dtype, father=id_dtype, mother=id_dtype,
+                       father_index=np.int32, mother_index=np.int32))
+    try:
+        father_index, mother_index = [], []
+        with TextPedigreeWriter(partial, COLUMNS) as text:
+            for block in chain([founder_rows], read_blocks(input, block_rows)):
+                text.write(block)
+                father_index.append(
+                    parent_index(block[:, 1], id_sorted, id_order).astype(np.int32))
+                mother_index.append(
+                    parent_index(block[:, 2], id_sorted, id_order).astype(np.int32))
+                if binary is not None:
+                    binary.write_columns(
+                        [*block.T, father_index[-1], mother_index[-1]])
+        num_rows = text.num_rows
+
+        cycle = cyclic_rows(np.concatenate(father_index),
+                            np.concatenate(mother_index))
+        if len(cycle):
+            ids = np.empty_like(id_sorted)
+            ids[id_order] = id_sorted
+            raise ValueError(f"{len(cycle)} individuals are their own ancestor "
+                             f"or descend from one, e.g. {ids[cycle[0]]}")
+    except BaseException:
+        if binary is not None:
+            binary.abort()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    if binary is not None:
+        binary.close(extra=[("id_sorted", id_sorted.astype(id_dtype)),
+                            ("id_order", id_order)])
+    os.replace(partial, output)
+    return len(founders), num_rows - len(founders)
+
 
-parser = ArgumentParser("balsac_preprocess.py")
-parser.add_argument("input")
-parser.add_argument("output")
-args = parser.parse_args()
+def get_parser():
+    parser = ArgumentParser("balsac_preprocess.py")
+    parser.add_argument("input", help="BALSAC CSV export")
+    parser.add_argument("output", help="Output genealogy file")
+    parser.add_argument("--binary-output", "-b", default=None,
+                        help="Also write the genealogy in the binary pedigree "
+                             "format")
+    parser.add_argument("--block-rows", default=BLOCK_ROWS, type=int,
+                        help="Number of CSV lines parsed at a time")
+    instrument.add_arguments(parser)
+    return parser
 
-table = np.genfromtxt(args.input, delimiter=",", skip_header=1,
-                      usecols=(0, 1, 2), dtype=int, filling_values=0)
 
-individuals = set(table[:, 0])
-fathers = set(table[:, 1])
-mothers = set(table[:, 2])
-parents = fathers.union(mothers)
-missing_parents = parents - individuals
-missing_parents.remove(0)
+def main(args):
+    instrument.start("preprocess", args)
+    with instrument.span("preprocess") as span:
+        num_founders, num_rows = preprocess(args.input, args.output,
+                                            binary_output=args.binary_output,
+                                            block_rows=args.block_rows)
+        span.count(individuals=num_rows, founders=num_founders)
+    status(f"Read {num_rows} individuals, added {num_founders} founders")
+    instrument.finish(args.output)
 
-extra_rows = np.array([(parent, 0, 0) for parent in missing_parents])
 
-np.savetxt(args.output, np.row_stack([extra_rows, table]),
-           fmt="%d", delimiter="\t", header="individual\tfather\tmother")
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -30,7 +30,10 @@ GEN=cached/genealogy.tsv
 OUT=example_sim
 
 ## Simulate!
-python msp_sim_gen.py $GEN $OUT -r $REC -l $CHR -a ${PBS_ARRAYID} --no-provenance
-
-# NB: --no-provenance flag is a temporary work-around. By default, proband info
-#     is stored in the tree sequence, which can be a waste of space
+mkdir -p $OUT
+# every stage is checkpointed in $OUT/checkpoints: resubmitting the array
+# resumes each task from its last finished stage instead of starting over.
+# The outputs are simplified to the probands and their lineages (--compact)
+# and gzip-compressed (.gz), which every script reads.
+python simulate.py $GEN $OUT/sim_${PBS_ARRAYID}.trees.gz -r $REC -l $CHR \
+    --seed ${PBS_ARRAYID} --checkpoint-dir $OUT/checkpoints --compact
@@ -0,0 +1,127 @@
+"""
+Compare the array-backed `create_genealogy.simulate_pedigree` against the
+original set-based implementation.
+
+Run from the repository root:
+
+    python -m benchmarks.genealogy --founders 1000 10000 --generations 50
+"""
+from argparse import ArgumentParser
+from itertools import count
+from timeit import default_timer as timer
+
+import numpy as np
+from numpy import random as rnd
+
+from create_genealogy import simulate_pedigree
+
+
+def reference_simulate_pedigree(n_founders, n_generations,
+                                avg_offspring=2,
+                                avg_immigrants=2,
+                                seed=None):
+    """
+    The original one-individual-at-a-time implementation, kept verbatim
+    (minus the progress bar) as the baseline for this benchmark.
+    """
+    rng = rnd.default_rng(seed)
+    current_males, current_females = set(), set()
+    next_males, next_females = set(), set()
+
+    ped = []
+    id_counter = count(1)
+
+    for _ in range(n_founders):
+        ind_id = next(id_counter)
+        male = rng.random() < 0.5
+        if male:
+            current_males.add(ind_id)
+            ped.append((ind_id, 0, 0, n_generations, 1))
+        else:
+            current_females.add(ind_id)
+            ped.append((ind_id, 0, 0, n_generations, 2))
+
+    for t in range(n_generations-1, -1, -1):
+        diff = len(current_males) - len(current_females)
+        if diff > 0:
+            for _ in range(diff):
+                ind_id = next(id_counter)
+                current_females.add(ind_id)
+                ped.append((ind_id, 0, 0, t+1, 2))
+        elif diff < 0:
+            for _ in range(-diff):
+                ind_id = next(id_counter)
+                current_males.add(ind_id)
+                ped.append((ind_id, 0, 0, t+1, 1))
+
+        while len(current_males) and len(current_females):
+            father = current_males.pop()
+            mother = current_females.pop()
+
+            n_children = rng.poisson(avg_offspring)
+
+            for ch in range(n_children):
+                child_id = next(id_counter)
+                child_male = rng.random() < 0.5
+                if child_male:
+                    next_males.add(child_id)
+                    ped.append((child_id, father, mother, t, 1))
+                else:
+                    next_females.add(child_id)
+                    ped.append((child_id, father, mother, t, 2))
+
+        if t > 1:
+            n_immigrants = rnd.poisson(avg_immigrants)
+            for _ in range(n_immigrants):
+                ind_id = next(id_counter)
+                ind_male = rng.random() < 0.5
+                if ind_male:
+                    next_males.add(ind_id)
+                    ped.append((ind_id, 0, 0, t, 1))
+                else:
+                    next_females.add(ind_id)
+                    ped.append((ind_id, 0, 0, t, 2))
+
+        if not (next_males or next_females):
+            raise(RuntimeError('Simulation terminated at time t=' + str(t)))
+        current_males = next_males
+        current_females = next_females
+        next_males = set()
+        next_females = set()
+
+    return np.array(ped)
+
+
+def best_of(repeats, func, *args, **kwargs):
+    times = []
+    for _ in range(repeats):
+        start = timer()
+        result = func(*args, **kwargs)
+        times.append(timer() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.genealogy")
+    parser.add_argument("--founders", "-f", type=int, nargs="+",
+                        default=[1_000, 10_000, 100_000])
+    parser.add_argument("--generations", "-g", type=int, default=20)
+    parser.add_argument("--children", "-c", type=float, default=2.0)
+    parser.add_argument("--repeats", "-n", type=int, default=3)
+    parser.add_argument("--seed", "-s", type=int, default=42)
+    args = parser.parse_args()
+
+    print("founders\tindividuals\treference_s\tvectorized_s\tspeedup")
+    for n_founders in args.founders:
+        kwargs = dict(avg_offspring=args.children, seed=args.seed)
+        t_ref, ref = best_of(args.repeats, reference_simulate_pedigree,
+                             n_founders, args.generations, **kwargs)
+        t_vec, ped = best_of(args.repeats, simulate_pedigree,
+                             n_founders, args.generations, **kwargs)
+
+        # the seeded mode has to be reproducible
+        again = simulate_pedigree(n_founders, args.generations, **kwargs)
+        assert np.array_equal(ped, again)
+
+        print(f"{n_founders}\t{len(ped)}\t{t_ref:.3f}\t{t_vec:.3f}\t"
+              f"{t_ref / t_vec:.1f}x")
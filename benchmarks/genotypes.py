@@ -0,0 +1,76 @@
+"""
+Compare `ts.write_vcf`, as convert_to_bcf.py used to run it, against the
+chunked VCF writer and the PLINK .bed writer in genotypes.py.
+
+Run from the repository root:
+
+    python -m benchmarks.genotypes --individuals 1000 10000 --processes 1 4
+"""
+import io
+import os
+import tempfile
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+import msprime
+
+import genotypes
+
+
+def simulate(num_individuals, length, seed):
+    ts = msprime.sim_ancestry(
+        num_individuals,
+        sequence_length=length,
+        recombination_rate=1e-8,
+        population_size=10_000,
+        random_seed=seed,
+    )
+    return msprime.sim_mutations(ts, rate=1e-8, random_seed=seed)
+
+
+def timed(func, *args, **kwargs):
+    start = timer()
+    result = func(*args, **kwargs)
+    return timer() - start, result
+
+
+def tskit_vcf(ts):
+    output = io.StringIO()
+    ts.write_vcf(output)
+    return output.getvalue().encode()
+
+
+def chunked_vcf(ts, nodes, names, processes):
+    output = io.BytesIO()
+    genotypes.write_vcf(output, ts, nodes, names, processes=processes)
+    return output.getvalue()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.genotypes")
+    parser.add_argument("--individuals", "-n", type=int, nargs="+",
+                        default=[1_000, 10_000])
+    parser.add_argument("--length", "-l", type=float, default=1e6)
+    parser.add_argument("--processes", "-j", type=int, nargs="+",
+                        default=[1, 4])
+    parser.add_argument("--seed", "-s", type=int, default=42)
+    args = parser.parse_args()
+
+    print("individuals\tsites\tprocesses\twrite_vcf_s\tchunked_s\tbed_s\t"
+          "speedup")
+    for n in args.individuals:
+        ts = simulate(n, args.length, args.seed)
+        nodes = ts.samples()
+        names = [f"tsk_{j}" for j in range(ts.num_individuals)]
+        t_tskit, expected = timed(tskit_vcf, ts)
+        for processes in args.processes:
+            t_chunked, text = timed(chunked_vcf, ts, nodes, names, processes)
+            # the chunked writer has to write the same bytes as tskit
+            assert text == expected
+            with tempfile.TemporaryDirectory() as directory:
+                prefix = os.path.join(directory, "genotypes")
+                sources = [(ts, nodes, names, "1", 0)]
+                t_bed, _ = timed(genotypes.write_plink, prefix, sources,
+                                 processes=processes)
+            print(f"{n}\t{ts.num_sites}\t{processes}\t{t_tskit:.3f}\t"
+                  f"{t_chunked:.3f}\t{t_bed:.3f}\t{t_tskit / t_chunked:.1f}x")
@@ -0,0 +1,90 @@
+"""
+Runtime and accuracy of the hybrid Wright-Fisher then Hudson continuation
+of complete_simulation_wf.py, for several switch points, against pure
+Wright-Fisher.
+
+The input stands in for a pedigree simulation: a Wright-Fisher simulation
+stopped `--input-generations` generations back. Accuracy is the relative L1
+distance between the mean branch-length AFS of the replicates and that of
+an independent set of pure Wright-Fisher replicates, so the `dtwf` row gives
+the distance due to replicate noise alone.
+
+Run from the repository root:
+
+    python -m benchmarks.hybrid --switch 0 10 100 1000 --replicates 20
+"""
+import os
+import tempfile
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+import msprime
+import numpy as np
+
+from complete_simulation_wf import complete
+
+
+def make_input(path, samples, population_size, length, recomb_rate,
+               generations, seed):
+    ts = msprime.sim_ancestry(
+        samples,
+        population_size=population_size,
+        sequence_length=length,
+        recombination_rate=recomb_rate,
+        model="dtwf",
+        end_time=generations,
+        random_seed=seed,
+    )
+    ts.dump(path)
+
+
+def mean_afs(input_ts, population_size, dtwf_generations, seeds):
+    """
+    Mean folded branch AFS of the completions with the given seeds, and the
+    mean time per completion.
+    """
+    spectra = []
+    start = timer()
+    for seed in seeds:
+        ts = complete(input_ts, population_size,
+                      dtwf_generations=dtwf_generations, seed=seed)
+        spectra.append(ts.allele_frequency_spectrum(polarised=False,
+                                                    mode="branch"))
+    return np.mean(spectra, axis=0), (timer() - start) / len(seeds)
+
+
+def afs_distance(afs, reference):
+    return np.abs(afs - reference).sum() / np.abs(reference).sum()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.hybrid")
+    parser.add_argument("--switch", type=int, nargs="+",
+                        default=[0, 10, 100, 1000],
+                        help="Wright-Fisher generations above the input")
+    parser.add_argument("--replicates", "-n", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--population-size", "-N", type=int, default=1_000)
+    parser.add_argument("--length", "-l", type=float, default=1e6)
+    parser.add_argument("--recomb-rate", "-r", type=float, default=1e-8)
+    parser.add_argument("--input-generations", type=int, default=20)
+    parser.add_argument("--seed", "-s", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_ts = os.path.join(tmp, "input.trees")
+        make_input(input_ts, args.samples, args.population_size, args.length,
+                   args.recomb_rate, args.input_generations, args.seed)
+        seeds = range(args.seed, args.seed + args.replicates)
+        reference_seeds = range(args.seed + args.replicates,
+                                args.seed + 2 * args.replicates)
+        reference, _ = mean_afs(input_ts, args.population_size, None,
+                                reference_seeds)
+
+        print("dtwf_generations\tseconds\tspeedup\tafs_distance")
+        afs, t_dtwf = mean_afs(input_ts, args.population_size, None, seeds)
+        print(f"dtwf\t{t_dtwf:.3f}\t1.0x\t{afs_distance(afs, reference):.3f}")
+        for switch in args.switch:
+            afs, t = mean_afs(input_ts, args.population_size, switch, seeds)
+            print(f"{switch}\t{t:.3f}\t{t_dtwf / t:.1f}x\t"
+                  f"{afs_distance(afs, reference):.3f}")
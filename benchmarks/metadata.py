@@ -0,0 +1,59 @@
+"""
+Compare encoding individual metadata row by row with `add_row`, as
+simulate.py used to, against the vectorized encoders in metadata.py.
+
+Run from the repository root:
+
+    python -m benchmarks.metadata --individuals 100000 1000000
+"""
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+import numpy as np
+import tskit
+
+from metadata import INDIVIDUAL_JSON_SCHEMA, encode_individual_metadata
+
+
+def encode_add_row(names, is_sample):
+    table = tskit.IndividualTable()
+    table.metadata_schema = tskit.MetadataSchema(INDIVIDUAL_JSON_SCHEMA)
+    for name, sample in zip(names, is_sample):
+        table.add_row(
+            metadata={"individual_name": int(name), "is_sample": bool(sample)}
+        )
+    return table.metadata, table.metadata_offset
+
+
+def timed(func, *args, **kwargs):
+    start = timer()
+    result = func(*args, **kwargs)
+    return timer() - start, result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.metadata")
+    parser.add_argument("--individuals", "-n", type=int, nargs="+",
+                        default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--seed", "-s", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print("individuals\tadd_row_s\tjson_s\tstruct_s\tjson_speedup")
+    for n in args.individuals:
+        names = rng.integers(1, 10**9, size=n)
+        is_sample = rng.random(n) < 0.1
+
+        t_loop, (loop_meta, loop_offset) = timed(encode_add_row, names,
+                                                 is_sample)
+        t_json, (meta, offset) = timed(encode_individual_metadata, names,
+                                       is_sample, codec="json")
+        t_struct, _ = timed(encode_individual_metadata, names, is_sample,
+                            codec="struct")
+
+        # the vectorized JSON has to be byte-for-byte what add_row writes
+        assert np.array_equal(loop_meta, meta)
+        assert np.array_equal(loop_offset, offset)
+
+        print(f"{n}\t{t_loop:.3f}\t{t_json:.3f}\t{t_struct:.3f}\t"
+              f"{t_loop / t_json:.1f}x")
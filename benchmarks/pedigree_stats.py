@@ -0,0 +1,105 @@
+"""
+Compare the generation-at-a-time kinship and inbreeding of
+`pedigree_stats.py` against the textbook recursion over pairs of
+individuals, memoized, on a random sample of probands.
+
+The genealogy is either simulated with `create_genealogy.simulate_pedigree`
+or read from a file. The memo of the recursion grows with the number of
+pairs of ancestors, to gigabytes for a few thousand founders, so on a real
+genealogy only time the frontier method with `--no-reference`.
+
+Run from the repository root:
+
+    python -m benchmarks.pedigree_stats --founders 100 300 --probands 20 100
+    python -m benchmarks.pedigree_stats --genealogy data/balsac.tsv \
+        --probands 100 1000 --no-reference
+"""
+import sys
+from argparse import ArgumentParser
+from functools import lru_cache
+from timeit import default_timer as timer
+
+import numpy as np
+
+import pedigree_stats
+from create_genealogy import simulate_pedigree
+from pedigree import PedigreeColumns, founder_generations, load_pedigree
+
+
+def reference_kinship(ped, rows):
+    """
+    Kinship by recursing on the younger of every pair of individuals.
+    """
+    father = ped.father_index.tolist()
+    mother = ped.mother_index.tolist()
+    generation = founder_generations(ped.father_index,
+                                     ped.mother_index).tolist()
+
+    @lru_cache(maxsize=None)
+    def phi(i, j):
+        if i < 0 or j < 0:
+            return 0.0
+        if i == j:
+            return (1 + phi(father[i], mother[i])) / 2
+        if generation[i] < generation[j]:
+            i, j = j, i
+        return (phi(father[i], j) + phi(mother[i], j)) / 2
+
+    rows = [int(r) for r in rows]
+    return np.array([[phi(min(i, j), max(i, j)) for j in rows] for i in rows])
+
+
+def simulated_pedigree(founders, generations, seed):
+    ped = simulate_pedigree(founders, generations, seed=seed)
+    return PedigreeColumns({"individual": ped[:, 0], "father": ped[:, 1],
+                            "mother": ped[:, 2]})
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.pedigree_stats")
+    parser.add_argument("--founders", "-f", type=int, nargs="+",
+                        default=[100, 300])
+    parser.add_argument("--generations", "-g", type=int, default=15)
+    parser.add_argument("--genealogy", default=None,
+                        help="Use this genealogy instead of simulated ones")
+    parser.add_argument("--probands", "-p", type=int, nargs="+",
+                        default=[20, 100])
+    parser.add_argument("--no-reference", action="store_true",
+                        help="Do not run the recursion")
+    parser.add_argument("--seed", "-s", type=int, default=42)
+    args = parser.parse_args()
+    sys.setrecursionlimit(100_000)
+
+    if args.genealogy is not None:
+        pedigrees = [(args.genealogy, load_pedigree(args.genealogy))]
+    else:
+        pedigrees = [(f"{f} founders",
+                      simulated_pedigree(f, args.generations, args.seed))
+                     for f in args.founders]
+
+    print("genealogy\tindividuals\tprobands\treference_s\tfrontier_s\t"
+          "speedup\tmax_error\tinbreeding_all_s")
+    rng = np.random.default_rng(args.seed)
+    for name, ped in pedigrees:
+        start = timer()
+        pedigree_stats.inbreeding(ped)
+        t_inbreeding = timer() - start
+
+        probands = ped.proband_indices()
+        for n in args.probands:
+            rows = np.sort(rng.choice(probands, min(n, len(probands)),
+                                      replace=False))
+            start = timer()
+            kinship = pedigree_stats.kinship(ped, rows)
+            t_frontier = timer() - start
+            if args.no_reference:
+                print(f"{name}\t{ped.num_individuals}\t{len(rows)}\t\t"
+                      f"{t_frontier:.3f}\t\t\t{t_inbreeding:.3f}")
+                continue
+            start = timer()
+            reference = reference_kinship(ped, rows)
+            t_ref = timer() - start
+            error = np.abs(kinship - reference).max()
+            print(f"{name}\t{ped.num_individuals}\t{len(rows)}\t{t_ref:.3f}\t"
+                  f"{t_frontier:.3f}\t{t_ref / t_frontier:.1f}x\t{error:.2g}\t"
+                  f"{t_inbreeding:.3f}")
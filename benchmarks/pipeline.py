@@ -0,0 +1,299 @@
+"""
+Time every stage of the pipeline over a sweep of synthetic genealogies,
+chromosome lengths, recombination rates and sample counts.
+
+Every genealogy is simulated with `create_genealogy` and its probands are
+listed once. Every combination of length, recombination rate and number of
+sampled probands is then simulated, completed, mutated and converted. Every
+stage is an `msp_gen.py` command run in its own process, and its wall time,
+CPU time (user + system) and peak RSS are read from the rusage of that
+process. The results are written to a JSON file. With `--baseline`, stages
+whose time or memory grew by more than `--tolerance` over an earlier
+results file are flagged, and the exit status is 1.
+
+Stages that need a missing dependency are skipped: `complete` without
+stdpopsim, and `convert` without bcftools writes PLINK files instead. A
+failed stage is recorded, and the stages that depend on it are skipped.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline --founders 100 1000 --length 1e5 1e6 \\
+        --output results.json --baseline previous_results.json
+"""
+import importlib.metadata
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+MSP_GEN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "msp_gen.py")
+# parameters that identify a configuration in the results
+CONFIG_KEYS = ("founders", "generations", "length", "recomb_rate", "samples")
+
+
+def run_stage(command, log_file):
+    """
+    Run an msp_gen.py command in its own process. Returns its exit code,
+    wall time, CPU time and peak RSS in bytes.
+    """
+    with open(log_file, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, MSP_GEN, *command],
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # the rusage of this one child, rather than of all of them
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return dict(
+        returncode=process.returncode,
+        wall_time=wall_time,
+        cpu_time=usage.ru_utime + usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss=usage.ru_maxrss * 1024,
+    )
+
+
+class Pipeline:
+    """
+    Runs the stages of one configuration in a work directory, and collects
+    one result per stage. A stage runs only if its inputs were made.
+    """
+
+    def __init__(self, work_dir, config, results):
+        self.work_dir = work_dir
+        self.config = config
+        self.results = results
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def stage(self, name, command, inputs=(), outputs=(), **extra):
+        result = dict(self.config, stage=name, **extra)
+        missing = [path for path in inputs if not os.path.exists(path)]
+        if missing:
+            result["status"] = "skipped"
+            result["reason"] = f"missing {', '.join(map(os.path.basename, missing))}"
+        else:
+            log_file = self.path(f"{name}.log")
+            result.update(run_stage(command, log_file))
+            result["status"] = "done" if result["returncode"] == 0 else "failed"
+            if result["status"] == "failed":
+                result["log"] = log_file
+                for path in outputs:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+        self.results.append(result)
+        print_result(result)
+        return result["status"] == "done"
+
+
+def print_result(result):
+    config = "\t".join(str(result[key]) for key in CONFIG_KEYS)
+    if result["status"] == "skipped":
+        print(f"{config}\t{result['stage']}\tskipped\t\t\t{result['reason']}")
+    else:
+        print(f"{config}\t{result['stage']}\t{result['status']}\t"
+              f"{result['wall_time']:.2f}\t{result['cpu_time']:.2f}\t"
+              f"{result['peak_rss'] / 2**20:.0f}", flush=True)
+
+
+def sample_probands(proband_file, samples, output, seed):
+    """
+    Write a random subset of `samples` probands, or all of them for 0.
+    """
+    probands = np.loadtxt(proband_file, dtype=np.int64, ndmin=1)
+    if samples and samples < len(probands):
+        rng = np.random.default_rng(seed)
+        probands = np.sort(rng.choice(probands, samples, replace=False))
+    np.savetxt(output, probands, fmt="%d")
+
+
+def run_genealogy(args, work_dir, founders, results):
+    """
+    The genealogy stages of one genealogy size, shared by every simulation
+    over it. Returns the genealogy and proband files.
+    """
+    config = dict(founders=founders, generations=args.generations,
+                  length=None, recomb_rate=None, samples=None)
+    pipeline = Pipeline(work_dir, config, results)
+    genealogy = pipeline.path("genealogy.tsv")
+    probands = pipeline.path("probands.txt")
+    pipeline.stage(
+        "genealogy",
+        ["genealogy", str(founders), str(args.generations), "--seed",
+         str(args.seed), "--no-progress", "--output", genealogy],
+        outputs=[genealogy])
+    pipeline.stage("probands", ["probands", genealogy, probands],
+                   inputs=[genealogy], outputs=[probands])
+    return genealogy, probands
+
+
+def run_simulation(args, work_dir, config, genealogy, probands, results):
+    pipeline = Pipeline(work_dir, config, results)
+    seed = str(args.seed)
+    sim, wf, ooa = (pipeline.path(f"{n}.trees") for n in ("sim", "wf", "ooa"))
+    mutated = pipeline.path("wf_mu.trees")
+
+    sample_file = pipeline.path("samples.txt")
+    if os.path.exists(probands):
+        sample_probands(probands, config["samples"], sample_file, args.seed)
+    pipeline.stage(
+        "simulate",
+        ["simulate", genealogy, sim, "-p", sample_file, "-l",
+         str(config["length"]), "-r", str(config["recomb_rate"]), "-s", seed],
+        inputs=[genealogy, sample_file], outputs=[sim])
+    hybrid = []
+    if args.dtwf_generations is not None:
+        hybrid = ["--dtwf-generations", str(args.dtwf_generations)]
+    pipeline.stage(
+        "complete-wf",
+        ["complete-wf", sim, wf, "-N", str(args.population_size), "-s", seed,
+         *hybrid],
+        inputs=[sim], outputs=[wf])
+    if importlib.util.find_spec("stdpopsim") is None:
+        results.append(dict(config, stage="complete", status="skipped",
+                            reason="stdpopsim is not installed"))
+        print_result(results[-1])
+    else:
+        pipeline.stage("complete", ["complete", sim, ooa, "-s", seed, "-q"],
+                       inputs=[sim], outputs=[ooa])
+    pipeline.stage(
+        "mutate",
+        ["mutate", wf, mutated, "-u", str(args.mutation_rate), "-s", seed],
+        inputs=[wf], outputs=[mutated])
+    if shutil.which("bcftools") is not None:
+        output, convert_format = pipeline.path("wf_mu.bcf"), []
+    else:
+        output, convert_format = pipeline.path("wf_mu"), ["--plink"]
+    pipeline.stage(
+        "convert", ["convert", mutated, output, *convert_format],
+        inputs=[mutated],
+        format="plink" if convert_format else "bcf")
+
+
+def environment():
+    versions = {}
+    for package in ("numpy", "tskit", "msprime", "stdpopsim"):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(MSP_GEN), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        commit=commit,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        packages=versions,
+    )
+
+
+def compare(results, baseline, tolerance, min_time, min_rss):
+    """
+    Stages of `results` at least `tolerance` (relative) slower or larger
+    than the same stage and configuration of `baseline`. Differences below
+    `min_time` seconds or `min_rss` bytes are noise.
+    """
+    def key(result):
+        return tuple(result[k] for k in CONFIG_KEYS) + (result["stage"],)
+
+    previous = {key(r): r for r in baseline["results"] if r["status"] == "done"}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if result["status"] != "done" or before is None:
+            continue
+        for metric, floor in (("wall_time", min_time), ("cpu_time", min_time),
+                              ("peak_rss", min_rss)):
+            old, new = before[metric], result[metric]
+            if new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(dict(stage=result["stage"], metric=metric,
+                                        before=old, after=new,
+                                        **{k: result[k] for k in CONFIG_KEYS}))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.pipeline")
+    parser.add_argument("--founders", type=int, nargs="+", default=[100, 1000],
+                        help="Founders of the synthetic genealogies")
+    parser.add_argument("--generations", type=int, default=10)
+    parser.add_argument("--length", type=float, nargs="+", default=[1e5, 1e6])
+    parser.add_argument("--recomb-rate", type=float, nargs="+", default=[1e-8])
+    parser.add_argument("--samples", type=int, nargs="+", default=[0],
+                        help="Number of probands sampled; 0 for all")
+    parser.add_argument("--population-size", "-N", type=int, default=10_000)
+    parser.add_argument("--mutation-rate", type=float, default=1e-8)
+    parser.add_argument("--dtwf-generations", type=int, default=None,
+                        help="Hybrid continuation of the complete-wf stage")
+    parser.add_argument("--seed", "-s", type=int, default=1)
+    parser.add_argument("--output", "-o", default="pipeline_results.json")
+    parser.add_argument("--baseline", default=None,
+                        help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative increase flagged as a regression")
+    parser.add_argument("--min-time", type=float, default=0.1,
+                        help="Time differences below this (seconds) are noise")
+    parser.add_argument("--min-rss", type=float, default=16,
+                        help="Memory differences below this (MiB) are noise")
+    parser.add_argument("--work-dir", default=None,
+                        help="Keep the outputs of every stage here")
+    args = parser.parse_args()
+
+    results = []
+    print("\t".join(CONFIG_KEYS) + "\tstage\tstatus\twall_s\tcpu_s\tpeak_rss_mib")
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.work_dir or tmp
+        for founders in args.founders:
+            genealogy_dir = os.path.join(root, f"f{founders}")
+            os.makedirs(genealogy_dir, exist_ok=True)
+            genealogy, probands = run_genealogy(args, genealogy_dir, founders,
+                                                results)
+            for length, recomb_rate, samples in itertools.product(
+                    args.length, args.recomb_rate, args.samples):
+                config = dict(founders=founders, generations=args.generations,
+                              length=int(length), recomb_rate=recomb_rate,
+                              samples=samples)
+                work_dir = os.path.join(
+                    genealogy_dir, f"l{int(length)}_r{recomb_rate}_s{samples}")
+                os.makedirs(work_dir, exist_ok=True)
+                run_simulation(args, work_dir, config, genealogy, probands,
+                               results)
+
+    report = dict(environment=environment(), arguments=vars(args),
+                  results=results)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare(results, baseline, args.tolerance,
+                                        args.min_time, args.min_rss * 2**20)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}", file=sys.stderr)
+
+    for regression in report.get("regressions", []):
+        config = ", ".join(f"{k}={regression[k]}" for k in CONFIG_KEYS)
+        print(f"REGRESSION {regression['stage']} {regression['metric']}: "
+              f"{regression['before']:.3g} -> {regression['after']:.3g} "
+              f"({config})", file=sys.stderr)
+    failed = [r for r in results if r["status"] == "failed"]
+    if report.get("regressions") or failed:
+        sys.exit(1)
@@ -0,0 +1,75 @@
+"""
+Startup time of the `msp-gen` commands, against importing the dependencies
+every script used to import at the top, as the scripts did before.
+
+Every run is a fresh interpreter parsing `--help`, which is all the work a
+command does before reading its input. Dependencies that are not installed
+are left out of the eager imports.
+
+Run from the repository root:
+
+    python -m benchmarks.startup --repeat 10
+"""
+import importlib.util
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from timeit import default_timer as timer
+
+from msp_gen import COMMANDS
+
+# the heavy modules the scripts imported at the top before the commands were
+# made lazy
+EAGER_IMPORTS = {
+    "genealogy": ["tqdm"],
+    "simulate": ["msprime"],
+    "replicates": ["msprime"],
+    "complete": ["msprime", "stdpopsim"],
+    "complete-wf": ["msprime"],
+    "mutate": ["msprime"],
+    "convert": ["pandas"],
+    "plot-afs": ["matplotlib.pyplot"],
+}
+
+
+def installed(name):
+    return importlib.util.find_spec(name.split(".")[0]) is not None
+
+
+def time_run(code, repeat):
+    """
+    Median wall time of `repeat` fresh interpreters running `code`.
+    """
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(timer() - start)
+    return statistics.median(times)
+
+
+def command_code(command, eager=()):
+    imports = "".join(f"import {name}; " for name in eager)
+    return (f"{imports}import msp_gen; "
+            f"msp_gen.main([{command!r}, '--help'])")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("benchmarks.startup")
+    parser.add_argument("--repeat", "-n", type=int, default=5)
+    parser.add_argument("--commands", nargs="+", default=list(COMMANDS),
+                        choices=list(COMMANDS))
+    args = parser.parse_args()
+
+    print(f"interpreter\t{time_run('pass', args.repeat):.3f}")
+    print(f"msp-gen --help\t{time_run(command_code('--help'), args.repeat):.3f}")
+    print("command\teager_s\tlazy_s\tspeedup\tskipped")
+    for command in args.commands:
+        eager = [m for m in EAGER_IMPORTS.get(command, []) if installed(m)]
+        skipped = [m for m in EAGER_IMPORTS.get(command, []) if not installed(m)]
+        t_lazy = time_run(command_code(command), args.repeat)
+        t_eager = time_run(command_code(command, eager), args.repeat)
+        print(f"{command}\t{t_eager:.3f}\t{t_lazy:.3f}\t"
+              f"{t_eager / t_lazy:.1f}x\t{','.join(skipped)}")
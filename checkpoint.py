@@ -0,0 +1,142 @@
+"""
+Content-addressed checkpoints for long simulation pipelines.
+
+Every stage of a pipeline gets a key: a hash of the stage name, its
+parameters and its inputs, which are either files (hashed by content) or
+the keys of upstream stages. The result of the stage is written atomically
+to a file named after the key, so an interrupted run never leaves a partial
+checkpoint behind, and a rerun with the same inputs and parameters loads
+the result instead of recomputing it.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import tskit
+
+
+def status(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+
+def _update_with_file(digest, path, chunk_size=1 << 20):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+
+def content_digest(path):
+    """
+    SHA-256 of the content of a file, or of all the files in a directory
+    (such as a binary pedigree) in name order.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update(os.path.relpath(full, path).encode())
+                _update_with_file(digest, full)
+    else:
+        _update_with_file(digest, path)
+    return digest.hexdigest()
+
+
+def check_seed_argument(parser, args):
+    """
+    Exit with a usage error if `--checkpoint-dir` is given without `--seed`
+    (see `Checkpoints.check_seed`).
+    """
+    if args.checkpoint_dir is not None and args.seed is None:
+        parser.error("argument --checkpoint-dir: requires --seed, as the "
+                     "stages are only reproducible with a fixed seed")
+
+
+def save_ts(ts, path):
+    ts.dump(path)
+
+
+def load_ts(path):
+    return tskit.load(path)
+
+
+class Checkpoints:
+    """
+    A directory of checkpoints. With `directory=None` checkpointing is
+    disabled: stages always run, and no inputs are hashed.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def check_seed(self, seed):
+        """
+        Raise a ValueError if checkpointing is enabled without a root seed:
+        random stages are only reproducible with one, so their checkpoints
+        could neither be resumed nor safely reused.
+        """
+        if self.enabled and seed is None:
+            raise ValueError("Checkpoints need a fixed random seed")
+
+    def key(self, stage, files=(), keys=(), params=None):
+        """
+        The key of a stage, or None if checkpointing is disabled.
+        """
+        if not self.enabled:
+            return None
+        digest = hashlib.sha256()
+        digest.update(stage.encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        for path in files:
+            if path is not None:
+                digest.update(content_digest(path).encode())
+        for key in keys:
+            digest.update(str(key).encode())
+        return digest.hexdigest()
+
+    def path(self, stage, key, suffix=""):
+        return os.path.join(self.directory, f"{stage}-{key[:24]}{suffix}")
+
+    def commit(self, path, write):
+        """
+        Atomically create `path` (a file or a directory) with `write(tmp)`.
+        """
+        tmp = f"{path}.tmp{os.getpid()}"
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+
+    def run(self, stage, compute, save=save_ts, load=load_ts, files=(),
+            keys=(), params=None, suffix=".trees"):
+        """
+        Run a stage, or load its result if it has already been checkpointed.
+        `save(result, path)` and `load(path)` (by default, for a tree
+        sequence) write and read the checkpoint. Returns the result and the
+        key of the stage.
+        """
+        key = self.key(stage, files=files, keys=keys, params=params)
+        if key is None:
+            return compute(), None
+
+        path = self.path(stage, key, suffix)
+        if os.path.exists(path):
+            status(f"Reusing checkpoint {path} for stage {stage}...")
+            return load(path), key
+
+        result = compute()
+        self.commit(path, lambda tmp: save(result, tmp))
+        return result, key
@@ -1,77 +1,276 @@
-import msprime
-import tskit
+"""
+Complete incomplete tree sequences with a stdpopsim demographic model.
+
+Any number of input tree sequences (e.g. chromosomes or replicates) can be
+completed with any number of models in one run. Every continuation is a
+task of a process pool; each worker builds every model once, and every
+task gets its own seed derived from `--seed`.
+
+stdpopsim and msprime are imported when the command runs rather than with
+the module, so that `--help` is quick.
+"""
+import functools
+import multiprocessing
+import os
 from argparse import ArgumentParser
 import json
-import stdpopsim
+
 import numpy as np
 
+import instrument
+import storage
+from checkpoint import Checkpoints, check_seed_argument
+from simulate import derive_seeds, status
+
+
+# per-process state of pool workers, set up once by init_worker
+worker = {}
+
+
+@functools.lru_cache(maxsize=1)
+def get_species():
+    import stdpopsim
+
+    return stdpopsim.get_species('HomSap')
+
+
+def init_worker(models):
+    """
+    Pool initializer: build the demographic models once per worker process.
+    """
+    worker["models"] = {
+        model_id: get_species().get_demographic_model(model_id)
+        for model_id in models
+    }
+
+
+@functools.lru_cache(maxsize=2)
+def prepare_input(input_ts, model_id, population):
+    """
+    Load an incomplete tree sequence, with the populations of the model and
+    all its nodes in `population`. Returns it with the recombination rate of
+    its simulation.
+    """
+    model = worker["models"][model_id]
+    ts = storage.load(input_ts)
+
+    # read the recombination map from the provenance
+    provenance = json.loads(str(ts.provenance(0).record))
+    ts_recomb_rate = provenance["parameters"]["recombination_rate"]
+
+    tables = ts.dump_tables()
+    # Add extra populations
+    for _ in range(model.num_populations - 1):
+        tables.populations.add_row()
+
+    pop_ids = [pop.id for pop in model.populations]
+    our_id = pop_ids.index(population)
+
+    # change the population of all the nodes, e.g. to CEU
+    tables.nodes.population = np.full(
+        tables.nodes.num_rows, our_id, dtype=np.int32
+    )
+    return tables.tree_sequence(), ts_recomb_rate
+
+
+def complete(input_ts, model_id, population, seed=None):
+    """
+    Complete one tree sequence with a Hudson continuation under the model.
+    """
+    import msprime
+
+    model = worker["models"][model_id]
+    ts, ts_recomb_rate = prepare_input(input_ts, model_id, population)
+    sim = msprime.simulate(
+        from_ts=ts,
+        model="hudson",
+        population_configurations=model.population_configurations,
+        demographic_events=model.demographic_events,
+        migration_matrix=model.migration_matrix,
+        recombination_rate=ts_recomb_rate,
+        random_seed=seed,
+        num_replicates=1
+    )
+    return next(sim)
+
+
+def _complete_task(task):
+    (input_ts, model_id, population, seed, output_ts, checkpoint_dir, key,
+     compact) = task
+    checkpoints = Checkpoints(checkpoint_dir)
+    # pool workers inherit the session of the main process, but the spans
+    # they record never reach it: the span of the continuation is saved in
+    # the provenance of its output only, and returned to the main process
+    with instrument.measure(f"complete {model_id} {population}") as span:
+        ts, _ = checkpoints.run(
+            "complete_demography",
+            lambda: complete(input_ts, model_id, population, seed),
+            files=[input_ts],
+            params=dict(model=model_id, population=population, **key),
+        )
+        if compact:
+            ts = storage.compact(ts)
+        span.count_tree_sequence(ts)
+    ts = instrument.add_provenance(ts, spans=[span])
+    storage.dump(ts, output_ts)
+    return output_ts, span
+
+
+def output_path(output, input_ts, model_id, population, replicate, batch):
+    """
+    The output file of a task: `output` itself for a single continuation,
+    otherwise a file named after the input, model, population and replicate
+    in the directory `output`, compressed if the input is named `*.gz`.
+    """
+    if not batch:
+        return output
+    stem, suffix = os.path.basename(input_ts), ".trees"
+    if stem.endswith(storage.COMPRESSED_SUFFIX):
+        stem = stem[:-len(storage.COMPRESSED_SUFFIX)]
+        suffix += storage.COMPRESSED_SUFFIX
+    stem = os.path.splitext(stem)[0]
+    return os.path.join(output,
+                        f"{stem}_{model_id}_{population}_{replicate}{suffix}")
+
+
+def complete_batch(inputs, output, models, replicates=1, seed=None,
+                   processes=None, checkpoint_dir=None, compact=False):
+    """
+    Complete every input with every `(model_id, population)` of `models`,
+    `replicates` times, and `storage.compact` the outputs if `compact`.
+    Returns the output files.
+    """
+    Checkpoints(checkpoint_dir).check_seed(seed)
+    batch = len(inputs) * len(models) * replicates > 1
+    if batch:
+        os.makedirs(output, exist_ok=True)
+    tasks = [
+        (input_ts, model_id, population, replicate)
+        for input_ts in inputs
+        for model_id, population in models
+        for replicate in range(replicates)
+    ]
+    tasks = [
+        (
+            input_ts,
+            model_id,
+            population,
+            task_seed,
+            output_path(output, input_ts, model_id, population, replicate, batch),
+            checkpoint_dir,
+            dict(seed=seed, replicate=replicate),
+            compact,
+        )
+        for (input_ts, model_id, population, replicate), task_seed in zip(
+            tasks, derive_seeds(seed, len(tasks))
+        )
+    ]
+
+    if not tasks:
+        return []
+
+    model_set = sorted({model_id for model_id, _ in models})
+    processes = min(processes or os.cpu_count(), len(tasks))
+    if processes <= 1:
+        init_worker(model_set)
+        results = [_complete_task(task) for task in tasks]
+    else:
+        status(f"Running {len(tasks)} continuations on {processes} "
+               f"processes...")
+        with multiprocessing.Pool(
+            processes, initializer=init_worker, initargs=(model_set,)
+        ) as pool:
+            # tasks of the same input are sent together, so that workers
+            # can reuse the prepared input
+            results = pool.map(_complete_task, tasks, chunksize=replicates)
+    outputs, spans = zip(*results)
+    instrument.record(spans)
+    return list(outputs)
+
+
+def get_parser():
+    parser = ArgumentParser("complete_simulation_demography")
+
+    parser.add_argument("input_ts", nargs="+",
+                        help="input incomplete tree sequence(s)")
+    parser.add_argument(
+        "output_ts",
+        help="output tree sequence file, or output directory when there are "
+             "several inputs, models or replicates")
+    parser.add_argument(
+        "-m", "--model", help="Contiuation model(s), any HomSap model of "
+        "stdpopsim", nargs="+", default=["OutOfAfrica_2T12"]
+    )
+    parser.add_argument("-p", "--population", default=['EUR'], nargs="+",
+                        help="source population, one for all the models or "
+                             "one per model")
+    parser.add_argument("-n", "--replicates", default=1, type=int,
+                        help="Number of completed replicates of each input")
+    parser.add_argument("-s", "--seed", default=None, type=int,
+                        help="Root seed")
+    parser.add_argument("-j", "--processes", default=None, type=int,
+                        help="Number of worker processes (default: all cores)")
+    parser.add_argument("-q", "--no-citations", action="store_true")
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="Skip the continuations already checkpointed "
+                             "here")
+    parser.add_argument("--compact", action="store_true",
+                        help="Simplify the outputs to their samples and their "
+                             "lineages, with struct-encoded metadata (see "
+                             "storage.py)")
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    parser = get_parser()
+    check_seed_argument(parser, args)
+    if args.replicates < 1:
+        parser.error("argument -n/--replicates: must be at least 1")
+    hom_sap = get_species()
+    model_ids = [model.id for model in hom_sap.demographic_models]
+    for model_id in args.model:
+        if model_id not in model_ids:
+            parser.exit(1, f"{parser.prog}: error: argument -m/--model: "
+                           f"invalid choice: {model_id} (choose from "
+                           f"{model_ids})\n")
+
+    populations = args.population
+    if len(populations) == 1:
+        populations = populations * len(args.model)
+    if len(populations) != len(args.model):
+        parser.exit(1, f"{parser.prog}: error: give one population, or one "
+                       f"per model\n")
+
+    for model_id, population in zip(args.model, populations):
+        model = hom_sap.get_demographic_model(model_id)
+        pop_ids = [pop.id for pop in model.populations]
+        if population not in pop_ids:
+            message = f'''{parser.prog}: error: argument -p/--population: invalid choice: {population} (choose from {pop_ids})\n'''
+            parser.exit(1, message)
+
+    instrument.start("complete", args)
+    with instrument.span("complete_batch") as span:
+        outputs = complete_batch(
+            args.input_ts,
+            args.output_ts,
+            list(zip(args.model, populations)),
+            replicates=args.replicates,
+            seed=args.seed,
+            processes=args.processes,
+            checkpoint_dir=args.checkpoint_dir,
+            compact=args.compact,
+        )
+        span.count(continuations=len(outputs))
+    instrument.finish(args.output_ts)
+
+    if not args.no_citations:
+        for model_id in dict.fromkeys(args.model):
+            model = hom_sap.get_demographic_model(model_id)
+            print(model.description)
+            for citation in model.citations:
+                print(citation.author, citation.year, citation.doi)
+
 
-hom_sap = stdpopsim.get_species('HomSap')
-model_ids = [model.id for model in hom_sap.demographic_models]
-
-parser = ArgumentParser("complete_simulation_demography")
-
-parser.add_argument("input_ts", help="input incomplete tree sequence")
-parser.add_argument("output_ts", help="output tree sequence file")
-parser.add_argument(
-    "-m", "--model", help="Contiuation model",
-    default="OutOfAfrica_2T12", choices=model_ids
-)
-parser.add_argument("-p", "--population", default='EUR',
-                    help="source population")
-parser.add_argument("-q", "--no-citations", action="store_true")
-
-args = parser.parse_args()
-ts = tskit.load(args.input_ts)
-
-model = hom_sap.get_demographic_model(args.model)
-pop_ids = [pop.id for pop in model.populations]
-if args.population not in pop_ids:
-    message = f'''{parser.prog}: error: argument -p/--population: invalid choice: {args.population} (choose from {pop_ids})\n'''
-    parser.exit(1, message)
-
-# read the recombination map from the provenance
-provenance = json.loads(str(ts.provenance(0).record))
-ts_recomb_rate = provenance["parameters"]["recombination_rate"]
-
-tables = ts.dump_tables()
-# Add extra populations
-for _ in range(model.num_populations - 1):
-    tables.populations.add_row()
-
-pop_ids = [pop.id for pop in model.populations]
-our_id = pop_ids.index(args.population)
-
-# change the population - set all to CEU
-nodes = tables.nodes
-nodes.set_columns(
-    time=nodes.time,
-    flags=nodes.flags,
-    individual=nodes.individual,
-    population=np.repeat(our_id, len(nodes)).astype(np.int32),
-    metadata=nodes.metadata,
-    metadata_offset=nodes.metadata_offset,
-    # metadata_schema=nodes.metadata_schema,
-    # Does this mean that the metadata gets drpped here?
-    # Though we are not really using it
-)
-
-ts = tables.tree_sequence()
-
-sim = msprime.simulate(
-    from_ts=ts,
-    model="hudson",
-    population_configurations=model.population_configurations,
-    demographic_events=model.demographic_events,
-    migration_matrix=model.migration_matrix,
-    recombination_rate=ts_recomb_rate,
-    # TODO Make the replicate interface consistent across scripts
-    num_replicates=1
-)
-
-if not args.no_citations:
-    print(model.description)
-    for citation in model.citations:
-        print(citation.author, citation.year, citation.doi)
-
-next(sim).dump(args.output_ts)
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,34 +1,103 @@
-import msprime
-import tskit
 from argparse import ArgumentParser
 import json
 
+import instrument
+import storage
+from checkpoint import Checkpoints, check_seed_argument
 
-parser = ArgumentParser("sim_complete")
 
-parser.add_argument("input_ts", help="input incomplete tree sequence")
-parser.add_argument("output_ts", help="output tree sequence file")
-parser.add_argument(
-    "-N",
-    "--population-size",
-    help="Effective population size, for Wright-Fisher",
-    type=int,
-    default=1_000,
-)
+def get_parser():
+    parser = ArgumentParser("sim_complete")
 
-args = parser.parse_args()
-ts = tskit.load(args.input_ts)
+    parser.add_argument("input_ts", help="input incomplete tree sequence")
+    parser.add_argument("output_ts", help="output tree sequence file")
+    parser.add_argument(
+        "-N",
+        "--population-size",
+        help="Effective population size, for Wright-Fisher",
+        type=int,
+        default=1_000,
+    )
+    parser.add_argument(
+        "--dtwf-generations",
+        type=int,
+        default=None,
+        help="Switch from Wright-Fisher to the Hudson coalescent this many "
+        "generations above the input (default: Wright-Fisher until the end)",
+    )
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Random seed")
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="Skip the continuation if it was already checkpointed here",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Simplify the output to its samples and their lineages, with "
+        "struct-encoded metadata (see storage.py); name it *.gz to also "
+        "compress it",
+    )
+    instrument.add_arguments(parser)
+    return parser
 
-# read the recombination map from the provenance
-provenance = json.loads(str(ts.provenance(0).record))
-ts_recomb_rate = provenance["parameters"]["recombination_rate"]
 
+def complete(input_ts, population_size, dtwf_generations=None, seed=None):
+    """
+    Complete a tree sequence with the discrete-time Wright-Fisher model. With
+    `dtwf_generations`, only the generations up to that many above the
+    oldest root of the input are Wright-Fisher, and the Hudson coalescent
+    takes over from there, which is much faster for the last few lineages.
+    """
+    import msprime
 
-sim = msprime.simulate(
-    from_ts=ts,
-    model="dtwf",
-    Ne=args.population_size,
-    recombination_rate=ts_recomb_rate,
-    num_replicates=1)
+    ts = storage.load(input_ts)
 
-next(sim).dump(args.output_ts)
+    # read the recombination map from the provenance
+    provenance = json.loads(str(ts.provenance(0).record))
+    ts_recomb_rate = provenance["parameters"]["recombination_rate"]
+
+    model_changes = []
+    if dtwf_generations is not None:
+        model_changes.append(msprime.SimulationModelChange(
+            time=ts.max_root_time + dtwf_generations, model="hudson"))
+
+    sim = msprime.simulate(
+        from_ts=ts,
+        model="dtwf",
+        Ne=population_size,
+        recombination_rate=ts_recomb_rate,
+        demographic_events=model_changes,
+        random_seed=seed,
+        num_replicates=1)
+
+    return next(sim)
+
+
+def main(args):
+    check_seed_argument(get_parser(), args)
+    instrument.start("complete-wf", args)
+    checkpoints = Checkpoints(args.checkpoint_dir)
+    with instrument.span("complete") as span:
+        ts, _ = checkpoints.run(
+            "complete_wf",
+            lambda: complete(args.input_ts, args.population_size,
+                             dtwf_generations=args.dtwf_generations,
+                             seed=args.seed),
+            files=[args.input_ts],
+            params=dict(population_size=args.population_size,
+                        dtwf_generations=args.dtwf_generations, seed=args.seed))
+        span.count_tree_sequence(ts)
+    if args.compact:
+        with instrument.span("compact") as span:
+            ts = storage.compact(ts)
+            span.count_tree_sequence(ts)
+    ts = instrument.add_provenance(ts)
+    with instrument.span("write"):
+        storage.dump(ts, args.output_ts)
+    instrument.finish(args.output_ts)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -1,12 +1,17 @@
 import os
 import argparse
+import multiprocessing
 import subprocess
 import numpy as np
-import pandas as pd
 import tempfile
 
 import tskit
 
+import genotypes
+import instrument
+import storage
+from metadata import decode_individual_metadata
+
 
 class Runner:
     def __init__(self, args):
@@ -25,6 +30,173 @@ class Runner:
             subprocess.run(cmd, shell=True, check=True)
 
 
+def derived_allele_counts(ts, sample_nodes=None):
+    """
+    Number of sample nodes carrying a non-ancestral allele at every site,
+    computed for all the sites in a single pass over the trees.
+    """
+    if sample_nodes is None:
+        sample_nodes = ts.samples()
+    if ts.num_sites == 0:
+        # windows="sites" gives one window even without sites
+        return np.zeros(0, dtype=np.int64)
+    counts = ts.sample_count_stat(
+        [sample_nodes],
+        lambda x: x,
+        1,
+        windows="sites",
+        mode="site",
+        span_normalise=False,
+        polarised=True,
+        strict=False,
+    )
+    return np.round(counts[:, 0]).astype(np.int64)
+
+
+def site_filter_mask(
+    ts, min_af=0, max_af=1, remove_singletons=False, folded=False
+):
+    """
+    Boolean mask of the sites to keep: sites with an in-sample allele
+    frequency in [min_af, max_af], and, with `remove_singletons`, that are
+    not singletons. With `folded`, the frequency is that of the minor
+    allele, otherwise that of the derived allele.
+    """
+    sample_nodes = ts.samples()
+    counts = derived_allele_counts(ts, sample_nodes)
+    if folded:
+        counts = np.minimum(counts, len(sample_nodes) - counts)
+    freq = counts / len(sample_nodes)
+
+    keep = (freq >= min_af) & (freq <= max_af)
+    if remove_singletons:
+        keep &= counts != 1
+    return keep
+
+
+def output_format(use_vcf=False, bgzip=False):
+    """
+    The `bcftools -O` output type: uncompressed VCF, bgzipped VCF or BCF.
+    """
+    if use_vcf:
+        return "v"
+    return "z" if bgzip else "b"
+
+
+def index_option(index, out_format):
+    """
+    The `bcftools --write-index` option for a `csi` or `tbi` index, or an
+    empty list without an index.
+    """
+    if index is None:
+        return []
+    if out_format not in ("b", "z") or (index == "tbi" and out_format != "z"):
+        raise ValueError(
+            f"A {index} index needs {'bgzipped VCF' if index == 'tbi' else 'compressed'} output"
+        )
+    return [f"--write-index={index}"]
+
+
+def write_vcf_stream(ts, out_file, nodes, individual_names, out_format="b",
+                     index=None, chunk_size=genotypes.CHUNK_SIZE,
+                     **vcf_kwargs):
+    """
+    Write the VCF of the diploid individuals with haplotype `nodes` through
+    `bcftools view`, which encodes it to `out_file` (and indexes it) in the
+    same pass. The VCF text is formatted in chunks of sites, on
+    `processes` processes with the `processes` of `vcf_kwargs`, which are
+    passed on to `genotypes.write_vcf`.
+    """
+    read_fd, write_fd = os.pipe()
+    write_pipe = os.fdopen(write_fd, "wb")
+    cmd = ["bcftools", "view", "-O", out_format, "-o", out_file]
+    proc = subprocess.Popen(cmd + index_option(index, out_format), stdin=read_fd)
+    os.close(read_fd)
+    try:
+        genotypes.write_vcf(
+            write_pipe,
+            ts,
+            nodes,
+            individual_names,
+            chunk_size=chunk_size,
+            **vcf_kwargs,
+        )
+    finally:
+        write_pipe.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError("bcftools failed with status:", proc.returncode)
+
+
+def load_samples(
+    ts_file,
+    af_cutoff=0,
+    keep_sample=None,
+    remove_singletons=False,
+    max_af=1,
+    folded=False,
+):
+    """
+    Load a tree sequence without the sites removed by the allele frequency
+    filters. Returns it with the haplotype nodes (two consecutive nodes per
+    individual) and the names of the diploid sample individuals to output,
+    only keeping those in the array of names `keep_sample` if it is given.
+    """
+    ts = storage.load(ts_file)
+
+    # remove sites based on allele frequency cutoff
+    if (af_cutoff != 0) or (max_af != 1) or remove_singletons:
+        keep = site_filter_mask(
+            ts,
+            min_af=af_cutoff,
+            max_af=max_af,
+            remove_singletons=remove_singletons,
+            folded=folded,
+        )
+
+        # bulk-remove sites
+        tables = ts.dump_tables()
+        tables.delete_sites(np.flatnonzero(~keep), record_provenance=False)
+        ts = tables.tree_sequence()
+
+    sample_nodes = ts.samples()
+    if ts.num_individuals == 0:
+        # pair up consecutive sample nodes, as `tskit vcf --ploidy 2` does
+        if len(sample_nodes) % 2 != 0:
+            raise ValueError("The number of samples must be even")
+        names = [f"tsk_{j}" for j in range(len(sample_nodes) // 2)]
+        return ts, sample_nodes, names
+
+    # diploid individuals whose two nodes are both samples
+    node_individual = ts.tables.nodes.individual
+    in_individual = node_individual != tskit.NULL
+    is_sample = (ts.tables.nodes.flags & tskit.NODE_IS_SAMPLE) != 0
+    num_nodes = np.bincount(
+        node_individual[in_individual], minlength=ts.num_individuals
+    )
+    num_sample_nodes = np.bincount(
+        node_individual[in_individual & is_sample], minlength=ts.num_individuals
+    )
+    selected = (num_nodes == 2) & (num_sample_nodes == 2)
+
+    names, _ = decode_individual_metadata(ts.tables.individuals)
+    if keep_sample is not None:
+        # sorted-array join with the IDs of the keep file
+        keep_sample = np.unique(keep_sample)
+        index = np.searchsorted(keep_sample, names)
+        found = index < len(keep_sample)
+        found[found] = keep_sample[index[found]] == names[found]
+        selected &= found
+
+    # the nodes of the selected individuals, grouped by individual in
+    # individual and then node ID order
+    order = np.argsort(node_individual, kind="stable")
+    order = order[in_individual[order]]
+    nodes = order[selected[node_individual[order]]].astype(np.int32)
+    sample_names = [str(name) for name in names[selected]]
+    return ts, nodes, sample_names
+
+
 def ts_to_bcf_single(
     ts_file,
     out_file,
@@ -33,109 +205,138 @@ def ts_to_bcf_single(
     keep_sample=None,
     remove_singletons=False,
     use_vcf=False,
+    max_af=1,
+    folded=False,
+    contig_id="1",
+    contig_length=None,
+    position_offset=0,
+    out_format=None,
+    index=None,
+    chunk_size=genotypes.CHUNK_SIZE,
+    chunk_processes=1,
 ):
-
-    ts = tskit.load(ts_file)
-    if ts.num_individuals == 0:
-        bcf_cmd = "tskit vcf --ploidy 2 {} | bcftools view -O b > {}".format(
-            ts_file, out_file
-        )
-        runner.run(bcf_cmd)
-    else:
-        # remove sites based on allele frequency cutoff
-        sample_nodes = ts.samples()
-
-        if (af_cutoff != 0) or remove_singletons:
-            sites_to_delete = []
-            for tree in ts.trees():
-                for mutation in tree.mutations():
-                    # should this be count-1 since the node itself is included?
-                    count = tree.num_samples(mutation.node)
-                    # note that this is non-polarized frequency ( > 50% possible)
-                    if (count / len(sample_nodes)) < af_cutoff:
-                        sites_to_delete.append(mutation.site)
-                    if remove_singletons and count == 1:
-                        sites_to_delete.append(mutation.site)
-
-            # bulk-remove sites
-            tables = ts.dump_tables()
-            tables.delete_sites(sites_to_delete, record_provenance=False)
-            ts = tables.tree_sequence()
-
-        # Obtain a list of the individuals and their nodes:
-        node_table = []
-        individual_table = []
-
-        for ind in ts.individuals():
-            if len(ind.nodes) == 2:
-                node_table.extend([{'Node': ind.nodes[i], 'Individual': ind.id} for i in range(2)])
-                individual_table.append({'Individual': ind.id, 'IndividualName': ind.metadata["individual_name"]})
-
-        # Construct a dataframe of the nodes:
-        node_df = pd.DataFrame(node_table)
-        # Construct a dataframe of individuals:
-        individual_df = pd.DataFrame(individual_table)
-
-        # Merge with the sampled nodes list:
-        merged_df = node_df.merge(pd.DataFrame({'Node': sample_nodes}))
-        
-        # Count how many times an individual ID occurs in the merged table:
-        ind_counts = merged_df['Individual'].value_counts()
-
-        # Keep only individuals that occur twice (i.e. are diploid):
-        sample_individuals = list(ind_counts[ind_counts == 2].index)
-
-        final_list = individual_df.merge(pd.DataFrame({'Individual': sample_individuals}))
-        final_list['IndividualName'] = final_list['IndividualName'].astype(str)
-
-        if keep_sample is not None:
-            final_list = final_list.merge(keep_sample)
-        
-        sample_names = list(final_list['IndividualName'].values)
-        sample_ids = list(final_list['Individual'].values)
-
-        read_fd, write_fd = os.pipe()
-        write_pipe = os.fdopen(write_fd, "w")
-        with open(out_file, "w") as f:
-            output_format = "v" if use_vcf else "b"
-            proc = subprocess.Popen(
-                ["bcftools", "view", "-O", output_format], stdin=read_fd, stdout=f
+    """
+    Convert a tree sequence into a BCF/VCF file of contig `contig_id`, with
+    positions shifted by `position_offset`, in a single pass. `out_format`
+    overrides the `bcftools -O` type chosen by `use_vcf`.
+    """
+    if out_format is None:
+        out_format = output_format(use_vcf)
+    if runner.verbose:
+        print(
+            "Writing contig {} of {} to {} (bcftools view -O {})".format(
+                contig_id, ts_file, out_file, out_format
             )
-            ts.write_vcf(
-                write_pipe, individuals=sample_ids, individual_names=sample_names
-            )
-            write_pipe.close()
-            os.close(read_fd)
-            proc.wait()
-            if proc.returncode != 0:
-                raise RuntimeError("bcftools failed with status:", proc.returncode)
+        )
+    if runner.test:
+        return
+
+    with instrument.span("load") as span:
+        ts, nodes, names = load_samples(
+            ts_file,
+            af_cutoff=af_cutoff,
+            keep_sample=keep_sample,
+            remove_singletons=remove_singletons,
+            max_af=max_af,
+            folded=folded,
+        )
+        span.count(sites=ts.num_sites, samples=len(names))
+    # bcftools encodes the VCF text as it is written, so this is the time of
+    # both
+    with instrument.span("write_vcf", sites=ts.num_sites):
+        write_vcf_stream(
+            ts,
+            out_file,
+            nodes,
+            names,
+            out_format=out_format,
+            index=index,
+            chunk_size=chunk_size,
+            processes=chunk_processes,
+            contig_id=str(contig_id),
+            contig_length=contig_length,
+            position_offset=position_offset,
+        )
 
 
-def bcf_convert_chrom(bcf_file, chrom_num, runner, use_vcf):
-    with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
-        f.write("1\t" + str(chrom_num) + "\n")
-        output_format = "v" if use_vcf else "b"
-        convert_chrom_cmd = (
-            "bcftools annotate --rename-chrs {} {} | "
-            "bcftools view -O {} > tmp && mv tmp {} && "
-            "rm {}"
-        ).format(f.name, bcf_file, output_format, bcf_file, f.name)
-        runner.run(convert_chrom_cmd)
+def convert_chrom(job):
+    """
+    Convert the tree sequence of one chromosome into its own BCF file.
+    """
+    ts_file, bcf_file, runner, options = job
+    # the spans recorded in a pool worker never reach the main process, so
+    # the span of the chromosome is returned for it to record
+    with instrument.measure("chromosome",
+                            contig=options["contig_id"]) as span:
+        ts_to_bcf_single(ts_file, bcf_file, runner, **options)
+    return bcf_file, span
 
 
-def concat_bcf(bcf_files, out_file, runner, use_vcf):
-    output_format = "v" if use_vcf else "b"
-    concat_chrom_cmd = "bcftools concat -o {} -O {} --threads 2"
+def concat_bcf(bcf_files, out_file, runner, out_format, index=None):
+    concat_chrom_cmd = "bcftools concat -o {} -O {} --threads 2 {}".format(
+        out_file, out_format, " ".join(index_option(index, out_format))
+    )
 
     for f in bcf_files:
         concat_chrom_cmd += " " + f
 
-    concat_chrom_cmd = concat_chrom_cmd.format(out_file, output_format)
-
     runner.run(concat_chrom_cmd)
 
 
-def main(args):
+def write_genotypes(args, out_file, runner, contig_ids, options):
+    """
+    Write the chromosomes, one after the other, as a PLINK 1 file set with
+    the prefix `out_file`, or as columnar stores in the directory `out_file`.
+    """
+    position_offset = options.pop("position_offset")
+    chunk_size = options.pop("chunk_size")
+    chunk_processes = options.pop("chunk_processes")
+    if runner.verbose:
+        print("Writing {} to {}".format(" ".join(args.ts_file), out_file))
+    if runner.test:
+        return
+
+    def chromosomes():
+        for ts_file, contig_id in zip(args.ts_file, contig_ids):
+            with instrument.span("load") as span:
+                ts, nodes, names = load_samples(ts_file, **options)
+                span.count(sites=ts.num_sites, samples=len(names))
+            yield ts, nodes, names, contig_id
+
+    if args.columnar:
+        for ts, nodes, names, contig_id in chromosomes():
+            with instrument.span("write_columnar", sites=ts.num_sites):
+                genotypes.write_columnar(
+                    os.path.join(out_file, str(contig_id)),
+                    ts,
+                    nodes,
+                    names,
+                    position_offset=position_offset,
+                    chunk_size=chunk_size,
+                    processes=chunk_processes,
+                )
+        return
+
+    sources = (
+        (ts, nodes, names, contig_id, position_offset)
+        for ts, nodes, names, contig_id in chromosomes()
+    )
+    # the chromosomes are loaded as they are written, so this span includes
+    # the "load" spans
+    with instrument.span("write_plink") as span:
+        skipped = genotypes.write_plink(
+            out_file, sources, chunk_size=chunk_size,
+            processes=chunk_processes,
+        )
+        span.count(skipped=skipped)
+    if skipped > 0:
+        print("Skipped {} sites that are not biallelic".format(skipped))
+
+
+def convert(args):
+    """
+    Convert the tree sequences of the command line arguments `args`.
+    """
     out_file = os.path.expanduser(args.out_file)
     runner = Runner(args)
 
@@ -143,34 +344,89 @@ def main(args):
         keep = None
     else:
         try:
-            keep = pd.read_csv(args.keep_file, header=None, names=['IndividualName'])
-            keep['IndividualName'] = keep['IndividualName'].astype(str)
+            keep = np.loadtxt(args.keep_file, dtype=np.int64, ndmin=1)
         except Exception as e:
             print("Failed to read the sample filter file!")
             raise e
 
-    tmp_bcf_files = []
+    num_chroms = len(args.ts_file)
+    contig_ids = args.contig_ids or [str(i + 1) for i in range(num_chroms)]
+    contig_lengths = args.contig_lengths or [None] * num_chroms
+    if len(contig_ids) != num_chroms or len(contig_lengths) != num_chroms:
+        raise ValueError("Give one contig ID and length for every tree sequence")
+    out_format = output_format(args.use_vcf, args.bgzip)
+    index_option(args.index, out_format)
+
+    options = dict(
+        af_cutoff=args.af_cutoff,
+        keep_sample=keep,
+        remove_singletons=args.remove_singletons,
+        max_af=args.max_af,
+        folded=args.folded,
+        position_offset=args.position_offset,
+        chunk_size=args.chunk_size,
+        chunk_processes=args.chunk_processes,
+    )
+
+    if args.plink or args.columnar:
+        write_genotypes(args, out_file, runner, contig_ids, options)
+        return
+
+    if num_chroms == 1:
+        # a single chromosome is written, and indexed, in one pass
+        ts_to_bcf_single(
+            args.ts_file[0],
+            out_file,
+            runner,
+            contig_id=contig_ids[0],
+            contig_length=contig_lengths[0],
+            out_format=out_format,
+            index=args.index,
+            **options,
+        )
+        return
+
     with tempfile.TemporaryDirectory() as tmpdirname:
+        jobs = []
         for i, tsf in enumerate(args.ts_file):
-            chrom_num = i + 1
             tmp_bcf_file = os.path.join(tmpdirname, ".tmp" + str(i) + ".bcf")
-            tmp_bcf_files.append(tmp_bcf_file)
-
-            ts_to_bcf_single(
-                tsf,
-                tmp_bcf_file,
-                runner,
-                af_cutoff=args.af_cutoff,
-                keep_sample=keep,
-                remove_singletons=args.remove_singletons,
-                use_vcf=args.use_vcf,
+            # the chromosomes are only compressed once, by the concatenation
+            job_options = dict(
+                options,
+                contig_id=contig_ids[i],
+                contig_length=contig_lengths[i],
+                out_format="u",
             )
-            bcf_convert_chrom(tmp_bcf_file, chrom_num, runner, args.use_vcf)
+            jobs.append((tsf, tmp_bcf_file, runner, job_options))
+
+        # chromosomes are converted in parallel; the concatenation starts
+        # once all of them are ready. Pool workers cannot start pools of
+        # their own, so with --chunk-processes the chromosomes are converted
+        # one after the other
+        processes = min(args.processes or os.cpu_count(), len(jobs))
+        if args.chunk_processes > 1:
+            processes = 1
+        with instrument.span("chromosomes", processes=processes):
+            if processes <= 1:
+                results = [convert_chrom(job) for job in jobs]
+            else:
+                with multiprocessing.Pool(processes) as pool:
+                    results = pool.map(convert_chrom, jobs, chunksize=1)
+            tmp_bcf_files, spans = zip(*results)
+            instrument.record(spans)
+
+        with instrument.span("concat"):
+            concat_bcf(tmp_bcf_files, out_file, runner, out_format, args.index)
 
-        concat_bcf(tmp_bcf_files, out_file, runner, args.use_vcf)
 
+def main(args):
+    instrument.start("convert", args)
+    with instrument.span("convert", contigs=len(args.ts_file)):
+        convert(args)
+    instrument.finish(os.path.expanduser(args.out_file))
 
-if __name__ == "__main__":
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("ts_file", nargs="*")
     parser.add_argument("out_file")
@@ -188,17 +444,95 @@ if __name__ == "__main__":
         default=0,
         help="Drop sites below this allele frequency cutoff. Default - 0",
     )
+    parser.add_argument(
+        "--max-af",
+        type=float,
+        default=1,
+        help="Drop sites above this allele frequency. Default - 1",
+    )
+    parser.add_argument(
+        "--folded",
+        action="store_true",
+        help="Apply the frequency cutoffs to the minor allele frequency "
+        "instead of the derived allele frequency",
+    )
     parser.add_argument(
         "-r",
         "--remove-singletons",
         action="store_true",
         help="Drop sites with a single mutation",
     )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of chromosomes converted in parallel. Default - all cores",
+    )
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-vcf", "--use-vcf", action="store_true")
+    parser.add_argument(
+        "-z",
+        "--bgzip",
+        action="store_true",
+        help="Write bgzipped VCF instead of BCF",
+    )
+    parser.add_argument(
+        "--index",
+        choices=["csi", "tbi"],
+        default=None,
+        help="Index the output while it is written (tbi needs --bgzip)",
+    )
+    parser.add_argument(
+        "--plink",
+        action="store_true",
+        help="Write a PLINK 1 .bed/.bim/.fam file set with the output prefix "
+        "instead of a BCF file (biallelic sites only)",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Write a directory of .npy genotype arrays per contig instead "
+        "of a BCF file",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=genotypes.CHUNK_SIZE,
+        help="Number of sites decoded at once. Default - %(default)s",
+    )
+    parser.add_argument(
+        "--chunk-processes",
+        type=int,
+        default=1,
+        help="Number of processes decoding and encoding the chunks of every "
+        "chromosome; chromosomes are then converted one at a time. "
+        "Default - 1",
+    )
+    parser.add_argument(
+        "--contig-ids",
+        nargs="+",
+        default=None,
+        help="Contig ID of every tree sequence. Default - 1, 2, ...",
+    )
+    parser.add_argument(
+        "--contig-lengths",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Contig length of every tree sequence. Default - the sequence length",
+    )
+    parser.add_argument(
+        "--position-offset",
+        type=int,
+        default=0,
+        help="Added to every site position. Default - 0",
+    )
 
     parser.add_argument("-T", "--test", action="store_true")
+    instrument.add_arguments(parser)
+    return parser
 
-    args = parser.parse_args()
 
-    main(args)
+if __name__ == "__main__":
+    main(get_parser().parse_args())
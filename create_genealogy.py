@@ -1,95 +1,114 @@
-from itertools import count
-from tqdm import tqdm
+from argparse import ArgumentParser
+from contextlib import ExitStack
 from numpy import random as rnd
 import numpy as np
 
+import instrument
+from pedigree import PedigreeWriter, TextPedigreeWriter
+
 # SEX: 1 = male, 2 = female
 # Individual = ("ID", "father", "mother", "time", "sex")
-
-
-def simulate_pedigree(n_founders, n_generations,
-                      avg_offspring=2,
-                      avg_immigrants=2,
-                      seed=None,
-                      no_progress=True):
-
+MALE, FEMALE = 1, 2
+COLUMNS = ("individual", "father", "mother", "time", "sex")
+
+
+def _new_block(n, first_id, time, rng, father=0, mother=0):
+    """
+    Allocate a (n, 5) int32 block of individuals with consecutive IDs
+    starting at `first_id`, all at `time`, and a random sex.
+    """
+    block = np.empty((n, len(COLUMNS)), dtype=np.int32)
+    block[:, 0] = np.arange(first_id, first_id + n, dtype=np.int32)
+    block[:, 1] = father
+    block[:, 2] = mother
+    block[:, 3] = time
+    block[:, 4] = np.where(rng.random(n) < 0.5, MALE, FEMALE)
+    return block
+
+
+def simulate_generations(n_founders, n_generations,
+                         avg_offspring=2,
+                         avg_immigrants=2,
+                         seed=None,
+                         no_progress=True):
+    """
+    Simulate the genealogy one generation at a time, from the founders to
+    the present.
+
+    Yields one (n, 5) int32 array per generation, with the columns listed in
+    `COLUMNS`. A generation is yielded once it is complete, i.e. after it
+    has been padded to an even sex ratio and paired into couples.
+    """
     rng = rnd.default_rng(seed)
-    current_males, current_females = set(), set()
-    next_males, next_females = set(), set()
-
-    ped = []
-    id_counter = count(1)
-
-    # assign sex to the founder generation
-    for _ in range(n_founders):
-        ind_id = next(id_counter)
-        male = rng.random() < 0.5
-        if male:
-            current_males.add(ind_id)
-            ped.append((ind_id, 0, 0, n_generations, 1))
-        else:
-            current_females.add(ind_id)
-            ped.append((ind_id, 0, 0, n_generations, 2))
-
-    for t in tqdm(range(n_generations-1, -1, -1), disable=no_progress):
-        # pad the arrays if we have uneven sex ratio
-        diff = len(current_males) - len(current_females)
-        if diff > 0:
-            for _ in range(diff):
-                ind_id = next(id_counter)
-                current_females.add(ind_id)
-                ped.append((ind_id, 0, 0, t+1, 2))
-        elif diff < 0:
-            for _ in range(-diff):
-                ind_id = next(id_counter)
-                current_males.add(ind_id)
-                ped.append((ind_id, 0, 0, t+1, 1))
+    next_id = 1
+
+    current = _new_block(n_founders, next_id, n_generations, rng)
+    next_id += n_founders
+
+    times = range(n_generations-1, -1, -1)
+    if not no_progress:
+        from tqdm import tqdm
+        times = tqdm(times)
+
+    for t in times:
+        # pad the generation if we have uneven sex ratio
+        is_male = current[:, 4] == MALE
+        diff = 2 * np.count_nonzero(is_male) - len(current)
+        if diff != 0:
+            padding = _new_block(abs(diff), next_id, t+1, rng)
+            padding[:, 4] = FEMALE if diff > 0 else MALE
+            next_id += abs(diff)
+            current = np.concatenate([current, padding])
+            is_male = current[:, 4] == MALE
 
         # Pick couples
-        while len(current_males) and len(current_females):
-            # I am assuming that set.pop() returns a random element
-            father = current_males.pop()
-            mother = current_females.pop()
-
-            n_children = rng.poisson(avg_offspring)
-
-            for ch in range(n_children):
-                child_id = next(id_counter)
-                child_male = rng.random() < 0.5
-                if child_male:
-                    next_males.add(child_id)
-                    ped.append((child_id, father, mother, t, 1))
-                else:
-                    next_females.add(child_id)
-                    ped.append((child_id, father, mother, t, 2))
+        fathers = rng.permutation(current[is_male, 0])
+        mothers = rng.permutation(current[~is_male, 0])
+        n_children = rng.poisson(avg_offspring, size=len(fathers))
+
+        yield current
+
+        n_total = int(n_children.sum())
+        children = _new_block(n_total, next_id, t, rng,
+                              father=np.repeat(fathers, n_children),
+                              mother=np.repeat(mothers, n_children))
+        next_id += n_total
 
         # add extra out-of-family individuals - but not in the present
         if t > 1:
-            n_immigrants = rnd.poisson(avg_immigrants)
-            for _ in range(n_immigrants):
-                ind_id = next(id_counter)
-                ind_male = rng.random() < 0.5
-                if ind_male:
-                    next_males.add(ind_id)
-                    ped.append((ind_id, 0, 0, t, 1))
-                else:
-                    next_females.add(ind_id)
-                    ped.append((ind_id, 0, 0, t, 2))
-
-        if not (next_males or next_females):
+            n_immigrants = rng.poisson(avg_immigrants)
+            immigrants = _new_block(n_immigrants, next_id, t, rng)
+            next_id += n_immigrants
+            children = np.concatenate([children, immigrants])
+
+        if len(children) == 0:
             raise(RuntimeError('Simulation terminated at time t=' + str(t) +
                                ', (' + str(n_generations-t) +
                                ' generations from founders)'))
-        current_males = next_males
-        current_females = next_females
-        next_males = set()
-        next_females = set()
+        current = children
 
-    return np.array(ped)
+    yield current
 
 
-if __name__ == "__main__":
-    from argparse import ArgumentParser
+def simulate_pedigree(n_founders, n_generations,
+                      avg_offspring=2,
+                      avg_immigrants=2,
+                      seed=None,
+                      no_progress=True):
+    """
+    Simulate a genealogy and return it as a single (n, 5) int32 array.
+
+    The same seed always produces the same pedigree.
+    """
+    generations = simulate_generations(n_founders, n_generations,
+                                       avg_offspring=avg_offspring,
+                                       avg_immigrants=avg_immigrants,
+                                       seed=seed,
+                                       no_progress=no_progress)
+    return np.concatenate(list(generations))
+
+
+def get_parser():
     parser = ArgumentParser("Simulate an extended family genealogy")
     parser.add_argument("founders", type=int,
                         help="Number of founder individuals")
@@ -104,13 +123,42 @@ if __name__ == "__main__":
     parser.add_argument("--no-progress", action="store_true")
     parser.add_argument(
         "--output", "-o", default="genealogy.tsv", help="Output file")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--binary-output", "-b", default=None,
+        help="Also write the genealogy in the binary pedigree format")
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    instrument.start("genealogy", args)
+    generations = simulate_generations(args.founders, args.generations,
+                                       avg_offspring=args.children,
+                                       avg_immigrants=args.immigrants,
+                                       seed=args.seed,
+                                       no_progress=args.no_progress)
+
+    # write every generation as soon as it is complete, so that only the
+    # current and the next generation are held in memory
+    with ExitStack() as stack:
+        writers = [stack.enter_context(TextPedigreeWriter(args.output,
+                                                          COLUMNS))]
+        if args.binary_output is not None:
+            writers.append(stack.enter_context(
+                PedigreeWriter(args.binary_output, COLUMNS)))
+
+        # simulating and writing are interleaved, so they share a span
+        with instrument.span("simulate") as span:
+            individuals = 0
+            for generation in generations:
+                for writer in writers:
+                    writer.write(generation)
+                individuals += len(generation)
+            span.count(individuals=individuals,
+                       generations=args.generations + 1)
+
+    instrument.finish(args.output)
 
-    ped = simulate_pedigree(args.founders, args.generations,
-                            avg_offspring=args.children,
-                            avg_immigrants=args.immigrants,
-                            seed=args.seed,
-                            no_progress=args.no_progress)
 
-    np.savetxt(args.output, ped, fmt="%d", delimiter="\t",
-               header="individual\tfather\tmother\ttime\tsex")
+if __name__ == "__main__":
+    main(get_parser().parse_args())
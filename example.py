@@ -1,44 +1,35 @@
-import msprime
-import tskit
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 
+from replicate_stats import summarize_counts
+from replicates import collect_replicates, run_replicates
+
 # An example script to simulate over a genealogy and count the number of
 # coalescent events
 
-ped = msprime.Pedigree.read_txt("data/balsac.tsv")
-rep = 100
-probands = ped.get_proband_indices()
-ped.set_samples(num_samples=len(probands))
-
-t = int(max(ped.time))
-    
-replicates = msprime.simulate(len(probands),
-                              pedigree=ped,
-                              length=1_000_000,
-                              recombination_rate=0,
-                              model='wf_ped',
-                              end_time=t,
-                              num_replicates=rep)
+if __name__ == "__main__":
+    rep = 100
 
-coal_times = []
-for ts in replicates:
-    tb = ts.dump_tables()
-    # filter out stop nodes and sample nodes
-    mask = ~((tb.nodes.individual == -1) | (tb.nodes.flags == tskit.NODE_IS_SAMPLE))
-    coal_times.extend(tb.nodes.time[mask])
+    # replicates run on all cores, and only send back their number of
+    # coalescences per generation, stored in a (replicates x generations)
+    # integer matrix
+    results = run_replicates("data/balsac.tsv", rep,
+                             reduction="coalescence",
+                             length=1_000_000,
+                             recomb_rate=0)
+    coal_counts = collect_replicates(results, rep, dtype=np.int32)
 
-counts, bins = np.histogram(coal_times, range(1, t+1))
-means = counts / rep
-stdev = np.sqrt((counts - means) / (rep - 1))
+    # mean and standard deviation across replicates of generations 1 to t
+    summary = summarize_counts(coal_counts[:, 1:])
+    generations = np.arange(1, coal_counts.shape[1])
 
-mpl.style.use('seaborn')
-fig, ax = plt.subplots()
-ax.bar(bins[:-1], means)
-ax.errorbar(bins[:-1], means, stdev, ls="", color="gray")
-# ax.set_ylim(0,7)
-ax.set(xlabel="Generation",
-       ylabel="Effective N times some arbitrary constant",
-       title=f"Simulating over publically available BALSAC data, n={rep}")
-fig.savefig("example.png", dpi=300)
+    mpl.style.use('seaborn')
+    fig, ax = plt.subplots()
+    ax.bar(generations, summary.mean)
+    ax.errorbar(generations, summary.mean, summary.stdev, ls="", color="gray")
+    # ax.set_ylim(0,7)
+    ax.set(xlabel="Generation",
+           ylabel="Effective N times some arbitrary constant",
+           title=f"Simulating over publically available BALSAC data, n={rep}")
+    fig.savefig("example.png", dpi=300)
@@ -1,38 +1,55 @@
 import sys
 import numpy as np
-import pandas as pd
 from argparse import ArgumentParser
 
+import instrument
+from pedigree import load_pedigree
+
 
 def status(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
 
 
-parser = ArgumentParser(
-    "fild-probands.py - filter all individuals with no children")
-parser.add_argument("genealogy", help="Genealogy file")
-parser.add_argument("output", help="Output file")
-parser.add_argument("--year", "-y", default=None,
-                    help="Remove individuals before this year")
-parser.add_argument("--delimiter", "-d", default=None,
-                    help="Delimiter for genealogy")
-
-args = parser.parse_args()
-
-status(f"Reading input genealogy {args.genealogy}...")
-ped = pd.read_table(args.genealogy, delimiter=args.delimiter)
-
-status("Finding probands...")
-everyone = set(ped.ind)
-fathers = set(ped.father)
-mothers = set(ped.mother)
-probands = everyone.difference(mothers.union(fathers))
-status(f"Found {len(probands)} probands...")
-
-if args.year is not None:
-    pass
-
-status(f"Writing output to {args.output}...")
-np.savetxt(args.output, np.array(list(probands)), fmt="%d")
-
-status("Done")
+def get_parser():
+    parser = ArgumentParser(
+        "fild-probands.py - filter all individuals with no children")
+    parser.add_argument("genealogy", help="Genealogy file")
+    parser.add_argument("output", help="Output file")
+    parser.add_argument("--year", "-y", default=None, type=float,
+                        help="Only keep probands whose time column is at "
+                             "least YEAR, i.e. born in or after YEAR with birth "
+                             "years in the time column")
+    parser.add_argument("--delimiter", "-d", default=None,
+                        help="Delimiter for genealogy")
+    parser.add_argument("--indices", "-i", action="store_true",
+                        help="Write row indices in the genealogy instead of "
+                             "IDs")
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    instrument.start("probands", args)
+    status(f"Reading input genealogy {args.genealogy}...")
+    with instrument.span("read") as span:
+        ped = load_pedigree(args.genealogy, delimiter=args.delimiter)
+        span.count(individuals=len(ped.individual))
+
+    status("Finding probands...")
+    with instrument.span("probands") as span:
+        proband_idx = ped.proband_indices(min_time=args.year)
+        span.count(probands=len(proband_idx))
+    status(f"Found {len(proband_idx)} probands...")
+
+    status(f"Writing output to {args.output}...")
+    with instrument.span("write"):
+        if args.indices:
+            np.savetxt(args.output, proband_idx, fmt="%d")
+        else:
+            np.savetxt(args.output, ped.individual[proband_idx], fmt="%d")
+
+    instrument.finish(args.output)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
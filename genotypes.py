@@ -0,0 +1,347 @@
+"""
+Chunked genotype writers for tree sequences.
+
+The genotypes are decoded in chunks of consecutive sites, one genotype
+matrix (sites x haplotypes) per chunk. With `processes`, the chunks are
+decoded and encoded by a pool of processes, each with its own copy of the
+tree sequence, as both hold the GIL; the encoded chunks are written in site
+order, with at most a few chunks per process in flight. The output is VCF
+text (the same bytes as `ts.write_vcf`), a PLINK 1 .bed/.bim/.fam file set,
+or a columnar store of .npy arrays, which need no text at all.
+"""
+import functools
+import multiprocessing
+import os
+from collections import deque
+
+import numpy as np
+import tskit
+
+CHUNK_SIZE = 1024
+
+# two bits per genotype: the PLINK 1 codes of 0, 1 and 2 copies of allele 1
+# (the ALT allele), and of missing genotypes
+BED_MAGIC = bytes([0x6C, 0x1B, 0x01])
+BED_CODES = np.array([0b11, 0b10, 0b00], dtype=np.uint8)
+BED_MISSING = 0b01
+
+# per-process state of pool workers, set up once by _init_worker
+worker = {}
+
+
+class GenotypeChunks:
+    """
+    The genotypes of the haplotype `nodes` (the nodes of every individual,
+    `ploidy` consecutive nodes each) at the sites of `ts`, in chunks of
+    `chunk_size` sites.
+    """
+
+    def __init__(self, ts, nodes, ploidy=2, position_offset=0,
+                 chunk_size=CHUNK_SIZE):
+        self.ts = ts
+        self.nodes = np.asarray(nodes, dtype=np.int32)
+        self.ploidy = ploidy
+        self.position_offset = position_offset
+        self.chunk_size = chunk_size
+        self.site_position = ts.tables.sites.position
+        self.positions = (
+            np.round(self.site_position).astype(np.int64) + position_offset
+        )
+
+    @property
+    def num_individuals(self):
+        return len(self.nodes) // self.ploidy
+
+    def contig_length(self):
+        """
+        The contig length `ts.write_vcf` writes in the VCF header.
+        """
+        length = int(np.round(self.ts.sequence_length)) + self.position_offset
+        if len(self.positions) > 0:
+            length = max(length, int(self.positions[-1]))
+        return length
+
+    def chunks(self):
+        """
+        The `(start, stop)` site ranges of the chunks.
+        """
+        num_sites = len(self.site_position)
+        starts = range(0, num_sites, self.chunk_size)
+        return [(start, min(start + self.chunk_size, num_sites)) for start in starts]
+
+    def decode(self, chunk):
+        """
+        The alleles and the genotype matrix of the sites in `chunk`.
+        """
+        start, stop = chunk
+        left = self.site_position[start]
+        right = (
+            self.site_position[stop]
+            if stop < len(self.site_position)
+            else self.ts.sequence_length
+        )
+        genotypes = None
+        alleles = []
+        variants = self.ts.variants(
+            samples=self.nodes, left=left, right=right, copy=False
+        )
+        for j, variant in enumerate(variants):
+            if genotypes is None:
+                genotypes = np.empty(
+                    (stop - start, len(self.nodes)), dtype=variant.genotypes.dtype
+                )
+            genotypes[j] = variant.genotypes
+            alleles.append(variant.alleles[: variant.num_alleles])
+        return alleles, genotypes
+
+
+def _init_worker(func, source):
+    worker.update(func=func, source=source)
+
+
+def _encode_chunk(chunk):
+    return worker["func"](worker["source"], chunk)
+
+
+def encode_chunks(func, source, processes=1, lookahead=4):
+    """
+    Yield `func(source, chunk)` for every chunk of `source`, in site order,
+    computed on a pool of `processes` processes with at most
+    `lookahead * processes` chunks ahead of the consumer. `func` must be
+    picklable, e.g. a module-level function or a partial of one.
+    """
+    if processes <= 1:
+        for chunk in source.chunks():
+            yield func(source, chunk)
+        return
+    with multiprocessing.Pool(
+        processes, initializer=_init_worker, initargs=(func, source)
+    ) as pool:
+        pending = deque()
+        for chunk in source.chunks():
+            pending.append(pool.apply_async(_encode_chunk, (chunk,)))
+            if len(pending) >= lookahead * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def vcf_header(contig_id, contig_length, individual_names):
+    """
+    The VCF header, as `ts.write_vcf` writes it.
+    """
+    lines = [
+        "##fileformat=VCFv4.2",
+        f"##source=tskit {tskit.__version__}",
+        '##FILTER=<ID=PASS,Description="All filters passed">',
+        f"##contig=<ID={contig_id},length={contig_length}>",
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        "\t".join(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+            + [str(name) for name in individual_names]
+        ),
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def format_vcf_chunk(contig_id, site_ids, positions, alleles, genotypes, ploidy=2):
+    """
+    The VCF records of a chunk of sites. All the genotype fields are
+    formatted at once, as one (sites x 2 * haplotypes) array of characters.
+    """
+    num_sites, num_haplotypes = genotypes.shape
+    if any(len(site_alleles) > 9 for site_alleles in alleles):
+        raise ValueError("More than 9 alleles are not supported in VCF output")
+
+    # every genotype and the separator after it are one little-endian
+    # 16-bit character pair, so the text is built in a single addition;
+    # missing genotypes (-1) come out as "/" and are moved down to "."
+    separators = np.full(num_haplotypes, ord("|"), dtype="<u2")
+    separators[ploidy - 1 :: ploidy] = ord("\t")
+    separators[-1] = ord("\n")
+    pairs = np.add(
+        genotypes, (separators << 8) + ord("0"), dtype="<u2", casting="unsafe"
+    )
+    missing = genotypes == -1
+    if missing.any():
+        pairs -= missing
+    text = pairs.view(np.uint8)
+
+    records = []
+    for j in range(num_sites):
+        site_alleles = alleles[j]
+        alt = ",".join(site_alleles[1:]) if len(site_alleles) > 1 else "."
+        records.append(
+            f"{contig_id}\t{positions[j]}\t{site_ids[j]}\t{site_alleles[0]}\t"
+            f"{alt}\t.\tPASS\t.\tGT\t".encode()
+        )
+        records.append(text[j].tobytes())
+    return b"".join(records)
+
+
+def pack_bed_chunk(alleles, genotypes, ploidy=2):
+    """
+    The PLINK 1 .bed records (2-bit packed, variant-major) of the biallelic
+    sites of a chunk, and the mask of those sites.
+    """
+    biallelic = np.array([len(site_alleles) == 2 for site_alleles in alleles],
+                         dtype=bool)
+    if not biallelic.all():
+        genotypes = genotypes[biallelic]
+    num_sites = genotypes.shape[0]
+    # reductions over the short ploidy axis are slow, so the haplotypes of
+    # every individual are combined slice by slice
+    dosage = genotypes[:, 0::ploidy].astype(np.intp)
+    lowest = genotypes[:, 0::ploidy].copy()
+    for k in range(1, ploidy):
+        dosage += genotypes[:, k::ploidy]
+        np.minimum(lowest, genotypes[:, k::ploidy], out=lowest)
+    missing = lowest < 0
+    codes = np.take(BED_CODES, dosage, mode="clip")
+    if missing.any():
+        codes[missing] = BED_MISSING
+
+    # four individuals per byte, the first in the lowest two bits
+    num_individuals = codes.shape[1]
+    padded = np.zeros((num_sites, -(-num_individuals // 4) * 4), dtype=np.uint8)
+    padded[:, :num_individuals] = codes
+    quads = padded.reshape(num_sites, -1, 4)
+    packed = quads[:, :, 0] | (quads[:, :, 1] << 2)
+    packed |= quads[:, :, 2] << 4
+    packed |= quads[:, :, 3] << 6
+    return packed.tobytes(), biallelic
+
+
+def _encode_vcf(contig_id, source, chunk):
+    alleles, genotypes = source.decode(chunk)
+    start, stop = chunk
+    return format_vcf_chunk(
+        contig_id,
+        range(start, stop),
+        source.positions[start:stop],
+        alleles,
+        genotypes,
+        source.ploidy,
+    )
+
+
+def write_vcf(output, ts, nodes, individual_names, contig_id="1",
+              contig_length=None, position_offset=0, ploidy=2,
+              chunk_size=CHUNK_SIZE, processes=1):
+    """
+    Write the VCF of the `nodes` of `ts` to the binary file `output`.
+    """
+    source = GenotypeChunks(ts, nodes, ploidy, position_offset, chunk_size)
+    if contig_length is None:
+        contig_length = source.contig_length()
+    output.write(vcf_header(contig_id, contig_length, individual_names))
+    encode = functools.partial(_encode_vcf, contig_id)
+    for text in encode_chunks(encode, source, processes):
+        output.write(text)
+
+
+def write_fam(path, individual_names):
+    """
+    Write the PLINK 1 .fam file of the individuals, with unknown parents,
+    sex and phenotype.
+    """
+    with open(path, "w") as f:
+        for name in individual_names:
+            f.write(f"{name}\t{name}\t0\t0\t0\t-9\n")
+
+
+def _encode_bed(contig_id, source, chunk):
+    alleles, genotypes = source.decode(chunk)
+    packed, biallelic = pack_bed_chunk(alleles, genotypes, source.ploidy)
+    start, stop = chunk
+    lines = [
+        f"{contig_id}\t{site_id}\t0\t{position}\t{site_alleles[1]}\t{site_alleles[0]}\n"
+        for site_id, position, site_alleles, keep in zip(
+            range(start, stop), source.positions[start:stop], alleles, biallelic
+        )
+        if keep
+    ]
+    return packed, "".join(lines), int(np.sum(~biallelic))
+
+
+def append_bed(bed, bim, ts, nodes, contig_id="1", position_offset=0,
+               ploidy=2, chunk_size=CHUNK_SIZE, processes=1):
+    """
+    Append the biallelic sites of the `nodes` of `ts` to the open binary
+    .bed and text .bim files. Returns the number of sites skipped as
+    multiallelic or monomorphic.
+    """
+    source = GenotypeChunks(ts, nodes, ploidy, position_offset, chunk_size)
+    encode = functools.partial(_encode_bed, contig_id)
+    skipped = 0
+    for packed, lines, num_skipped in encode_chunks(encode, source, processes):
+        bed.write(packed)
+        bim.write(lines)
+        skipped += num_skipped
+    return skipped
+
+
+def write_plink(prefix, sources, ploidy=2, chunk_size=CHUNK_SIZE,
+                processes=1):
+    """
+    Write the `prefix`.bed/.bim/.fam file set of `sources`, a sequence of
+    `(ts, nodes, individual_names, contig_id, position_offset)` chromosomes
+    with the same individuals. Returns the number of skipped sites.
+    """
+    skipped = 0
+    fam_names = None
+    with open(prefix + ".bed", "wb") as bed, open(prefix + ".bim", "w") as bim:
+        bed.write(BED_MAGIC)
+        for ts, nodes, individual_names, contig_id, position_offset in sources:
+            if fam_names is None:
+                fam_names = list(individual_names)
+                write_fam(prefix + ".fam", fam_names)
+            elif list(individual_names) != fam_names:
+                raise ValueError(
+                    f"The individuals of contig {contig_id} differ from those "
+                    "of the first contig"
+                )
+            skipped += append_bed(
+                bed, bim, ts, nodes, contig_id, position_offset, ploidy,
+                chunk_size, processes,
+            )
+    return skipped
+
+
+def write_columnar(directory, ts, nodes, individual_names, position_offset=0,
+                   ploidy=2, chunk_size=CHUNK_SIZE, processes=1):
+    """
+    Write the genotypes of the `nodes` of `ts` as a directory of .npy
+    arrays: `genotypes` (sites x haplotypes, written chunk by chunk into a
+    memory map), `position`, `ref`, `alt` (comma separated) and `samples`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    source = GenotypeChunks(ts, nodes, ploidy, position_offset, chunk_size)
+    genotypes = np.lib.format.open_memmap(
+        os.path.join(directory, "genotypes.npy"),
+        mode="w+",
+        dtype=np.int8,
+        shape=(ts.num_sites, len(source.nodes)),
+    )
+    ref = np.empty(ts.num_sites, dtype=object)
+    alt = np.empty(ts.num_sites, dtype=object)
+
+    # the chunks are decoded by the pool, and stored here in site order
+    decoded = encode_chunks(GenotypeChunks.decode, source, processes)
+    for chunk, (alleles, chunk_genotypes) in zip(source.chunks(), decoded):
+        start, stop = chunk
+        if any(len(site_alleles) > 127 for site_alleles in alleles):
+            raise ValueError("More than 127 alleles are not supported")
+        genotypes[start:stop] = chunk_genotypes
+        ref[start:stop] = [site_alleles[0] for site_alleles in alleles]
+        alt[start:stop] = [",".join(site_alleles[1:]) for site_alleles in alleles]
+    genotypes.flush()
+    del genotypes
+
+    np.save(os.path.join(directory, "position.npy"), source.positions)
+    np.save(os.path.join(directory, "ref.npy"), ref.astype(str))
+    np.save(os.path.join(directory, "alt.npy"), alt.astype(str))
+    np.save(
+        os.path.join(directory, "samples.npy"),
+        np.asarray([str(name) for name in individual_names]),
+    )
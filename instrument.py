@@ -0,0 +1,368 @@
+"""
+Named, timed spans around the stages of the scripts.
+
+A script starts a session with `start(command, args)`, wraps its stages in
+`with span(name) as s:` blocks, optionally adding counts such as rows,
+nodes or sites with `s.count(...)`, and ends with `finish(output)`. Every
+span records its elapsed and CPU time and the peak RSS of the process so
+far, and prints a progress line to stderr. Library code can open spans
+whether or not a session is active; outside of a session they are neither
+printed nor recorded.
+
+With `--report`, the spans are written to `<output>.report.json`, and
+`add_provenance` saves them in the provenance of output tree sequences.
+With `--profile`, the run is also profiled, with cProfile (`<output>.prof`,
+readable with `pstats`) or with a low-overhead sampling profiler
+(`<output>.stacks`, in the collapsed format of flame graph tools).
+
+This module only uses the standard library, so that it adds nothing to the
+startup time of the scripts.
+"""
+import collections
+import cProfile
+import json
+import os
+import pstats
+import resource
+import signal
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILERS = ("cprofile", "sample")
+
+# the active session of this process, if any
+_session = None
+
+
+def status(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+
+def peak_rss():
+    """
+    Peak resident set size so far of this process and its finished
+    children, such as the workers of a pool, in bytes.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(own, children) * scale
+
+
+def cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class Span:
+    """
+    The cost of one stage, and counts of what it processed.
+    """
+
+    def __init__(self, name, depth, counts):
+        self.name = name
+        self.depth = depth
+        self.counts = dict(counts)
+        self.start = self.elapsed = self.cpu_time = self.peak_rss = None
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def count_tree_sequence(self, ts):
+        self.count(nodes=ts.num_nodes, edges=ts.num_edges, sites=ts.num_sites,
+                   mutations=ts.num_mutations, individuals=ts.num_individuals,
+                   trees=ts.num_trees)
+
+    def as_dict(self):
+        return dict(name=self.name, depth=self.depth, start=self.start,
+                    elapsed=self.elapsed, cpu_time=self.cpu_time,
+                    peak_rss=self.peak_rss, counts=self.counts)
+
+    def summary(self):
+        counts = ", ".join(f"{k}={v}" for k, v in self.counts.items())
+        return (f"{'  ' * self.depth}{self.name}: {self.elapsed:.2f} s, "
+                f"CPU {self.cpu_time:.2f} s, peak RSS "
+                f"{self.peak_rss / 2**20:.0f} MiB" +
+                (f" ({counts})" if counts else ""))
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler: every `interval` seconds of CPU time, SIGPROF
+    records the stack of the main thread. Its overhead does not grow with
+    the number of calls, unlike cProfile, but it only sees the main thread,
+    and only on Unix.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                         f":{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+    def top(self, n=20):
+        """
+        The functions with the most samples on top of the stack.
+        """
+        functions = collections.Counter()
+        for stack, samples in self.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += samples
+        total = sum(functions.values()) or 1
+        return [dict(function=function, samples=samples,
+                     fraction=samples / total)
+                for function, samples in functions.most_common(n)]
+
+
+@contextmanager
+def _timed(name, depth, counts, origin=0.0):
+    """
+    A span timed from its start to its end, starting `origin` seconds (on
+    the `time.perf_counter` clock) after the start of its session.
+    """
+    span = Span(name, depth, counts)
+    start, cpu_start = time.perf_counter(), cpu_time()
+    try:
+        yield span
+    finally:
+        span.start = start - origin
+        span.elapsed = time.perf_counter() - start
+        span.cpu_time = cpu_time() - cpu_start
+        span.peak_rss = peak_rss()
+
+
+def _span_order(span):
+    # spans of pool workers without a session may have no start
+    return (span.start is None, span.start or 0)
+
+
+def _cprofile_top(profiler, n=20):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [dict(function=f"{name} ({os.path.basename(file)}:{line})",
+                 calls=calls, total_time=total_time, cumulative_time=cumulative)
+            for (file, line, name), (_, calls, total_time, cumulative, _)
+            in rows[:n]]
+
+
+class Session:
+    """
+    The spans of one run of a script.
+    """
+
+    def __init__(self, command, report=False, profile=None, arguments=None):
+        self.command = command
+        self.report = report
+        self.arguments = arguments or {}
+        self.spans = []
+        self.started = datetime.now()
+        status(f"[{command}] Started at {self.started}")
+        self._start, self._cpu_start = time.perf_counter(), cpu_time()
+        self._depth = 0
+
+        self.profile = profile
+        self._profiler = None
+        if profile == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif profile == "sample":
+            self._profiler = SamplingProfiler()
+            self._profiler.start()
+        elif profile is not None:
+            raise ValueError(f"Unknown profiler {profile}, not in {PROFILERS}")
+
+    @contextmanager
+    def measure(self, name, **counts):
+        """
+        A span that is timed and printed but not recorded, for the tasks of
+        a pool, whose spans are sent back to the main process to `record`.
+        """
+        self._depth += 1
+        try:
+            with _timed(name, self._depth - 1, counts, self._start) as span:
+                yield span
+        finally:
+            self._depth -= 1
+            status(f"[{self.command}] {span.summary()}")
+
+    @contextmanager
+    def span(self, name, **counts):
+        with self.measure(name, **counts) as span:
+            try:
+                yield span
+            finally:
+                self.spans.append(span)
+
+    def record(self, spans):
+        self.spans.extend(spans)
+
+    def resources(self):
+        """
+        The cost of the run so far, with the keys of the `resources` of the
+        tskit provenance schema. As in tskit, the CPU times include the
+        startup of the process.
+        """
+        times = os.times()
+        return dict(
+            elapsed_time=time.perf_counter() - self._start,
+            user_time=times.user + times.children_user,
+            sys_time=times.system + times.children_system,
+            max_memory=peak_rss(),
+        )
+
+    def provenance(self, spans=None):
+        """
+        A tskit provenance record of `spans`, by default all the spans so
+        far.
+        """
+        spans = self.spans if spans is None else spans
+        return {
+            "schema_version": "1.0.0",
+            "software": {"name": "msp-gen"},
+            "parameters": {"command": self.command, **self.arguments},
+            "resources": self.resources(),
+            "spans": [s.as_dict() for s in sorted(spans, key=_span_order)],
+        }
+
+    def finish(self, output):
+        """
+        Stop the profiler, and write the report and profile next to the
+        output. Returns the report.
+        """
+        report = dict(self.provenance(), started=self.started.isoformat(),
+                      argv=sys.argv)
+        resources = report["resources"]
+        status(f"[{self.command}] Done in {resources['elapsed_time']:.2f} s, "
+               f"CPU {cpu_time() - self._cpu_start:.2f} s, "
+               f"peak RSS {resources['max_memory'] / 2**20:.0f} MiB")
+        if self._profiler is not None:
+            if self.profile == "cprofile":
+                self._profiler.disable()
+                path = f"{output}.prof"
+                self._profiler.dump_stats(path)
+                top = _cprofile_top(self._profiler)
+            else:
+                self._profiler.stop()
+                path = f"{output}.stacks"
+                self._profiler.write(path)
+                top = self._profiler.top()
+            report["profile"] = dict(profiler=self.profile, file=path, top=top)
+            status(f"[{self.command}] Wrote the profile to {path}")
+        if self.report:
+            path = f"{output}.report.json"
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, default=str)
+            status(f"[{self.command}] Wrote the report to {path}")
+        return report
+
+
+def add_arguments(parser):
+    """
+    Add the `--report` and `--profile` options of `start` to a parser.
+    """
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Write the time, peak memory and counts of every stage to "
+        "<output>.report.json, and to the provenance of output tree sequences",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILERS,
+        default=None,
+        help="Profile the run with cProfile (<output>.prof) or a sampling "
+        "profiler (<output>.stacks)",
+    )
+
+
+def start(command, args):
+    """
+    Start the session of this process, with the options of `add_arguments`.
+    """
+    global _session
+    _session = Session(command, report=args.report, profile=args.profile,
+                       arguments={k: v for k, v in vars(args).items()
+                                  if k not in ("report", "profile")})
+    return _session
+
+
+@contextmanager
+def span(name, **counts):
+    """
+    A span of the active session; outside of a session, the span is only
+    there for its counts.
+    """
+    if _session is None:
+        yield Span(name, 0, counts)
+    else:
+        with _session.span(name, **counts) as s:
+            yield s
+
+
+@contextmanager
+def measure(name, **counts):
+    """
+    A span of the active session that is not recorded: the task of a pool
+    returns it, with its output, for the main process to `record`. Pool
+    workers started with the spawn method have no session, and time the
+    span all the same, with its start on the `time.perf_counter` clock.
+    """
+    if _session is None:
+        with _timed(name, 0, counts) as s:
+            yield s
+    else:
+        with _session.measure(name, **counts) as s:
+            yield s
+
+
+def record(spans):
+    """
+    Add the spans measured by the tasks of a pool to the active session.
+    """
+    if _session is not None:
+        _session.record(spans)
+
+
+def add_provenance(ts, spans=None):
+    """
+    With `--report`, a copy of `ts` with `spans`, by default all the spans
+    so far, appended to its provenance; otherwise `ts` itself, as copying
+    the tables of a large tree sequence is not free.
+    """
+    if _session is None or not _session.report:
+        return ts
+    tables = ts.dump_tables()
+    tables.provenances.add_row(
+        record=json.dumps(_session.provenance(spans), default=str))
+    return tables.tree_sequence()
+
+
+def finish(output):
+    global _session
+    if _session is None:
+        return None
+    report = _session.finish(output)
+    _session = None
+    return report
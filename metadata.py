@@ -0,0 +1,136 @@
+"""
+Individual metadata of the simulated tree sequences.
+
+Every individual records the ID it has in the genealogy (`individual_name`,
+-1 for individuals that are not in the genealogy) and whether it is a
+sample. The metadata is encoded for all individuals at once with numpy,
+either as JSON (the original format) or with tskit's binary struct codec.
+"""
+import re
+
+import numpy as np
+import tskit
+
+# the offset dtype of the installed tskit: 32 bits before tskit 0.4, which
+# limits a metadata column to 4 GiB
+OFFSET_DTYPE = tskit.IndividualTable().metadata_offset.dtype
+
+INDIVIDUAL_JSON_SCHEMA = {
+    "codec": "json",
+    "type": "object",
+    "properties": {
+        # Name of the individual in the pedigree file
+        "individual_name": {"type": "integer"},
+        "is_sample": {"type": "boolean"},
+    },
+    "required": ["individual_name", "is_sample"],
+}
+
+INDIVIDUAL_STRUCT_SCHEMA = {
+    "codec": "struct",
+    "type": "object",
+    "properties": {
+        # Name of the individual in the pedigree file
+        "individual_name": {"type": "integer", "binaryFormat": "q",
+                            "index": 0},
+        "is_sample": {"type": "boolean", "binaryFormat": "?", "index": 1},
+    },
+    "required": ["individual_name", "is_sample"],
+    "additionalProperties": False,
+}
+
+SCHEMAS = {"json": INDIVIDUAL_JSON_SCHEMA, "struct": INDIVIDUAL_STRUCT_SCHEMA}
+
+# the layout of one struct-encoded row
+STRUCT_DTYPE = np.dtype([("individual_name", "<i8"), ("is_sample", "?")])
+
+
+# the fields of JSON metadata, with or without whitespace around the colon
+JSON_FIELDS = {
+    "individual_name": re.compile(rb'"individual_name"\s*:\s*(-?\d+)'),
+    "is_sample": re.compile(rb'"is_sample"\s*:\s*(true|false)'),
+}
+
+
+def _encode_json(names, is_sample):
+    # the same bytes tskit's JSON codec writes for every row
+    rows = np.char.add(
+        np.char.add(b'{"individual_name":', names.astype(bytes)),
+        np.where(is_sample, b',"is_sample":true}', b',"is_sample":false}'),
+    )
+    lengths = np.char.str_len(rows)
+    metadata = np.frombuffer(b"".join(rows.tolist()), dtype=np.int8)
+    return metadata, lengths
+
+
+def _encode_struct(names, is_sample):
+    rows = np.empty(len(names), dtype=STRUCT_DTYPE)
+    rows["individual_name"] = names
+    rows["is_sample"] = is_sample
+    metadata = rows.view(np.int8)
+    lengths = np.full(len(names), STRUCT_DTYPE.itemsize)
+    return metadata, lengths
+
+
+def encode_individual_metadata(names, is_sample, codec="json"):
+    """
+    Encode the metadata of every individual in one pass. Returns the
+    `metadata` and `metadata_offset` columns of an individual table.
+    """
+    names = np.asarray(names, dtype=np.int64)
+    is_sample = np.asarray(is_sample, dtype=bool)
+    if codec == "json":
+        metadata, lengths = _encode_json(names, is_sample)
+    elif codec == "struct":
+        metadata, lengths = _encode_struct(names, is_sample)
+    else:
+        raise ValueError(f"Unknown metadata codec {codec}")
+    offset = np.zeros(len(names) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=offset[1:])
+    if offset[-1] > np.iinfo(OFFSET_DTYPE).max:
+        raise ValueError(
+            f"{offset[-1]} bytes of {codec} metadata do not fit in the "
+            f"{OFFSET_DTYPE} offsets of this tskit version"
+        )
+    return metadata, offset.astype(OFFSET_DTYPE)
+
+
+def set_individual_metadata(tables, names, is_sample, codec="json"):
+    """
+    Replace the metadata and schema of the individual table.
+    """
+    metadata, metadata_offset = encode_individual_metadata(
+        names, is_sample, codec=codec)
+    individuals = tables.individuals
+    individuals.set_columns(
+        flags=individuals.flags,
+        location=individuals.location,
+        location_offset=individuals.location_offset,
+        metadata=metadata,
+        metadata_offset=metadata_offset,
+    )
+    individuals.metadata_schema = tskit.MetadataSchema(SCHEMAS[codec])
+
+
+def decode_individual_metadata(individuals):
+    """
+    Decode the metadata of every row of an individual table in one pass.
+    Returns the `individual_name` and `is_sample` arrays. JSON metadata is
+    scanned with regular expressions over the whole metadata column rather
+    than parsed row by row.
+    """
+    schema = individuals.metadata_schema.schema
+    metadata = individuals.metadata.tobytes()
+    num_rows = individuals.num_rows
+    if schema is not None and schema.get("codec") == "struct":
+        rows = np.frombuffer(metadata, dtype=STRUCT_DTYPE)
+        if len(rows) != num_rows:
+            raise ValueError("Unexpected struct individual metadata")
+        return rows["individual_name"].astype(np.int64), rows["is_sample"].copy()
+
+    names = JSON_FIELDS["individual_name"].findall(metadata)
+    is_sample = JSON_FIELDS["is_sample"].findall(metadata)
+    if len(names) != num_rows or len(is_sample) != num_rows:
+        raise ValueError("Every individual needs an individual_name and is_sample")
+    names = np.array(names, dtype=bytes).astype(np.int64)
+    return names, np.array(is_sample, dtype=bytes) == b"true"
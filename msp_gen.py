@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+msp-gen: a single entry point to the scripts of this repository.
+
+    ./msp_gen.py <command> [arguments]
+
+Every command is a script with a `get_parser()` and a `main(args)`. Only the
+script of the command being run is imported, and the scripts import their
+heavy dependencies (msprime, stdpopsim, matplotlib, tqdm) only where they
+are needed, so that listing the commands imports nothing and short tasks,
+such as the steps of an array job, do not pay for modules they never use.
+"""
+import importlib
+import sys
+
+# command -> (script module, description)
+COMMANDS = {
+    "genealogy": ("create_genealogy", "Simulate an extended family genealogy"),
+    "preprocess": ("balsac_preprocess", "Add the missing founders to a BALSAC export"),
+    "probands": ("find_probands", "List the individuals with no children"),
+    "pedigree-stats": ("pedigree_stats", "Depth, inbreeding and kinship of probands"),
+    "simulate": ("simulate", "Simulate genomes over a genealogy"),
+    "replicates": ("replicates", "Summarize many replicates over a genealogy"),
+    "complete": ("complete_simulation_demography", "Complete with stdpopsim demographic models"),
+    "complete-wf": ("complete_simulation_wf", "Complete with a Wright-Fisher model"),
+    "mutate": ("mutate_tree_sequence", "Overlay mutations on a tree sequence"),
+    "convert": ("convert_to_bcf", "Convert tree sequences to BCF, VCF, PLINK or arrays"),
+    "afs": ("afs_replicates", "Allele frequency spectra of many replicates"),
+    "plot-afs": ("af_compare", "Plot the spectra written by `afs`"),
+}
+
+
+def usage():
+    width = max(map(len, COMMANDS))
+    lines = ["usage: msp-gen <command> [arguments]", "", "commands:"]
+    lines += [f"  {name:<{width}}  {description}"
+              for name, (_, description) in COMMANDS.items()]
+    lines += ["", "Run `msp-gen <command> --help` for the arguments of a "
+                  "command."]
+    return "\n".join(lines) + "\n"
+
+
+def get_command_parser(command):
+    """
+    Import the script of a command, and return it with its argument parser.
+    """
+    module = importlib.import_module(COMMANDS[command][0])
+    parser = module.get_parser()
+    parser.prog = f"msp-gen {command}"
+    return module, parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in ("-h", "--help"):
+        sys.stdout.write(usage())
+        return 0
+    if not argv or argv[0] not in COMMANDS:
+        sys.stderr.write(usage())
+        if argv:
+            sys.stderr.write(f"\nmsp-gen: error: unknown command {argv[0]}\n")
+        return 2
+
+    command, *argv = argv
+    module, parser = get_command_parser(command)
+    module.main(parser.parse_args(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,295 @@
-import msprime
-import tskit
+"""
+Overlay mutations on a tree sequence.
+
+With `--chunks`, the genome is split into intervals that are mutated
+independently, each with its own seed derived from the root seed, on a pool
+of processes, and the site and mutation tables of the intervals are
+concatenated back in genome order. The result only depends on the seed and
+the number of chunks, not on the number of processes.
+"""
+import json
+import multiprocessing
 from argparse import ArgumentParser
 
-parser = ArgumentParser()
-parser.add_argument("input_file")
-parser.add_argument("output_file")
-parser.add_argument("-u", "--mutation_rate", default=1e-8, type=float)
+import numpy as np
+import tskit
+
+import instrument
+import storage
+from checkpoint import Checkpoints, check_seed_argument
+from simulate import derive_seeds, status
+
+# msprime mutation models, by name; msprime itself is only imported once
+# there is something to mutate
+MODELS = {
+    "binary": "BinaryMutationModel",
+    "jc69": "JC69",
+}
+
+# per-process state of pool workers, set up once by init_worker
+worker = {}
+
+
+def read_rate_map(path, sequence_length):
+    """
+    Read a mutation rate map: a whitespace-separated file with a header and
+    two columns, the start position of every interval and its rate per
+    base-pair per generation. The first interval must start at 0, and the
+    last one ends at the sequence length.
+    """
+    import msprime
+
+    position, rate = np.loadtxt(path, skiprows=1, ndmin=2, unpack=True)
+    return msprime.RateMap(
+        position=np.append(position, sequence_length), rate=rate
+    )
+
+
+def chunk_bounds(sequence_length, num_chunks):
+    """
+    Breakpoints splitting [0, sequence_length) into `num_chunks` intervals,
+    at integer positions.
+    """
+    bounds = np.linspace(0, sequence_length, num_chunks + 1)
+    bounds[1:-1] = np.round(bounds[1:-1])
+    return bounds
+
+
+def split_tables(ts):
+    """
+    The tables of `ts` without its edges, sites and mutations, and its edge
+    table, from which `interval_tree_sequence` builds any interval.
+    """
+    skeleton = ts.dump_tables()
+    edges = skeleton.edges.copy()
+    skeleton.edges.clear()
+    skeleton.sites.clear()
+    skeleton.mutations.clear()
+    return skeleton, edges
+
+
+def interval_tree_sequence(skeleton, edges, left, right):
+    """
+    The tree sequence of the `edges` that overlap [left, right), trimmed to
+    it, over all the nodes of `skeleton`, so that node IDs are unchanged.
+    """
+    keep = (edges.right > left) & (edges.left < right)
+    tables = skeleton.copy()
+    tables.edges.set_columns(
+        left=np.maximum(edges.left[keep], left),
+        right=np.minimum(edges.right[keep], right),
+        parent=edges.parent[keep],
+        child=edges.child[keep],
+    )
+    tables.build_index()
+    return tables.tree_sequence()
+
+
+def mutate_interval(skeleton, edges, rate_map, left, right, seed,
+                    model="binary", discrete_genome=False):
+    """
+    Mutate the interval [left, right) of the tree sequence split by
+    `split_tables`. Returns the site and mutation tables of the interval; as
+    with the legacy `msprime.mutate`, existing sites are not kept.
+    """
+    import msprime
+
+    # only the edges of the interval are mutated, so that a chunk costs a
+    # pass over its own interval rather than over the whole genome
+    mutated = msprime.sim_mutations(
+        interval_tree_sequence(skeleton, edges, left, right),
+        rate=rate_map,
+        random_seed=seed,
+        model=getattr(msprime, MODELS[model])(),
+        discrete_genome=discrete_genome,
+        keep=False,
+        record_provenance=False,
+    )
+    return mutated.tables.sites.copy(), mutated.tables.mutations.copy()
+
+
+def init_worker(input_file, extra):
+    """
+    Pool initializer: load and split the tree sequence once per worker
+    process.
+    """
+    skeleton, edges = split_tables(storage.load(input_file))
+    worker.update(skeleton=skeleton, edges=edges, **extra)
+
+
+def _mutate_chunk(task):
+    left, right, seed = task
+    return mutate_interval(
+        worker["skeleton"],
+        worker["edges"],
+        worker["rate_map"],
+        left,
+        right,
+        seed,
+        model=worker["model"],
+        discrete_genome=worker["discrete_genome"],
+    )
+
+
+def merge_intervals(tables, intervals):
+    """
+    Replace the sites and mutations of `tables` by those of the `intervals`,
+    a sequence of (sites, mutations) tables in genome order.
+    """
+    tables.sites.clear()
+    tables.mutations.clear()
+    for sites, mutations in intervals:
+        site_offset = tables.sites.num_rows
+        mutation_offset = tables.mutations.num_rows
+        tables.sites.append_columns(
+            position=sites.position,
+            ancestral_state=sites.ancestral_state,
+            ancestral_state_offset=sites.ancestral_state_offset,
+            metadata=sites.metadata,
+            metadata_offset=sites.metadata_offset,
+        )
+        parent = mutations.parent
+        tables.mutations.append_columns(
+            site=mutations.site + site_offset,
+            node=mutations.node,
+            time=mutations.time,
+            derived_state=mutations.derived_state,
+            derived_state_offset=mutations.derived_state_offset,
+            parent=np.where(parent == tskit.NULL, parent, parent + mutation_offset),
+            metadata=mutations.metadata,
+            metadata_offset=mutations.metadata_offset,
+        )
+
+
+def mutate(input_file, mutation_rate=1e-8, rate_map_file=None, seed=None,
+           num_chunks=1, processes=None, model="binary", discrete_genome=False):
+    """
+    Mutate the tree sequence in `input_file`, at a uniform `mutation_rate`
+    or with the rate map in `rate_map_file`, in `num_chunks` intervals
+    mutated on `processes` processes.
+    """
+    import msprime
+
+    ts = storage.load(input_file)
+    if rate_map_file is None:
+        rate_map = msprime.RateMap.uniform(ts.sequence_length, mutation_rate)
+    else:
+        rate_map = read_rate_map(rate_map_file, ts.sequence_length)
+    bounds = chunk_bounds(ts.sequence_length, num_chunks)
+    tasks = list(zip(bounds[:-1], bounds[1:], derive_seeds(seed, num_chunks)))
+    extra = dict(rate_map=rate_map, model=model, discrete_genome=discrete_genome)
+
+    tables = ts.dump_tables()
+    processes = min(processes or multiprocessing.cpu_count(), num_chunks)
+    if processes <= 1:
+        skeleton, edges = split_tables(ts)
+        worker.update(skeleton=skeleton, edges=edges, **extra)
+        merge_intervals(tables, map(_mutate_chunk, tasks))
+    else:
+        status(f"Mutating {num_chunks} chunks on {processes} processes...")
+        with multiprocessing.Pool(
+            processes, initializer=init_worker, initargs=(input_file, extra)
+        ) as pool:
+            # imap keeps the intervals in genome order
+            merge_intervals(tables, pool.imap(_mutate_chunk, tasks))
+
+    tables.provenances.add_row(
+        record=json.dumps(
+            {
+                "software": {"name": "msp-gen"},
+                "parameters": {
+                    "command": "mutate",
+                    "mutation_rate": mutation_rate if rate_map_file is None else None,
+                    "rate_map": rate_map_file,
+                    "seed": seed,
+                    "chunks": num_chunks,
+                    "model": model,
+                    "discrete_genome": discrete_genome,
+                },
+            }
+        )
+    )
+    tables.build_index()
+    return tables.tree_sequence()
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument("input_file")
+    parser.add_argument("output_file")
+    parser.add_argument("-u", "--mutation_rate", default=1e-8, type=float)
+    parser.add_argument(
+        "--rate-map",
+        default=None,
+        help="Variable mutation rate map (overrides --mutation_rate): a file "
+        "with a header and the columns position and rate",
+    )
+    parser.add_argument("--seed", "-s", default=None, type=int, help="Root seed")
+    parser.add_argument(
+        "--chunks",
+        default=1,
+        type=int,
+        help="Number of intervals mutated independently; the result depends "
+        "on it, but not on --processes",
+    )
+    parser.add_argument(
+        "--processes",
+        "-j",
+        default=None,
+        type=int,
+        help="Number of processes mutating the chunks (default: all cores)",
+    )
+    parser.add_argument(
+        "--model",
+        choices=sorted(MODELS),
+        default="binary",
+        help="Mutation model: binary 0/1 alleles or JC69 nucleotides",
+    )
+    parser.add_argument(
+        "--finite-sites",
+        action="store_true",
+        help="Place mutations at integer positions, where they can stack, "
+        "instead of the infinite sites model",
+    )
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="Skip the mutation if it was already checkpointed "
+                             "here")
+    instrument.add_arguments(parser)
+    return parser
 
-args = parser.parse_args()
 
-ts = tskit.load(args.input_file)
+def main(args):
+    check_seed_argument(get_parser(), args)
+    instrument.start("mutate", args)
+    checkpoints = Checkpoints(args.checkpoint_dir)
+    with instrument.span("mutate", chunks=args.chunks) as span:
+        tsm, _ = checkpoints.run(
+            "mutate",
+            lambda: mutate(
+                args.input_file,
+                mutation_rate=args.mutation_rate,
+                rate_map_file=args.rate_map,
+                seed=args.seed,
+                num_chunks=args.chunks,
+                processes=args.processes,
+                model=args.model,
+                discrete_genome=args.finite_sites,
+            ),
+            files=[args.input_file, args.rate_map],
+            params=dict(
+                mutation_rate=args.mutation_rate,
+                seed=args.seed,
+                chunks=args.chunks,
+                model=args.model,
+                finite_sites=args.finite_sites,
+            ),
+        )
+        span.count(sites=tsm.num_sites, mutations=tsm.num_mutations)
+    tsm = instrument.add_provenance(tsm)
+    with instrument.span("write"):
+        storage.dump(tsm, args.output_file)
+    instrument.finish(args.output_file)
 
-tsm = msprime.mutate(ts, rate=args.mutation_rate)
 
-tsm.dump(args.output_file)
+if __name__ == "__main__":
+    main(get_parser().parse_args())
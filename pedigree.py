@@ -0,0 +1,526 @@
+"""
+Pedigree storage shared by the scripts in this repository.
+
+Besides the whitespace-separated text format (see README), pedigrees can be
+stored in a binary columnar format: a directory, conventionally named
+`*.ped`, holding one raw little-endian file per column and a `pedigree.json`
+manifest with the number of rows and the dtype of every column. The
+manifest is written last, so a directory without one is an incomplete
+write.
+
+Converted pedigrees also store the parent row indices and an ID -> row
+index, so that loading them is a handful of memory maps and no parsing.
+Convert a text pedigree once with:
+
+    python pedigree.py genealogy.tsv
+
+after which `load_pedigree("genealogy.tsv")` maps `genealogy.ped` instead.
+"""
+import json
+import os
+
+import numpy as np
+
+FORMAT_NAME = "msp-gen-pedigree"
+FORMAT_VERSION = 1
+MANIFEST = "pedigree.json"
+BINARY_SUFFIX = ".ped"
+
+# the first three columns of a pedigree, whatever they are called in the
+# header of a text file
+ID_COLUMNS = ("individual", "father", "mother")
+# columns derived from the ID columns, rather than holding data about rows
+INDEX_COLUMNS = ("father_index", "mother_index", "id_sorted", "id_order")
+
+
+def is_binary_pedigree(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def binary_path(path):
+    """
+    The conventional location of the binary version of a text pedigree.
+    """
+    return os.path.splitext(path)[0] + BINARY_SUFFIX
+
+
+def _column_file(path, column):
+    return os.path.join(path, column + ".bin")
+
+
+def _id_dtype(*columns):
+    high = max((int(c.max()) for c in columns if len(c)), default=0)
+    return np.int32 if high <= np.iinfo(np.int32).max else np.int64
+
+
+class PedigreeWriter:
+    """
+    Append blocks of rows to a binary pedigree, one column file at a time,
+    so that only the block being written needs to be held in memory.
+
+    `dtype` is either a single dtype for all the columns, or a mapping from
+    column name to dtype.
+    """
+
+    def __init__(self, path, columns, dtype=np.int32):
+        self.path = path
+        self.columns = tuple(columns)
+        if isinstance(dtype, dict):
+            dtypes = [dtype[c] for c in self.columns]
+        else:
+            dtypes = [dtype] * len(self.columns)
+        self.dtypes = [np.dtype(d).newbyteorder("<") for d in dtypes]
+        self.num_rows = 0
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            os.remove(os.path.join(path, MANIFEST))
+        self._files = [open(_column_file(path, c), "wb") for c in self.columns]
+
+    def write(self, block):
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[1] != len(self.columns):
+            raise ValueError(f"Expected a block with {len(self.columns)} "
+                             f"columns, got shape {block.shape}")
+        self.write_columns(block.T)
+
+    def write_columns(self, columns):
+        """
+        Append one array per column, all of the same length.
+        """
+        lengths = {len(c) for c in columns}
+        if len(columns) != len(self.columns) or len(lengths) > 1:
+            raise ValueError("Expected one array per column, of equal length")
+        for f, column, dtype in zip(self._files, columns, self.dtypes):
+            f.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+        self.num_rows += lengths.pop() if lengths else 0
+
+    def close(self, extra=()):
+        """
+        Close the column files and write the manifest. `extra` is a sequence
+        of (name, array) pairs of derived columns, such as the ID index,
+        that do not have one value per row.
+        """
+        for f in self._files:
+            f.close()
+        columns = {c: d.str for c, d in zip(self.columns, self.dtypes)}
+        lengths = {c: self.num_rows for c in self.columns}
+        for name, array in extra:
+            array = np.asarray(array)
+            array.astype(array.dtype.newbyteorder("<")).tofile(
+                _column_file(self.path, name))
+            columns[name] = array.dtype.newbyteorder("<").str
+            lengths[name] = len(array)
+        manifest = {
+            "format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "num_rows": self.num_rows,
+            "columns": columns,
+            "lengths": lengths,
+        }
+        with open(os.path.join(self.path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """
+        Close the column files without writing the manifest, which leaves
+        an incomplete write.
+        """
+        for f in self._files:
+            f.close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TextPedigreeWriter:
+    """
+    Append blocks of integer rows to a tab-separated pedigree file, with the
+    same layout as `np.savetxt(..., fmt="%d", delimiter="\\t")`.
+    """
+
+    def __init__(self, path, columns):
+        self.columns = tuple(columns)
+        self.num_rows = 0
+        self._row_format = "\t".join(["%d"] * len(self.columns)) + "\n"
+        self._file = open(path, "w")
+        self._file.write("# " + "\t".join(self.columns) + "\n")
+
+    # rows formatted at a time: the Python ints and the text of a sub-block
+    # take a few hundred bytes per row, whatever the size of the block
+    ROWS_PER_WRITE = 1 << 14
+
+    def write(self, block):
+        block = np.asarray(block)
+        # a single string-format call per sub-block is much faster than
+        # savetxt
+        for start in range(0, len(block), self.ROWS_PER_WRITE):
+            rows = block[start:start + self.ROWS_PER_WRITE]
+            self._file.write((self._row_format * len(rows)) %
+                             tuple(rows.ravel().tolist()))
+        self.num_rows += len(block)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def founder_generations(father_index, mother_index):
+    """
+    The generation of every row counted down from the founders: 0 for rows
+    with no known parent, and one more than their latest parent for the
+    others. Rows are resolved one generation at a time, once both of their
+    parents are; rows that are never resolved are on or below a cycle, and
+    are at generation -1.
+    """
+    father_index = np.asarray(father_index)
+    mother_index = np.asarray(mother_index)
+    generation = np.full(len(father_index), -1, dtype=np.int32)
+    # -1 (a missing parent) picks the trailing True of resolved
+    resolved = np.zeros(len(father_index) + 1, dtype=bool)
+    resolved[-1] = True
+    remaining = np.arange(len(father_index), dtype=np.int32)
+    g = 0
+    while len(remaining):
+        ready = resolved[father_index[remaining]] & \
+            resolved[mother_index[remaining]]
+        if not np.any(ready):
+            break
+        generation[remaining[ready]] = g
+        resolved[remaining[ready]] = True
+        remaining = remaining[~ready]
+        g += 1
+    return generation
+
+
+def cyclic_rows(father_index, mother_index):
+    """
+    Rows that are their own ancestor, or descend from one: the rows that
+    `founder_generations` cannot resolve.
+    """
+    generation = founder_generations(father_index, mother_index)
+    return np.flatnonzero(generation < 0).astype(np.int32)
+
+
+class PedigreeColumns:
+    """
+    A pedigree as a set of columns. IDs are positive integers, with 0 for
+    a missing parent; parent indices are rows, with -1 for a missing
+    parent. `time` and `sex` are None if the input did not have them.
+    Any other per-row column (see `data_columns`) is carried along by
+    `subset` and `write_binary`.
+
+    Columns loaded from a binary pedigree are read-only memory maps.
+    """
+
+    def __init__(self, columns):
+        missing = [c for c in ID_COLUMNS if c not in columns]
+        if missing:
+            raise ValueError(f"Pedigree is missing columns {missing}")
+        self.columns = columns
+        self.individual = columns["individual"]
+        self.father = columns["father"]
+        self.mother = columns["mother"]
+        self.time = columns.get("time")
+        self.sex = columns.get("sex")
+        self.num_individuals = len(self.individual)
+
+        if "id_sorted" not in columns:
+            order = np.argsort(self.individual, kind="stable")
+            id_sorted = self.individual[order]
+            duplicated = id_sorted[1:][id_sorted[1:] == id_sorted[:-1]]
+            if len(duplicated):
+                raise ValueError(f"Pedigree has {len(duplicated)} duplicated "
+                                 f"IDs, e.g. {duplicated[0]}")
+            columns["id_sorted"] = id_sorted
+            columns["id_order"] = order.astype(np.int32)
+        self.id_sorted = columns["id_sorted"]
+        self.id_order = columns["id_order"]
+
+        if "father_index" not in columns:
+            columns["father_index"] = self.index_of(self.father, missing=0)
+            columns["mother_index"] = self.index_of(self.mother, missing=0)
+        self.father_index = columns["father_index"]
+        self.mother_index = columns["mother_index"]
+
+    @property
+    def data_columns(self):
+        """
+        Names of the columns with one value per row, other than indices.
+        """
+        return [name for name, column in self.columns.items()
+                if column is not None and name not in INDEX_COLUMNS]
+
+    def with_columns(self, **columns):
+        """
+        A new pedigree with extra or replaced per-row columns.
+        """
+        for name, column in columns.items():
+            if len(column) != self.num_individuals:
+                raise ValueError(f"Column {name} does not have one value "
+                                 f"per individual")
+        return PedigreeColumns(dict(self.columns, **columns))
+
+    @property
+    def parents(self):
+        """
+        A (n, 2) array of the father and mother row indices.
+        """
+        return np.column_stack([self.father_index, self.mother_index])
+
+    def index_of(self, ids, missing=None):
+        """
+        Rows of the individuals with the given IDs. IDs equal to `missing`
+        map to -1; any other unknown ID is an error.
+        """
+        ids = np.asarray(ids)
+        if len(self.id_sorted) == 0:
+            found = np.zeros(ids.shape, dtype=bool)
+            index = np.full(ids.shape, -1, dtype=np.int32)
+        else:
+            pos = np.minimum(np.searchsorted(self.id_sorted, ids),
+                             len(self.id_sorted) - 1)
+            found = self.id_sorted[pos] == ids
+            index = np.where(found, self.id_order[pos], -1).astype(np.int32)
+        unknown = ~found if missing is None else ~found & (ids != missing)
+        if np.any(unknown):
+            raise ValueError(f"{np.count_nonzero(unknown)} IDs are not in the "
+                             f"pedigree, e.g. {ids[unknown][0]}")
+        return index
+
+    def is_parent(self):
+        """
+        Whether every row is the father or mother of another row.
+        """
+        is_parent = np.zeros(self.num_individuals, dtype=bool)
+        is_parent[self.father_index[self.father_index >= 0]] = True
+        is_parent[self.mother_index[self.mother_index >= 0]] = True
+        return is_parent
+
+    def proband_indices(self, min_time=None):
+        """
+        Rows of the individuals that are nobody's parent, in row order. With
+        `min_time`, only probands whose `time` is at least `min_time` are
+        kept: with birth years in the time column, the probands born in or
+        after that year. The filter compares values only, so with times in
+        generations before the present (as written by create_genealogy.py)
+        it keeps the probands at least `min_time` generations back.
+        """
+        keep = ~self.is_parent()
+        if min_time is not None:
+            if self.time is None:
+                raise ValueError("Pedigree has no time column to filter on")
+            keep &= np.asarray(self.time) >= min_time
+        return np.flatnonzero(keep).astype(np.int32)
+
+    def check_probands(self, rows):
+        """
+        Raise a ValueError unless `rows` are distinct rows of probands, as
+        `msprime.Pedigree.set_samples` requires of its samples.
+        """
+        rows = np.asarray(rows)
+        if np.any((rows < 0) | (rows >= self.num_individuals)):
+            raise ValueError(f"Proband rows must be in [0, "
+                             f"{self.num_individuals})")
+        if len(np.unique(rows)) != len(rows):
+            raise ValueError("Duplicate probands")
+        parents = rows[self.is_parent()[rows]]
+        if len(parents) > 0:
+            raise ValueError(f"{len(parents)} probands have children in the "
+                             f"pedigree, e.g. {self.individual[parents[0]]}")
+
+    def generation_depth(self):
+        """
+        The time of every individual, in generations: probands are at 0 and
+        everyone else is one generation above their oldest child. This is
+        the time `msprime.Pedigree.read_txt` assigns without a time column.
+        """
+        parents = self.parents
+        time = np.zeros(self.num_individuals)
+        is_parent = np.zeros(self.num_individuals, dtype=bool)
+        is_parent[parents[parents >= 0]] = True
+        climbers = np.flatnonzero(~is_parent)
+        t = 0
+        while len(climbers):
+            if t > self.num_individuals:
+                raise ValueError("Pedigree has a cycle")
+            time[climbers] = t
+            climbers = parents[climbers].ravel()
+            climbers = np.unique(climbers[climbers >= 0])
+            t += 1
+        return time
+
+    def ancestor_closure(self, rows):
+        """
+        Sorted rows of the given individuals and all of their ancestors,
+        found breadth-first over the parent indices.
+        """
+        parents = self.parents
+        keep = np.zeros(self.num_individuals, dtype=bool)
+        frontier = np.unique(rows)
+        keep[frontier] = True
+        while len(frontier):
+            frontier = parents[frontier].ravel()
+            frontier = np.unique(frontier[frontier >= 0])
+            frontier = frontier[~keep[frontier]]
+            keep[frontier] = True
+        return np.flatnonzero(keep).astype(np.int32)
+
+    def subset(self, rows):
+        """
+        A new pedigree with only the given rows, in order, reindexed. The
+        rows must be closed under ancestry (see `ancestor_closure`). IDs are
+        unchanged, and an `original_index` column maps every row back to
+        this pedigree.
+        """
+        rows = np.asarray(rows)
+        new_index = np.full(self.num_individuals + 1, -1, dtype=np.int32)
+        new_index[rows] = np.arange(len(rows), dtype=np.int32)
+        columns = {name: np.asarray(self.columns[name])[rows]
+                   for name in self.data_columns}
+        # -1 (a missing parent) picks the trailing -1 of new_index
+        columns["father_index"] = new_index[self.father_index[rows]]
+        columns["mother_index"] = new_index[self.mother_index[rows]]
+        if np.any(columns["father_index"][columns["father"] != 0] < 0) or \
+                np.any(columns["mother_index"][columns["mother"] != 0] < 0):
+            raise ValueError("Subset is missing the parents of some rows")
+        if "original_index" not in columns:
+            columns["original_index"] = rows.astype(np.int32)
+        return PedigreeColumns(columns)
+
+    def to_msprime(self, time=None):
+        """
+        Build an `msprime.Pedigree`. By default, individuals get the time
+        returned by `generation_depth`.
+        """
+        import msprime
+
+        if time is None:
+            time = self.generation_depth()
+        return msprime.Pedigree(np.asarray(self.individual), self.parents,
+                                np.asarray(time))
+
+
+def _is_number(token):
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def read_text(path, delimiter=None):
+    """
+    Parse a text pedigree. The first three columns are the individual,
+    father and mother IDs; a header line, optionally starting with `#`,
+    names the columns, and `time` and `sex` columns are kept.
+    """
+    with open(path) as f:
+        first = f.readline()
+    tokens = first.lstrip("#").split(delimiter)
+    has_header = first.startswith("#") or not all(map(_is_number, tokens))
+    names = [t.strip().lower() for t in tokens] if has_header else []
+
+    data = np.loadtxt(path, delimiter=delimiter, comments="#",
+                      skiprows=int(has_header and not first.startswith("#")),
+                      ndmin=2)
+    ids = data[:, :3].astype(np.int64)
+    dtype = _id_dtype(ids)
+    columns = {name: ids[:, i].astype(dtype)
+               for i, name in enumerate(ID_COLUMNS)}
+    if "time" in names[3:]:
+        columns["time"] = data[:, names.index("time")]
+    if "sex" in names[3:]:
+        columns["sex"] = data[:, names.index("sex")].astype(np.int32)
+    return PedigreeColumns(columns)
+
+
+def read_binary(path):
+    """
+    Memory-map a binary pedigree.
+    """
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a binary pedigree")
+    if manifest["version"] > FORMAT_VERSION:
+        raise ValueError(f"Unsupported pedigree format version "
+                         f"{manifest['version']}")
+
+    lengths = manifest.get("lengths", {})
+    columns = {}
+    for name, dtype in manifest["columns"].items():
+        length = lengths.get(name, manifest["num_rows"])
+        if length == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(_column_file(path, name), dtype=dtype,
+                                      mode="r", shape=(length,))
+    return PedigreeColumns(columns)
+
+
+def load_pedigree(path, delimiter=None):
+    """
+    Load a pedigree from a binary pedigree directory, or from a text file.
+    For a text file, an up-to-date binary version next to it (see
+    `binary_path`) is memory-mapped instead of parsing the text.
+    """
+    if is_binary_pedigree(path):
+        return read_binary(path)
+    cached = binary_path(path)
+    if is_binary_pedigree(cached) and \
+            os.path.getmtime(cached) >= os.path.getmtime(path):
+        return read_binary(cached)
+    return read_text(path, delimiter=delimiter)
+
+
+def write_binary(ped, path):
+    """
+    Write a pedigree, including its parent and ID indices, in the binary
+    format.
+    """
+    names = ped.data_columns + ["father_index", "mother_index"]
+    arrays = [ped.columns[name] for name in names]
+    writer = PedigreeWriter(path, names,
+                            dtype={n: a.dtype for n, a in zip(names, arrays)})
+    writer.write_columns(arrays)
+    writer.close(extra=[("id_sorted", ped.id_sorted),
+                        ("id_order", ped.id_order)])
+
+
+def convert(text_path, output=None, delimiter=None):
+    """
+    Convert a text pedigree into the binary format, by default next to the
+    text file where `load_pedigree` will find it.
+    """
+    if output is None:
+        output = binary_path(text_path)
+    write_binary(read_text(text_path, delimiter=delimiter), output)
+    return output
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser("pedigree.py")
+    parser.add_argument("genealogy", help="Text genealogy file")
+    parser.add_argument("output", nargs="?", default=None,
+                        help="Binary pedigree directory "
+                             "(default: genealogy with a .ped suffix)")
+    parser.add_argument("--delimiter", "-d", default=None,
+                        help="Delimiter for genealogy")
+    args = parser.parse_args()
+
+    output = convert(args.genealogy, args.output, delimiter=args.delimiter)
+    print(f"Wrote {output}")
@@ -0,0 +1,317 @@
+"""
+Descriptive statistics of a genealogy, to choose probands and to compare
+with simulations before spending cluster hours on `simulate.py`: the depth
+of every individual's genealogy, the genetic contribution of founders to a
+set of probands, inbreeding coefficients, kinship between probands, and the
+number of ancestors of the probands at every generation.
+
+Everything is computed over the parent row indices of `pedigree.py`, one
+generation at a time, counted down from the founders (see
+`pedigree.founder_generations`): everyone's parents are in earlier
+generations, so a whole generation is computed at once from arrays of the
+generations above it. No statistic recurses over individuals.
+"""
+import sys
+from argparse import ArgumentParser
+from collections import namedtuple
+
+import numpy as np
+
+import instrument
+from pedigree import founder_generations, load_pedigree
+
+Depth = namedtuple("Depth", ["maximum", "minimum", "mean"])
+
+
+def status(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+
+def _check_generations(father_index, mother_index):
+    generation = founder_generations(father_index, mother_index)
+    if np.any(generation < 0):
+        raise ValueError(f"{np.count_nonzero(generation < 0)} individuals are "
+                         f"their own ancestor or descend from one")
+    return generation
+
+
+def generation_rows(generation):
+    """
+    The rows of every generation of `founder_generations`, founders first.
+    """
+    order = np.argsort(generation, kind="stable")
+    bounds = np.searchsorted(generation[order],
+                             np.arange(generation.max(initial=-1) + 2))
+    return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def depth(ped):
+    """
+    The depth of the genealogy of every individual, in generations: the
+    maximum is the longest line of ancestors up to a founder, the minimum
+    the number of complete generations, and the mean is the expected
+    number of generations (the sum over known ancestors of 1/2 to the
+    power of their generation). Founders are at 0.
+    """
+    n = ped.num_individuals
+    # -1 (a missing parent) picks the trailing -1, so that a missing parent
+    # adds nothing to the mean and ends the complete generations
+    maximum = np.full(n + 1, -1, dtype=np.int32)
+    minimum = np.full(n + 1, -1, dtype=np.int32)
+    mean = np.full(n + 1, -1.0)
+    generation = _check_generations(ped.father_index, ped.mother_index)
+    for level in generation_rows(generation):
+        father = ped.father_index[level]
+        mother = ped.mother_index[level]
+        maximum[level] = 1 + np.maximum(maximum[father], maximum[mother])
+        minimum[level] = 1 + np.minimum(minimum[father], minimum[mother])
+        mean[level] = (2 + mean[father] + mean[mother]) / 2
+    return Depth(maximum[:-1], minimum[:-1], mean[:-1])
+
+
+def genetic_contributions(ped, rows):
+    """
+    The expected fraction of the genomes of the individuals in `rows` that
+    comes from every individual of the pedigree, summed over every line of
+    descent. Over the founders, the contributions add up to one, less the
+    fraction inherited from missing parents of non-founders, which is
+    returned second.
+    """
+    n = ped.num_individuals
+    rows = np.unique(rows)
+    contribution = np.zeros(n + 1)
+    contribution[rows] = 1 / len(rows)
+    generation = _check_generations(ped.father_index, ped.mother_index)
+    # children pass half of what they have to each parent, from the latest
+    # generation up, so that every child is complete before its parents
+    # pass theirs on; founders keep what they have
+    for level in generation_rows(generation)[:0:-1]:
+        half = contribution[level] / 2
+        # -1 (a missing parent) adds to the trailing entry
+        np.add.at(contribution, ped.father_index[level], half)
+        np.add.at(contribution, ped.mother_index[level], half)
+    return contribution[:-1], contribution[-1]
+
+
+def _kinship_frontier(ped, rows, keep, max_frontier=None):
+    """
+    Kinship over the ancestors of `rows`, one generation at a time.
+
+    Only the kinship between the individuals of the "frontier" is held:
+    those with children in later generations, and, if `keep`, the `rows`
+    themselves. Everyone's kinship to the frontier is half the sum of
+    their parents', so a generation is added from rows of the frontier
+    matrix, and individuals leave the frontier after the generation of
+    their last child. Memory is the square of the largest frontier,
+    rather than of the pedigree.
+
+    Returns the ancestor rows, the inbreeding coefficient of every one of
+    them, and, if `keep`, the kinship matrix of `rows`.
+    """
+    closure = ped.ancestor_closure(rows)
+    new_index = np.full(ped.num_individuals + 1, -1, dtype=np.int64)
+    new_index[closure] = np.arange(len(closure))
+    # -1 (a missing parent) picks the trailing -1 of new_index
+    father = new_index[ped.father_index[closure]]
+    mother = new_index[ped.mother_index[closure]]
+    targets = new_index[np.asarray(rows)]
+
+    generation = _check_generations(father, mother)
+    num_generations = generation.max(initial=-1) + 1
+    # the generation after which every individual leaves the frontier; -1
+    # for individuals with no children, which never join it
+    last = np.full(len(closure) + 1, -1, dtype=np.int32)
+    np.maximum.at(last, father, generation)
+    np.maximum.at(last, mother, generation)
+    last = last[:-1]
+    if keep:
+        last[targets] = num_generations
+
+    joins = last > generation
+    sizes = np.cumsum(np.bincount(generation[joins], minlength=num_generations)
+                      - np.bincount(np.minimum(last[joins], num_generations),
+                                    minlength=num_generations + 1)[:-1])
+    peak = int(sizes.max(initial=0))
+    if max_frontier is not None and peak > max_frontier:
+        raise ValueError(f"The kinship frontier peaks at {peak} individuals, "
+                         f"over the limit of {max_frontier}")
+
+    inbreeding = np.zeros(len(closure))
+    # position of every individual in the frontier matrix, -1 if not in it.
+    # The matrix is allocated once, for the largest frontier, which fills
+    # its top left corner; its last row and column are never written, so
+    # that -1, for missing parents, picks zeros
+    position = np.full(len(closure) + 1, -1, dtype=np.int64)
+    frontier = np.empty(0, dtype=np.int64)
+    kinship = np.zeros((peak + 1, peak + 1))
+    for g, level in enumerate(generation_rows(generation)):
+        size = len(frontier)
+        father_pos = position[father[level]]
+        mother_pos = position[mother[level]]
+        inbreeding[level] = kinship[father_pos, mother_pos]
+
+        join = last[level] > g
+        father_pos, mother_pos = father_pos[join], mother_pos[join]
+        # kinship of the joining individuals to the frontier, with a last
+        # column of zeros for missing parents, and to each other, as none
+        # of them is an ancestor of another
+        cross = np.zeros((len(father_pos), size + 1))
+        cross[:, :size] = (kinship[father_pos, :size] +
+                           kinship[mother_pos, :size]) / 2
+        within = (np.take(cross, father_pos, axis=1) +
+                  np.take(cross, mother_pos, axis=1)) / 2
+        np.fill_diagonal(within, (1 + inbreeding[level[join]]) / 2)
+
+        stay = np.flatnonzero(last[frontier] > g)
+        if len(stay) < size:
+            kinship[:len(stay), :len(stay)] = kinship[np.ix_(stay, stay)]
+        cross = np.take(cross, stay, axis=1)
+        old, size = len(stay), len(stay) + len(cross)
+        kinship[old:size, :old] = cross
+        kinship[:old, old:size] = cross.T
+        kinship[old:size, old:size] = within
+
+        position[frontier] = -1
+        frontier = np.concatenate([frontier[stay], level[join]])
+        position[frontier] = np.arange(len(frontier))
+
+    result = None
+    if keep:
+        target_pos = position[targets]
+        result = kinship[np.ix_(target_pos, target_pos)]
+    return closure, inbreeding, result, peak
+
+
+def inbreeding(ped, rows=None, max_frontier=None):
+    """
+    Inbreeding coefficients of the individuals in `rows`, or of everyone:
+    the kinship between their parents.
+    """
+    if rows is None:
+        rows = np.arange(ped.num_individuals)
+    rows = np.asarray(rows)
+    closure, coefficients, _, _ = _kinship_frontier(
+        ped, rows, keep=False, max_frontier=max_frontier)
+    return coefficients[np.searchsorted(closure, rows)]
+
+
+def kinship(ped, rows, max_frontier=None):
+    """
+    The kinship matrix of the individuals in `rows`, in that order: the
+    probability that alleles drawn at random from two individuals at the
+    same locus are identical by descent. The diagonal is (1 + F) / 2 for
+    inbreeding coefficient F.
+    """
+    _, _, matrix, _ = _kinship_frontier(ped, rows, keep=True,
+                                        max_frontier=max_frontier)
+    return matrix
+
+
+def ancestors_per_generation(ped, rows):
+    """
+    The number of distinct ancestors of the individuals in `rows`,
+    themselves included, at every generation above the probands, with the
+    generation times `simulate.py` gives msprime (see
+    `PedigreeColumns.generation_depth`). It bounds the number of lineages,
+    and so of coalescences, at every generation of a simulation over the
+    pedigree.
+    """
+    time = ped.generation_depth().astype(np.int64)
+    return np.bincount(time[ped.ancestor_closure(rows)])
+
+
+def get_parser():
+    parser = ArgumentParser(
+        "pedigree_stats.py - describe the genealogy of a set of probands")
+    parser.add_argument("genealogy", help="Genealogy file")
+    parser.add_argument("output",
+                        help="Output table, with the depth and inbreeding "
+                             "coefficient of every proband")
+    parser.add_argument("--proband-file", "-p", default=None,
+                        help="Proband IDs, one per line; all the individuals "
+                             "with no children by default")
+    parser.add_argument("--proband-indices", action="store_true",
+                        help="The proband file holds row indices in the "
+                             "genealogy instead of IDs")
+    parser.add_argument("--founders", default=None,
+                        help="Write the genetic contribution of every founder "
+                             "to the probands to this file")
+    parser.add_argument("--generations", default=None,
+                        help="Write the number of ancestors of the probands "
+                             "at every generation to this file")
+    parser.add_argument("--kinship", default=None,
+                        help="Write the kinship matrix of the probands, in "
+                             "the order of the output table, to this .npy file")
+    parser.add_argument("--max-frontier", type=int, default=40_000,
+                        help="Fail rather than hold the kinship of more "
+                             "individuals than this at once")
+    parser.add_argument("--delimiter", "-d", default=None,
+                        help="Delimiter for genealogy")
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    instrument.start("pedigree-stats", args)
+    status(f"Reading input genealogy {args.genealogy}...")
+    with instrument.span("read") as span:
+        ped = load_pedigree(args.genealogy, delimiter=args.delimiter)
+        span.count(individuals=ped.num_individuals)
+
+    if args.proband_file:
+        probands = np.loadtxt(args.proband_file, dtype=np.int64, ndmin=1)
+        if not args.proband_indices:
+            probands = ped.index_of(probands)
+    else:
+        probands = ped.proband_indices()
+    status(f"Describing the genealogy of {len(probands)} probands...")
+
+    with instrument.span("depth"):
+        depths = depth(ped)
+    with instrument.span("inbreeding", probands=len(probands)) as span:
+        closure, coefficients, matrix, peak = _kinship_frontier(
+            ped, probands, keep=args.kinship is not None,
+            max_frontier=args.max_frontier)
+        span.count(ancestors=len(closure), frontier=peak)
+    with instrument.span("write"):
+        table = np.column_stack([
+            ped.individual[probands], depths.maximum[probands],
+            depths.minimum[probands], depths.mean[probands],
+            coefficients[np.searchsorted(closure, probands)]])
+        np.savetxt(args.output, table, fmt=["%d", "%d", "%d", "%.6f", "%.8g"],
+                   delimiter="\t",
+                   header="individual\tmax_depth\tmin_depth\tmean_depth\t"
+                          "inbreeding")
+        if matrix is not None:
+            np.save(args.kinship, matrix)
+
+    if args.founders is not None:
+        with instrument.span("founders") as span:
+            contribution, missing = genetic_contributions(ped, probands)
+            founders = np.flatnonzero((ped.father_index < 0) &
+                                      (ped.mother_index < 0) &
+                                      (contribution > 0))
+            founders = founders[np.argsort(-contribution[founders],
+                                           kind="stable")]
+            np.savetxt(args.founders, np.column_stack([
+                ped.individual[founders], contribution[founders]]),
+                fmt=["%d", "%.8g"], delimiter="\t",
+                header="founder\tcontribution")
+            span.count(founders=len(founders))
+        status(f"{len(founders)} founders contribute "
+               f"{contribution[founders].sum():.4f} of the probands' genomes, "
+               f"missing parents {missing:.4f}")
+
+    if args.generations is not None:
+        with instrument.span("generations"):
+            counts = ancestors_per_generation(ped, probands)
+            np.savetxt(args.generations,
+                       np.column_stack([np.arange(len(counts)), counts]),
+                       fmt="%d", delimiter="\t",
+                       header="generation\tancestors")
+
+    instrument.finish(args.output)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
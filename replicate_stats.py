@@ -0,0 +1,82 @@
+"""
+Summary statistics over simulation replicates.
+"""
+from collections import namedtuple
+from statistics import NormalDist
+
+import numpy as np
+import tskit
+
+
+class RunningMoments:
+    """
+    Online (Welford) mean and variance of a stream of equally shaped arrays,
+    in constant memory whatever the number of arrays.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros_like(values)
+            self.m2 = np.zeros_like(values)
+        elif values.shape != self.mean.shape:
+            raise ValueError(
+                f"Expected an array of shape {self.mean.shape}, got {values.shape}"
+            )
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        """
+        Unbiased sample variance, NaN with fewer than two arrays.
+        """
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self.m2 / (self.count - 1)
+
+
+def coalescence_counts(ts, num_generations):
+    """
+    Number of coalescence nodes in each of the generations 0 to
+    `num_generations - 1`, read from the node columns of `ts` without
+    copying its tables. Sample nodes and nodes outside the pedigree (with no
+    individual) are ignored.
+    """
+    mask = (ts.nodes_individual != -1) & (
+        (ts.nodes_flags & tskit.NODE_IS_SAMPLE) == 0
+    )
+    times = ts.nodes_time[mask].astype(np.int64)
+    times = times[times < num_generations]
+    return np.bincount(times, minlength=num_generations)
+
+
+CoalescenceSummary = namedtuple(
+    "CoalescenceSummary", ["mean", "variance", "stdev", "ci_low", "ci_high"]
+)
+
+
+def summarize_counts(counts, level=0.95):
+    """
+    Per-generation mean, unbiased variance, standard deviation and normal
+    confidence interval of the mean, over the replicates (rows) of a count
+    matrix.
+    """
+    num_replicates = counts.shape[0]
+    mean = counts.mean(axis=0)
+    if num_replicates > 1:
+        variance = counts.var(axis=0, ddof=1)
+    else:
+        variance = np.full(counts.shape[1], np.nan)
+    stdev = np.sqrt(variance)
+    half_width = NormalDist().inv_cdf((1 + level) / 2) * stdev / np.sqrt(num_replicates)
+    return CoalescenceSummary(
+        mean, variance, stdev, mean - half_width, mean + half_width
+    )
@@ -0,0 +1,259 @@
+"""
+Run replicate simulations over a genealogy on a pool of processes.
+
+Every worker loads the pedigree once and sends back a small summary of each
+replicate (a "reduction"), never the tree sequence itself, so N replicates
+can use N cores in bounded memory. Each replicate gets its own seed, derived
+from the root seed, so the results do not depend on the number of workers.
+"""
+import multiprocessing
+import os
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import instrument
+import replicate_stats
+from checkpoint import Checkpoints, check_seed_argument
+from pedigree import BINARY_SUFFIX, read_binary, write_binary
+from simulate import (
+    derive_seeds,
+    init_worker,
+    prepare_pedigree,
+    simulate,
+    status,
+    worker,
+)
+
+
+def coalescence_counts(ts, ped):
+    """
+    Number of coalescence nodes in every generation, from 0 to the depth of
+    the pedigree. Sample nodes and nodes outside the pedigree are ignored.
+    """
+    return replicate_stats.coalescence_counts(ts, int(max(ped.time)) + 1)
+
+
+def branch_afs(ts, ped):
+    """
+    Folded branch-length allele frequency spectrum.
+    """
+    return ts.allele_frequency_spectrum(
+        mode="branch", polarised=False, span_normalise=False
+    )
+
+
+def table_sizes(ts, ped):
+    """
+    Number of nodes, edges and trees.
+    """
+    return np.array([ts.num_nodes, ts.num_edges, ts.num_trees])
+
+
+REDUCTIONS = {
+    "coalescence": coalescence_counts,
+    "afs": branch_afs,
+    "nodes": table_sizes,
+}
+
+
+def _run_replicate(task):
+    replicate, seed, path = task
+    ts = next(
+        simulate(
+            worker["ped"],
+            worker["sample_size"],
+            random_seed=seed,
+            **worker["simulation_kwargs"],
+        )
+    )
+    return replicate, worker["reduce"](ts, worker["ped"]), path
+
+
+def _save_npy(array, path):
+    # np.save would add a .npy suffix to the temporary name
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+def _checkpointed(results, checkpoints):
+    for replicate, result, path in results:
+        if path is not None:
+            checkpoints.commit(path, lambda tmp: _save_npy(result, tmp))
+        yield replicate, result
+
+
+def run_replicates(
+    genealogy,
+    num_replicates,
+    reduction="coalescence",
+    processes=None,
+    seed=None,
+    length=1000,
+    recomb_rate=0,
+    proband_file=None,
+    proband_indices=False,
+    prune=True,
+    checkpoint_dir=None,
+):
+    """
+    Simulate `num_replicates` replicates over the genealogy. Yields
+    `(replicate, result)` pairs in completion order, where `result` is the
+    `reduction` (a key of `REDUCTIONS`) of the replicate tree sequence.
+
+    With `checkpoint_dir`, the result of every replicate is checkpointed,
+    and replicates finished by an earlier run are not simulated again.
+    """
+    checkpoints = Checkpoints(checkpoint_dir)
+    checkpoints.check_seed(seed)
+    columns, pedigree_key = checkpoints.run(
+        "pedigree",
+        lambda: prepare_pedigree(
+            genealogy,
+            proband_file=proband_file,
+            proband_indices=proband_indices,
+            prune=prune,
+        ),
+        save=write_binary,
+        load=read_binary,
+        files=[genealogy, proband_file],
+        params=dict(proband_indices=proband_indices, prune=prune),
+        suffix=BINARY_SUFFIX,
+    )
+
+    simulation_kwargs = dict(length=length, recomb_rate=recomb_rate)
+    tasks = []
+    for replicate, replicate_seed in enumerate(derive_seeds(seed, num_replicates)):
+        key = checkpoints.key(
+            "replicate",
+            keys=[pedigree_key],
+            params=dict(simulation_kwargs, seed=replicate_seed, reduction=reduction),
+        )
+        path = None if key is None else checkpoints.path("replicate", key, ".npy")
+        if path is not None and os.path.exists(path):
+            yield replicate, np.load(path)
+        else:
+            tasks.append((replicate, replicate_seed, path))
+    if not tasks:
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        pedigree = os.path.join(directory, "pedigree.ped")
+        write_binary(columns, pedigree)
+        extra = dict(simulation_kwargs=simulation_kwargs, reduce=REDUCTIONS[reduction])
+        initargs = (pedigree, extra)
+
+        if processes == 1:
+            init_worker(*initargs)
+            yield from _checkpointed(map(_run_replicate, tasks), checkpoints)
+        else:
+            with multiprocessing.Pool(
+                processes, initializer=init_worker, initargs=initargs
+            ) as pool:
+                results = pool.imap_unordered(_run_replicate, tasks)
+                yield from _checkpointed(results, checkpoints)
+
+
+def collect_replicates(results, num_replicates, dtype=None):
+    """
+    Stack streamed `(replicate, result)` pairs into a (replicates, k)
+    matrix, allocated once the first result arrives, of the `dtype` of the
+    results by default. Without results, the matrix is empty.
+    """
+    matrix = None
+    for replicate, result in results:
+        if matrix is None:
+            matrix = np.zeros(
+                (num_replicates, len(result)), dtype=dtype or result.dtype
+            )
+        matrix[replicate] = result
+    if matrix is None:
+        return np.zeros((0, 0), dtype=dtype or float)
+    return matrix
+
+
+def get_parser():
+    parser = ArgumentParser("replicates.py")
+    parser.add_argument("genealogy", help="Genealogy file")
+    parser.add_argument("output", help="Output .npy file, one row per replicate")
+    parser.add_argument(
+        "--replicates", "-n", default=10, type=int, help="Number of replicates"
+    )
+    parser.add_argument(
+        "--reduction",
+        choices=sorted(REDUCTIONS),
+        default="coalescence",
+        help="Summary of each replicate to keep",
+    )
+    parser.add_argument(
+        "--processes",
+        "-j",
+        default=None,
+        type=int,
+        help="Number of worker processes (default: all cores)",
+    )
+    parser.add_argument("--seed", "-s", default=None, type=int, help="Root seed")
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="Checkpoint every replicate in this directory, and skip the "
+        "replicates already finished by an earlier run",
+    )
+    parser.add_argument("--proband-file", "-p", default=None, help="List of probands")
+    parser.add_argument(
+        "--proband-indices",
+        action="store_true",
+        help="The proband file lists row indices in the genealogy "
+        "(find_probands.py --indices) instead of IDs",
+    )
+    parser.add_argument(
+        "--no-prune",
+        action="store_true",
+        help="Simulate over the whole genealogy, even if the probands only "
+        "descend from part of it",
+    )
+    parser.add_argument(
+        "--length", "-l", default=1000, type=int, help="Length of chromosome in base-pairs"
+    )
+    parser.add_argument(
+        "--recomb-rate",
+        "-r",
+        default=0,
+        type=float,
+        help="Recombination rate per base-pair per generation",
+    )
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    parser = get_parser()
+    check_seed_argument(parser, args)
+    if args.replicates < 1:
+        parser.error("argument --replicates/-n: must be at least 1")
+    instrument.start("replicates", args)
+    with instrument.span("replicates", replicates=args.replicates,
+                         processes=args.processes):
+        results = run_replicates(
+            args.genealogy,
+            args.replicates,
+            reduction=args.reduction,
+            processes=args.processes,
+            seed=args.seed,
+            length=args.length,
+            recomb_rate=args.recomb_rate,
+            proband_file=args.proband_file,
+            proband_indices=args.proband_indices,
+            prune=not args.no_prune,
+            checkpoint_dir=args.checkpoint_dir,
+        )
+        # the replicates run as the generator is consumed
+        matrix = collect_replicates(results, args.replicates)
+    with instrument.span("write"):
+        np.save(args.output, matrix)
+    status(f"Wrote {matrix.shape[0]} replicates to {args.output}")
+    instrument.finish(args.output)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
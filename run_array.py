@@ -0,0 +1,220 @@
+"""
+Run an array of simulate.py tasks on the local machine, as a stand-in for
+the PBS array job in batch_sim.sh on workstations and in CI.
+
+Task `i` (from 1 to the array size) simulates the chromosome with seed `i`
+into `<output>/sim_<i>.trees`, or `sim_<i>.trees.gz` with `--compress`.
+Every task runs the simulate.py code in its own process, with an optional
+address-space cap, its output in `<output>/logs/task_<i>.log`, and a number
+of retries. A summary of the wall time and peak RSS of every task is printed
+and written to `<output>/summary.json`.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+from argparse import ArgumentParser
+from collections import deque
+from multiprocessing.connection import wait
+
+import instrument
+import simulate
+
+UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_memory(text):
+    """
+    Parse a memory size such as `2gb`, `512M` or `1000000` into bytes.
+    """
+    text = text.strip().lower().rstrip("b")
+    unit = text[-1] if text and text[-1] in UNITS else ""
+    return int(float(text[: len(text) - len(unit)]) * UNITS[unit])
+
+
+def _run_task(task_args, log_file, memory_limit, conn):
+    # send everything the task prints, including from C extensions, to its
+    # log file
+    with open(log_file, "a") as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    start = time.perf_counter()
+    error = None
+    try:
+        simulate.main(simulate.get_parser().parse_args(task_args))
+    except BaseException:
+        error = traceback.format_exc()
+        print(error, file=sys.stderr)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.send(
+        dict(
+            wall_time=time.perf_counter() - start,
+            peak_rss=instrument.peak_rss(),
+            error=error,
+        )
+    )
+    conn.close()
+
+
+def task_arguments(args, task, extra):
+    """
+    The simulate.py command line of one array task.
+    """
+    suffix = ".trees.gz" if args.compress else ".trees"
+    output = os.path.join(args.output_dir, f"sim_{task}{suffix}")
+    return [
+        args.genealogy,
+        output,
+        "--length",
+        str(args.length),
+        "--recomb-rate",
+        str(args.recomb_rate),
+        "--seed",
+        str(task),
+    ] + extra
+
+
+def run_array(args, extra=()):
+    """
+    Run all the tasks of the array, at most `args.concurrency` at a time,
+    retrying failed ones up to `args.retries` times. Returns the per-task
+    summaries.
+    """
+    log_dir = os.path.join(args.output_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    memory_limit = None if args.mem_limit is None else parse_memory(args.mem_limit)
+
+    pending = deque(range(1, args.array_size + 1))
+    attempts = {task: 0 for task in pending}
+    summary = {}
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < args.concurrency:
+            task = pending.popleft()
+            attempts[task] += 1
+            log_file = os.path.join(log_dir, f"task_{task}.log")
+            with open(log_file, "a") as log:
+                log.write(f"=== attempt {attempts[task]}\n")
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_run_task,
+                args=(
+                    task_arguments(args, task, list(extra)),
+                    log_file,
+                    memory_limit,
+                    sender,
+                ),
+            )
+            process.start()
+            sender.close()
+            running[process.sentinel] = (task, process, receiver, time.perf_counter())
+
+        for sentinel in wait(list(running)):
+            task, process, receiver, start = running.pop(sentinel)
+            process.join()
+            if receiver.poll():
+                result = receiver.recv()
+            else:
+                # killed, e.g. by the out-of-memory killer
+                result = dict(
+                    wall_time=time.perf_counter() - start,
+                    peak_rss=None,
+                    error=f"exited with status {process.exitcode}",
+                )
+            receiver.close()
+
+            failed = result["error"] is not None or process.exitcode != 0
+            if failed and attempts[task] <= args.retries:
+                simulate.status(f"Task {task} failed, retrying...")
+                pending.append(task)
+                continue
+
+            summary[task] = dict(
+                task=task,
+                status="failed" if failed else "done",
+                attempts=attempts[task],
+                wall_time=result["wall_time"],
+                peak_rss_mb=(
+                    None if result["peak_rss"] is None else result["peak_rss"] / 2**20
+                ),
+                error=None if result["error"] is None else result["error"].strip(),
+            )
+            simulate.status(
+                f"Task {task} {summary[task]['status']} "
+                f"after {attempts[task]} attempt(s)"
+            )
+
+    return [summary[task] for task in sorted(summary)]
+
+
+def print_summary(summary, file=sys.stdout):
+    print("task\tstatus\tattempts\twall_time_s\tpeak_rss_mb", file=file)
+    for row in summary:
+        rss = "NA" if row["peak_rss_mb"] is None else f"{row['peak_rss_mb']:.1f}"
+        print(
+            f"{row['task']}\t{row['status']}\t{row['attempts']}\t"
+            f"{row['wall_time']:.2f}\t{rss}",
+            file=file,
+        )
+
+
+def get_parser():
+    parser = ArgumentParser(
+        "run_array.py",
+        description="Any argument not listed here is passed on to every "
+        "simulate.py task, e.g. --checkpoint-dir or --segments.",
+    )
+    parser.add_argument("genealogy", help="Genealogy file")
+    parser.add_argument("output_dir", help="Output directory for tree sequences")
+    parser.add_argument(
+        "--length", "-l", default=1000, type=int, help="Length of chromosome in base-pairs"
+    )
+    parser.add_argument(
+        "--recomb-rate",
+        "-r",
+        default=0,
+        type=float,
+        help="Recombination rate per base-pair per generation",
+    )
+    parser.add_argument(
+        "--array-size", "-n", default=10, type=int, help="Number of tasks"
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-j",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of tasks running at the same time (default: all cores)",
+    )
+    parser.add_argument(
+        "--mem-limit",
+        default=None,
+        help="Address space cap of every task, e.g. 2gb",
+    )
+    parser.add_argument(
+        "--retries", default=1, type=int, help="Number of retries of a failed task"
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Write gzip-compressed sim_<i>.trees.gz files (see storage.py)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args, extra = get_parser().parse_known_args()
+    summary = run_array(args, extra)
+    print_summary(summary)
+    with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    if any(row["status"] != "done" for row in summary):
+        sys.exit(1)
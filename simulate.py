@@ -1,102 +1,512 @@
-import msprime
 import tskit
 import numpy as np
+import json
+import multiprocessing
+import os
 import sys
+import tempfile
 from argparse import ArgumentParser
 from pathlib import Path
-from datetime import datetime
+
+import instrument
+import storage
+from checkpoint import Checkpoints, check_seed_argument
+from metadata import OFFSET_DTYPE, set_individual_metadata
+from pedigree import BINARY_SUFFIX, load_pedigree, read_binary, write_binary
 
 
 def status(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
 
 
-parser = ArgumentParser("simulate.py")
-parser.add_argument("genealogy", help="Genealogy file")
-parser.add_argument("output_ts", type=Path, help="Output tree sequence file")
-parser.add_argument("--proband-file", "-p", default=None, help="List of probands")
-parser.add_argument(
-    "--length", "-l", default=1000, type=int, help="Length of chromosome in base-pairs"
-)
-parser.add_argument(
-    "--recomb-rate",
-    "-r",
-    default=0,
-    type=float,
-    help="Recombination rate per base-pair per generation",
-)
-
-args = parser.parse_args()
-
-clock_start = datetime.now()
-status(f"Started at {clock_start}")
-
-status("Reading pedigree file...")
-ped = msprime.Pedigree.read_txt(args.genealogy)
-status(f"Read pedigree with {ped.num_individuals} individuals...")
-
-if args.proband_file:
-    status(f"Using proband file {args.proband_file}...")
-    proband_ID = np.loadtxt(args.proband_file, dtype=int)
-    sample_size = len(proband_ID)
-    ped.set_samples(sample_IDs=proband_ID, probands_only=True)
-else:
-    status("Finding probands...")
-    proband_idx = ped.get_proband_indices()
-    sample_size = len(proband_idx)
-    ped.set_samples(num_samples=sample_size)
-status(f"Using {sample_size} probands...")
-
-t = int(max(ped.time))
-
-sim = msprime.simulate(
-    sample_size,
-    pedigree=ped,
-    model="wf_ped",
-    end_time=t,
-    length=args.length,
-    recombination_rate=args.recomb_rate,
-    num_replicates=1,
-)
-
-status("Converting tables...")
-
-# record individual id metadata
-tables = next(sim).dump_tables()
-
-individual_metadata_schema = tskit.MetadataSchema(
-    {
-        "codec": "json",
-        "type": "object",
-        "properties": {
-            # Name of the individual in the pedigree file
-            "individual_name": {"type": "integer"},
-            "is_sample": {"type": "boolean"},
-        },
-        "required": ["individual_name", "is_sample"],
-    }
-)
-meta_individuals = tskit.IndividualTable()
-
-meta_individuals.metadata_schema = individual_metadata_schema
-for i, ind in enumerate(tables.individuals):
-    ind_name = int(ped.individual[i]) if i < ped.num_individuals else -1
-    is_sample = bool(ped.is_sample[i]) if i < ped.num_individuals else False
-    meta_individuals.add_row(
-        metadata={"individual_name": ind_name, "is_sample": is_sample},
-    )
-
-tables.individuals.set_columns(
-    flags=tables.individuals.flags,
-    location=tables.individuals.location,
-    location_offset=tables.individuals.location_offset,
-    metadata=meta_individuals.ll_table.metadata,
-    metadata_offset=meta_individuals.ll_table.metadata_offset,
-)
-
-tables.individuals.metadata_schema = individual_metadata_schema
-tables.tree_sequence().dump(args.output_ts)
-
-clock_stop = datetime.now()
-status(f"Done at {clock_stop}")
-status(f"Took {clock_stop - clock_start}")
+def prepare_pedigree(
+    genealogy,
+    proband_file=None,
+    proband_indices=False,
+    prune=True,
+):
+    """
+    Load the genealogy and work out what to simulate over it. Returns the
+    pedigree columns, with a `depth` column holding the time of every
+    individual in the full genealogy and an `is_sample` column. With a
+    proband file, the pedigree is pruned to the probands and their
+    ancestors unless `prune` is False.
+    """
+    status("Reading pedigree file...")
+    with instrument.span("read") as span:
+        columns = load_pedigree(genealogy)
+        span.count(individuals=columns.num_individuals)
+    status(f"Read pedigree with {columns.num_individuals} individuals...")
+    # times are always those of the full genealogy, even after pruning
+    with instrument.span("generation_depth"):
+        depth = columns.generation_depth()
+
+    if proband_file:
+        status(f"Using proband file {proband_file}...")
+        proband_idx = np.loadtxt(proband_file, dtype=int, ndmin=1)
+        if not proband_indices:
+            proband_idx = columns.index_of(proband_idx)
+    else:
+        status("Finding probands...")
+        proband_idx = columns.proband_indices()
+    columns.check_probands(proband_idx)
+    is_sample = np.zeros(columns.num_individuals, dtype=np.int8)
+    is_sample[proband_idx] = 1
+    columns = columns.with_columns(depth=depth, is_sample=is_sample)
+
+    if proband_file and prune:
+        status("Pruning pedigree to the ancestors of the probands...")
+        # the pruned pedigree keeps the original IDs, so the probands and
+        # the individual_name metadata refer to the input genealogy
+        with instrument.span("prune") as span:
+            columns = columns.subset(columns.ancestor_closure(proband_idx))
+            span.count(individuals=columns.num_individuals)
+        status(f"Kept {columns.num_individuals} individuals...")
+
+    return columns
+
+
+def to_simulation_pedigree(columns):
+    """
+    Build the `msprime.Pedigree` of prepared pedigree columns (see
+    `prepare_pedigree`), with its samples set. Returns the pedigree and the
+    number of samples.
+    """
+    ped = columns.to_msprime(time=columns.columns["depth"])
+    is_sample = np.asarray(columns.columns["is_sample"], dtype=bool)
+    # the checks of `ped.set_samples`, and the sample flags and count it
+    # would set, straight from the row indices: set_samples looks every
+    # sample ID up in the pedigree
+    columns.check_probands(np.flatnonzero(is_sample))
+    ped.is_sample = is_sample.astype(int)
+    ped.num_samples = int(is_sample.sum())
+    status(f"Using {ped.num_samples} probands...")
+    return ped, ped.num_samples
+
+
+def simulate(
+    ped, sample_size, length, recomb_rate, random_seed=None, num_replicates=1
+):
+    """
+    Simulate over the whole depth of the pedigree. Returns an iterator over
+    the replicate tree sequences.
+    """
+    import msprime
+
+    t = int(max(ped.time))
+
+    return msprime.simulate(
+        sample_size,
+        pedigree=ped,
+        model="wf_ped",
+        end_time=t,
+        length=length,
+        recombination_rate=recomb_rate,
+        random_seed=random_seed,
+        num_replicates=num_replicates,
+    )
+
+
+def derive_seeds(seed, num_seeds):
+    """
+    Independent msprime seeds spawned from a root seed, e.g. one per
+    replicate or per segment, so that results do not depend on how the work
+    is spread over processes.
+    """
+    children = np.random.SeedSequence(seed).spawn(num_seeds)
+    # msprime seeds must be in [1, 2^32 - 1]
+    return [int(c.generate_state(1)[0]) % (2**32 - 1) + 1 for c in children]
+
+
+# per-process state of pool workers, set up once by init_worker
+worker = {}
+
+
+def init_worker(pedigree, extra=None):
+    """
+    Pool initializer: map the prepared pedigree (a binary pedigree written
+    by the parent process) once per worker process.
+    """
+    ped, sample_size = to_simulation_pedigree(read_binary(pedigree))
+    worker.update(ped=ped, sample_size=sample_size, **(extra or {}))
+
+
+def segment_bounds(length, num_segments):
+    """
+    Breakpoints splitting [0, length) into `num_segments` equal segments.
+    """
+    return np.linspace(0, length, num_segments + 1).round().astype(np.int64)
+
+
+def _simulate_segment(task):
+    left, right, seed, path = task
+    ts = next(
+        simulate(
+            worker["ped"],
+            worker["sample_size"],
+            right - left,
+            worker["recomb_rate"],
+            random_seed=seed,
+        )
+    )
+    # written under a temporary name, so that a checkpoint is never partial
+    tmp = f"{path}.tmp{os.getpid()}"
+    ts.dump(tmp)
+    os.replace(tmp, path)
+    return path
+
+
+def ragged_rows(data, offset, rows):
+    """
+    The data and offsets of the `rows` of a ragged table column, such as
+    the metadata of some of the rows of a node table.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    offset = np.asarray(offset, dtype=np.int64)
+    lengths = offset[rows + 1] - offset[rows]
+    new_offset = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offset[1:])
+    index = np.repeat(offset[rows] - new_offset[:-1], lengths) + np.arange(
+        new_offset[-1])
+    return data[index], new_offset.astype(OFFSET_DTYPE)
+
+
+def stitch_segments(segments, bounds, num_shared_individuals):
+    """
+    Join tree sequences simulated over consecutive segments of the same
+    pedigree into a single tree sequence over [bounds[0], bounds[-1]).
+
+    Sample nodes and the first `num_shared_individuals` individuals (the
+    pedigree) are shared by all the segments; every other node and
+    individual is added from each segment, with its edges shifted to the
+    segment's coordinates.
+    """
+    tables = segments[0].dump_tables()
+    tables.sequence_length = float(bounds[-1])
+    is_sample = (tables.nodes.flags & tskit.NODE_IS_SAMPLE) != 0
+    samples = np.flatnonzero(is_sample)
+
+    if any(ts.num_sites > 0 for ts in segments):
+        raise ValueError("Segments must be stitched before adding mutations")
+
+    for segment, ts in enumerate(segments[1:], start=1):
+        offset = bounds[segment]
+        seg = ts.tables
+
+        # individuals outside the pedigree are specific to the segment
+        individuals = seg.individuals
+        extra = np.arange(num_shared_individuals, individuals.num_rows)
+        individual_map = np.arange(individuals.num_rows, dtype=np.int32)
+        individual_map[extra] = tables.individuals.num_rows + np.arange(
+            len(extra))
+        location, location_offset = ragged_rows(
+            individuals.location, individuals.location_offset, extra)
+        metadata, metadata_offset = ragged_rows(
+            individuals.metadata, individuals.metadata_offset, extra)
+        tables.individuals.append_columns(
+            flags=individuals.flags[extra],
+            location=location,
+            location_offset=location_offset,
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
+
+        nodes = seg.nodes
+        seg_is_sample = (nodes.flags & tskit.NODE_IS_SAMPLE) != 0
+        seg_samples = np.flatnonzero(seg_is_sample)
+        if not np.array_equal(
+            nodes.individual[seg_samples], tables.nodes.individual[samples]
+        ):
+            raise ValueError(f"Segment {segment} has different samples")
+
+        other = np.flatnonzero(~seg_is_sample)
+        node_map = np.empty(nodes.num_rows, dtype=np.int32)
+        node_map[seg_samples] = samples
+        node_map[other] = tables.nodes.num_rows + np.arange(len(other))
+        individual = nodes.individual[other]
+        metadata, metadata_offset = ragged_rows(
+            nodes.metadata, nodes.metadata_offset, other)
+        tables.nodes.append_columns(
+            flags=nodes.flags[other],
+            time=nodes.time[other],
+            population=nodes.population[other],
+            individual=np.where(
+                individual >= 0, individual_map[individual], -1
+            ).astype(np.int32),
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
+
+        edges = seg.edges
+        tables.edges.append_columns(
+            left=edges.left + offset,
+            right=edges.right + offset,
+            parent=node_map[edges.parent],
+            child=node_map[edges.child],
+        )
+
+    # keep the msprime record first: the completion scripts read their
+    # parameters from provenance 0
+    tables.provenances.add_row(
+        record=json.dumps(
+            {
+                "software": {"name": "msp-gen"},
+                "parameters": {
+                    "command": "stitch_segments",
+                    "bounds": [int(b) for b in bounds],
+                },
+            }
+        )
+    )
+    tables.sort()
+    return tables.tree_sequence()
+
+
+def simulate_segments(
+    columns,
+    length,
+    recomb_rate,
+    num_segments,
+    processes=None,
+    seed=None,
+    checkpoints=None,
+    pedigree_key=None,
+):
+    """
+    Simulate [0, length) over prepared pedigree columns as `num_segments`
+    independent segments on a pool of processes, and stitch them together.
+    Segments are treated as unlinked, i.e. as if a recombination happened
+    at every breakpoint.
+
+    With checkpoints, every segment is checkpointed on its own, and only the
+    missing segments are simulated. Returns the tree sequence and its key.
+    """
+    checkpoints = checkpoints or Checkpoints()
+    checkpoints.check_seed(seed)
+    bounds = segment_bounds(length, num_segments)
+    seeds = derive_seeds(seed, num_segments)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths, keys = [], []
+        for i in range(num_segments):
+            params = dict(
+                left=bounds[i], right=bounds[i + 1], recomb_rate=recomb_rate,
+                seed=seeds[i],
+            )
+            key = checkpoints.key("segment", keys=[pedigree_key], params=params)
+            keys.append(key)
+            if key is None:
+                paths.append(os.path.join(directory, f"segment_{i}.trees"))
+            else:
+                paths.append(checkpoints.path("segment", key, ".trees"))
+
+        tasks = [
+            (bounds[i], bounds[i + 1], seeds[i], paths[i])
+            for i in range(num_segments)
+            if not os.path.exists(paths[i])
+        ]
+        status(f"Simulating {len(tasks)} of {num_segments} segments...")
+        if tasks:
+            pedigree = os.path.join(directory, "pedigree.ped")
+            write_binary(columns, pedigree)
+            extra = dict(recomb_rate=recomb_rate)
+            with multiprocessing.Pool(
+                processes, initializer=init_worker, initargs=(pedigree, extra)
+            ) as pool:
+                pool.map(_simulate_segment, tasks, chunksize=1)
+
+        return checkpoints.run(
+            "stitch",
+            lambda: stitch_segments(
+                [tskit.load(path) for path in paths],
+                bounds,
+                columns.num_individuals,
+            ),
+            keys=keys,
+        )
+
+
+def convert_tables(ts, columns, metadata_codec="json"):
+    """
+    Record the genealogy ID of every individual, from prepared pedigree
+    columns, as metadata. Returns the table collection.
+    """
+    tables = ts.dump_tables()
+
+    # individuals beyond the pedigree are not in the genealogy file
+    num_rows = tables.individuals.num_rows
+    in_ped = min(num_rows, columns.num_individuals)
+    individual_name = np.full(num_rows, -1, dtype=np.int64)
+    individual_name[:in_ped] = columns.individual[:in_ped]
+    is_sample = np.zeros(num_rows, dtype=bool)
+    is_sample[:in_ped] = columns.columns["is_sample"][:in_ped]
+
+    set_individual_metadata(
+        tables, individual_name, is_sample, codec=metadata_codec
+    )
+    return tables
+
+
+def get_parser():
+    parser = ArgumentParser("simulate.py")
+    parser.add_argument("genealogy", help="Genealogy file")
+    parser.add_argument("output_ts", type=Path, help="Output tree sequence file")
+    parser.add_argument(
+        "--proband-file", "-p", default=None, help="List of probands"
+    )
+    parser.add_argument(
+        "--proband-indices",
+        action="store_true",
+        help="The proband file lists row indices in the genealogy "
+        "(find_probands.py --indices) instead of IDs",
+    )
+    parser.add_argument(
+        "--no-prune",
+        action="store_true",
+        help="Simulate over the whole genealogy, even if the probands only "
+        "descend from part of it",
+    )
+    parser.add_argument(
+        "--pruned-genealogy",
+        default=None,
+        help="Write the genealogy pruned to the ancestors of the probands to "
+        "this binary pedigree directory",
+    )
+    parser.add_argument(
+        "--length",
+        "-l",
+        default=1000,
+        type=int,
+        help="Length of chromosome in base-pairs",
+    )
+    parser.add_argument(
+        "--recomb-rate",
+        "-r",
+        default=0,
+        type=float,
+        help="Recombination rate per base-pair per generation",
+    )
+    parser.add_argument(
+        "--metadata-codec",
+        choices=["json", "struct"],
+        default="json",
+        help="Encoding of the individual metadata: JSON, or the compact "
+        "binary struct codec",
+    )
+    parser.add_argument(
+        "--seed", "-s", default=None, type=int, help="Random seed"
+    )
+    parser.add_argument(
+        "--segments",
+        default=1,
+        type=int,
+        help="Split the chromosome into this many segments, simulated in "
+        "parallel and stitched together",
+    )
+    parser.add_argument(
+        "--processes",
+        "-j",
+        default=None,
+        type=int,
+        help="Number of processes for --segments (default: all cores)",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="Checkpoint every stage in this directory, and skip the stages "
+        "already checkpointed by an earlier run with the same inputs",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Simplify the output to its samples and their lineages, with "
+        "struct-encoded metadata (see storage.py); name it *.gz to also "
+        "compress it",
+    )
+    instrument.add_arguments(parser)
+    return parser
+
+
+def main(args):
+    check_seed_argument(get_parser(), args)
+    instrument.start("simulate", args)
+    checkpoints = Checkpoints(args.checkpoint_dir)
+
+    with instrument.span("pedigree") as span:
+        columns, pedigree_key = checkpoints.run(
+            "pedigree",
+            lambda: prepare_pedigree(
+                args.genealogy,
+                proband_file=args.proband_file,
+                proband_indices=args.proband_indices,
+                prune=not args.no_prune,
+            ),
+            save=write_binary,
+            load=read_binary,
+            files=[args.genealogy, args.proband_file],
+            params=dict(proband_indices=args.proband_indices, prune=not args.no_prune),
+            suffix=BINARY_SUFFIX,
+        )
+        if args.pruned_genealogy is not None:
+            write_binary(columns, args.pruned_genealogy)
+        span.count(individuals=columns.num_individuals)
+
+    with instrument.span("simulate", segments=args.segments) as span:
+        if args.segments > 1:
+            ts, sim_key = simulate_segments(
+                columns,
+                args.length,
+                args.recomb_rate,
+                args.segments,
+                processes=args.processes,
+                seed=args.seed,
+                checkpoints=checkpoints,
+                pedigree_key=pedigree_key,
+            )
+        else:
+
+            def run_simulation():
+                ped, sample_size = to_simulation_pedigree(columns)
+                sim = simulate(
+                    ped, sample_size, args.length, args.recomb_rate,
+                    random_seed=args.seed
+                )
+                return next(sim)
+
+            ts, sim_key = checkpoints.run(
+                "simulate",
+                run_simulation,
+                keys=[pedigree_key],
+                params=dict(
+                    length=args.length, recomb_rate=args.recomb_rate, seed=args.seed
+                ),
+            )
+        span.count_tree_sequence(ts)
+
+    def run_conversion():
+        status("Converting tables...")
+        tables = convert_tables(ts, columns, metadata_codec=args.metadata_codec)
+        return tables.tree_sequence()
+
+    with instrument.span("convert") as span:
+        ts, _ = checkpoints.run(
+            "convert",
+            run_conversion,
+            keys=[sim_key],
+            params=dict(metadata_codec=args.metadata_codec),
+        )
+        span.count_tree_sequence(ts)
+
+    if args.compact:
+        with instrument.span("compact") as span:
+            ts = storage.compact(ts)
+            span.count_tree_sequence(ts)
+
+    ts = instrument.add_provenance(ts)
+    with instrument.span("write"):
+        storage.dump(ts, args.output_ts)
+    instrument.finish(args.output_ts)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,136 @@
+"""
+Compact storage of the tree sequences written by the scripts.
+
+A pedigree simulation keeps two nodes and an individual, with its metadata,
+for every member of the genealogy, although downstream steps only read the
+samples and the lineages they trace back to. `compact` simplifies a tree
+sequence down to its samples, keeping the roots the completion scripts
+start from and the individuals of the nodes that remain, with their
+metadata in the binary struct codec (see `metadata.py`), and drops the
+bulky parameters of its provenance records.
+
+`dump` gzip-compresses its output when the file name ends in `.gz`, and
+`load` reads plain and compressed files whatever their name, so every
+script reads the output of every other one. A compressed file is the gzip
+of an ordinary tree sequence file, which `gunzip` restores.
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+import tskit
+
+from metadata import decode_individual_metadata, set_individual_metadata
+
+GZIP_MAGIC = b"\x1f\x8b"
+COMPRESSED_SUFFIX = ".gz"
+# level 1 compresses tree sequences almost as well as the default level 6,
+# in a quarter of the time
+COMPRESS_LEVEL = 1
+CHUNK_SIZE = 1 << 20
+# provenance parameters longer than this as JSON are dropped by `compact`
+MAX_PARAMETER_BYTES = 1024
+
+
+def is_compressed(path):
+    with open(path, "rb") as f:
+        return f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def load(path):
+    """
+    Load a tree sequence file, gzip-compressed or not.
+    """
+    if not is_compressed(path):
+        return tskit.load(path)
+    # tskit only reads from file descriptors, so the tree sequence is
+    # decompressed to a local temporary file rather than next to the input,
+    # which is often on a shared filesystem
+    with tempfile.TemporaryFile() as tmp:
+        with gzip.open(path, "rb") as f:
+            shutil.copyfileobj(f, tmp, CHUNK_SIZE)
+        tmp.seek(0)
+        return tskit.load(tmp)
+
+
+def dump(ts, path):
+    """
+    Write a tree sequence, gzip-compressed if `path` ends in `.gz`.
+    """
+    path = os.fspath(path)
+    if not path.endswith(COMPRESSED_SUFFIX):
+        ts.dump(path)
+        return
+    # written under a temporary name, so that a compressed file is never
+    # partial
+    partial = f"{path}.tmp{os.getpid()}"
+    with tempfile.TemporaryFile() as tmp:
+        ts.dump(tmp)
+        tmp.seek(0)
+        with gzip.open(partial, "wb", compresslevel=COMPRESS_LEVEL) as f:
+            shutil.copyfileobj(tmp, f, CHUNK_SIZE)
+    os.replace(partial, path)
+
+
+def _compact_record(record):
+    """
+    A provenance record without its parameters longer than
+    `MAX_PARAMETER_BYTES`, whose names are listed in `dropped_parameters`.
+    """
+    try:
+        record = json.loads(record)
+    except ValueError:
+        return record
+    parameters = record.get("parameters")
+    if not isinstance(parameters, dict):
+        return json.dumps(record)
+    dropped = [name for name, value in parameters.items()
+               if len(json.dumps(value, default=str)) > MAX_PARAMETER_BYTES]
+    if dropped:
+        record["parameters"] = {name: value for name, value in parameters.items()
+                                if name not in dropped}
+        record["dropped_parameters"] = dropped
+    return json.dumps(record)
+
+
+def compact(ts):
+    """
+    Simplify a tree sequence to its samples and the roots above them, with
+    only the individuals of the remaining nodes, struct-encoded individual
+    metadata, and compacted provenance records. Node and individual IDs
+    change; the samples keep their order and the `individual_name` of their
+    individuals. Sites, populations and the first provenance record, whose
+    parameters the completion scripts read, are kept.
+    """
+    tables = ts.dump_tables()
+    tables.simplify(
+        keep_input_roots=True,
+        filter_sites=False,
+        filter_populations=False,
+        record_provenance=False,
+    )
+    if tables.individuals.num_rows > 0 and \
+            len(tables.individuals.metadata) > 0:
+        names, is_sample = decode_individual_metadata(tables.individuals)
+        set_individual_metadata(tables, names, is_sample, codec="struct")
+
+    provenances = tables.provenances.copy()
+    tables.provenances.clear()
+    for row in provenances:
+        tables.provenances.add_row(record=_compact_record(row.record),
+                                   timestamp=row.timestamp)
+    tables.provenances.add_row(
+        record=json.dumps(
+            {
+                "software": {"name": "msp-gen"},
+                "parameters": {
+                    "command": "compact",
+                    "num_nodes": ts.num_nodes,
+                    "num_individuals": ts.num_individuals,
+                },
+            }
+        )
+    )
+    return tables.tree_sequence()
@@ -0,0 +1,24 @@
+import msprime
+import pytest
+
+import afs_replicates
+
+
+def test_model_without_files_is_rejected(tmp_path, capsys):
+    args = afs_replicates.get_parser().parse_args(
+        [str(tmp_path / "afs.npz"), "--model", "A"])
+    with pytest.raises(SystemExit):
+        afs_replicates.main(args)
+    assert "no tree sequence files for model A" in capsys.readouterr().err
+    assert not (tmp_path / "afs.npz").exists()
+
+
+def test_save_afs_rejects_empty_models(tmp_path):
+    ts = msprime.sim_ancestry(5, sequence_length=1e4, random_seed=1)
+    path = tmp_path / "a.trees"
+    ts.dump(path)
+    moments = afs_replicates.accumulate_afs(
+        {"A": [str(path)], "B": []}, mode="branch", processes=1)
+    assert moments["A"].count == 1
+    with pytest.raises(ValueError, match="B"):
+        afs_replicates.save_afs(tmp_path / "afs.npz", moments, "branch")
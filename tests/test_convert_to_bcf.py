@@ -0,0 +1,51 @@
+import msprime
+import numpy as np
+import tskit
+
+import convert_to_bcf
+
+
+def simulate(tmp_path, mutation_rate):
+    """
+    A tree sequence file of 10 diploid samples, without individuals, whose
+    sample nodes are paired up into individuals by `load_samples`.
+    """
+    ts = msprime.sim_ancestry(10, sequence_length=1e5, population_size=1e4,
+                              recombination_rate=1e-8, random_seed=1)
+    ts = msprime.sim_mutations(ts, rate=mutation_rate, random_seed=1)
+    tables = ts.dump_tables()
+    tables.individuals.clear()
+    tables.nodes.individual = np.full(tables.nodes.num_rows, tskit.NULL,
+                                      dtype=np.int32)
+    path = tmp_path / "sim.trees"
+    tables.tree_sequence().dump(path)
+    return path
+
+
+def test_filter_without_sites(tmp_path):
+    path = simulate(tmp_path, mutation_rate=0)
+    ts, nodes, names = convert_to_bcf.load_samples(
+        path, af_cutoff=0.05, remove_singletons=True)
+    assert ts.num_sites == 0
+    assert len(nodes) == 20
+    assert len(names) == 10
+    assert len(convert_to_bcf.site_filter_mask(ts, min_af=0.05)) == 0
+
+
+def test_filter_out_every_site(tmp_path):
+    path = simulate(tmp_path, mutation_rate=1e-7)
+    assert tskit.load(path).num_sites > 0
+    # minor allele frequencies are at most 0.5
+    ts, nodes, names = convert_to_bcf.load_samples(
+        path, af_cutoff=0.6, folded=True)
+    assert ts.num_sites == 0
+    assert len(names) == 10
+
+
+def test_filter_keeps_sites_in_range(tmp_path):
+    path = simulate(tmp_path, mutation_rate=1e-7)
+    full = tskit.load(path)
+    ts, _, _ = convert_to_bcf.load_samples(path, af_cutoff=0.1, max_af=0.9)
+    counts = convert_to_bcf.derived_allele_counts(full)
+    freq = counts / full.num_samples
+    assert ts.num_sites == np.sum((freq >= 0.1) & (freq <= 0.9))
@@ -0,0 +1,47 @@
+import io
+import os
+
+import msprime
+import numpy as np
+import pytest
+
+import genotypes
+
+
+@pytest.fixture(scope="module")
+def ts():
+    ts = msprime.sim_ancestry(20, sequence_length=1e5, population_size=1e4,
+                              recombination_rate=1e-8, random_seed=2)
+    return msprime.sim_mutations(ts, rate=1e-7, random_seed=2)
+
+
+def names(ts):
+    return [f"tsk_{j}" for j in range(ts.num_individuals)]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_vcf_matches_tskit(ts, processes):
+    expected = io.StringIO()
+    ts.write_vcf(expected)
+    output = io.BytesIO()
+    genotypes.write_vcf(output, ts, ts.samples(), names(ts), chunk_size=100,
+                        processes=processes)
+    assert output.getvalue() == expected.getvalue().encode()
+
+
+def test_plink_and_columnar_do_not_depend_on_processes(ts, tmp_path):
+    outputs = []
+    for processes in (1, 2):
+        prefix = str(tmp_path / f"plink{processes}")
+        genotypes.write_plink(prefix, [(ts, ts.samples(), names(ts), "1", 0)],
+                              chunk_size=100, processes=processes)
+        directory = tmp_path / f"columnar{processes}"
+        genotypes.write_columnar(directory, ts, ts.samples(), names(ts),
+                                 chunk_size=100, processes=processes)
+        files = [prefix + suffix for suffix in (".bed", ".bim", ".fam")]
+        files += [os.path.join(directory, f"{name}.npy")
+                  for name in ("genotypes", "position", "ref", "alt")]
+        outputs.append([open(path, "rb").read() for path in files])
+    assert outputs[0] == outputs[1]
+    stored = np.load(tmp_path / "columnar1" / "genotypes.npy")
+    assert np.array_equal(stored, ts.genotype_matrix())
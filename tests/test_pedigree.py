@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from pedigree import PedigreeColumns
+
+
+def family(time):
+    """
+    Two founders (1, 2) with three children (3, 4, 5), none of whom has
+    children; `time` gives the time column of the six rows, 1 to 5 and 6
+    (an unrelated proband).
+    """
+    return PedigreeColumns({
+        "individual": np.array([1, 2, 3, 4, 5, 6]),
+        "father": np.array([0, 0, 1, 1, 1, 0]),
+        "mother": np.array([0, 0, 2, 2, 2, 0]),
+        "time": np.array(time),
+    })
+
+
+def test_probands():
+    ped = family([1900, 1900, 1930, 1950, 1970, 1960])
+    assert ped.proband_indices().tolist() == [2, 3, 4, 5]
+
+
+def test_min_time_keeps_later_birth_years():
+    # birth years: probands born in or after the year are kept
+    ped = family([1900, 1900, 1930, 1950, 1970, 1960])
+    assert ped.proband_indices(min_time=1950).tolist() == [3, 4, 5]
+    assert ped.proband_indices(min_time=1971).tolist() == []
+
+
+def test_min_time_compares_values_only():
+    # generations before the present: probands at least that far back
+    ped = family([2, 2, 1, 0, 0, 1])
+    assert ped.proband_indices(min_time=1).tolist() == [2, 5]
+
+
+def test_check_probands():
+    ped = family([1900, 1900, 1930, 1950, 1970, 1960])
+    ped.check_probands([2, 5])
+    with pytest.raises(ValueError, match="in \\[0, 6\\)"):
+        ped.check_probands([2, 6])
+    with pytest.raises(ValueError, match="in \\[0, 6\\)"):
+        ped.check_probands([-1])
+    with pytest.raises(ValueError, match="Duplicate"):
+        ped.check_probands([2, 2])
+    with pytest.raises(ValueError, match="have children"):
+        ped.check_probands([0, 2])
@@ -0,0 +1,55 @@
+import numpy as np
+import tskit
+
+from simulate import ragged_rows, stitch_segments
+
+
+def segment(length, extra_metadata):
+    """
+    Two shared individuals, each with two sample nodes, and an individual
+    and two internal nodes specific to the segment, with metadata.
+    """
+    tables = tskit.TableCollection(length)
+    tables.populations.add_row()
+    for name in (b"a", b"b", extra_metadata):
+        tables.individuals.add_row(location=[len(name)], metadata=name)
+    for j in range(4):
+        tables.nodes.add_row(flags=tskit.NODE_IS_SAMPLE, time=0,
+                             population=0, individual=j // 2)
+    tables.nodes.add_row(time=1, population=0, individual=2,
+                         metadata=b"p" + extra_metadata)
+    tables.nodes.add_row(time=2, population=0, metadata=b"root")
+    for child in (0, 1):
+        tables.edges.add_row(0, length, 4, child)
+    for child in (2, 3, 4):
+        tables.edges.add_row(0, length, 5, child)
+    tables.sort()
+    return tables.tree_sequence()
+
+
+def test_ragged_rows():
+    data = np.frombuffer(b"abbccc", dtype=np.int8)
+    offset = np.array([0, 1, 3, 6])
+    rows, new_offset = ragged_rows(data, offset, [2, 0])
+    assert rows.tobytes() == b"ccca"
+    assert new_offset.tolist() == [0, 3, 4]
+    rows, new_offset = ragged_rows(data, offset, [])
+    assert len(rows) == 0 and new_offset.tolist() == [0]
+
+
+def test_stitch_keeps_metadata():
+    segments = [segment(10, b"first"), segment(20, b"second")]
+    ts = stitch_segments(segments, [0, 10, 30], num_shared_individuals=2)
+    assert ts.sequence_length == 30
+    assert ts.num_samples == 4
+    assert [ind.metadata for ind in ts.individuals()] == [
+        b"a", b"b", b"first", b"second"]
+    assert [ind.location.tolist() for ind in ts.individuals()] == [
+        [1], [1], [5], [6]]
+    internal = [node for node in ts.nodes() if not node.is_sample()]
+    assert sorted(node.metadata for node in internal) == [
+        b"pfirst", b"psecond", b"root", b"root"]
+    second = [node for node in internal if node.metadata == b"psecond"][0]
+    assert second.individual == 3
+    assert ts.num_trees == 2
+    assert ts.first().num_roots == 1